@@ -20,7 +20,8 @@ It supports MCCP, GMCP, aliases, actions, substitutes, variables
  * From the installation directory, ```python bastproxy.py```
 
 ```
-usage: bastproxy.py [-h] [-p PORT] [-d]
+usage: bastproxy.py [-h] [-p PORT] [-d] [-e {epoll,poll,select}] [-r RESTORE]
+                    [-s SESSIONS]
 
 A python mud proxy
 
@@ -28,8 +29,23 @@ optional arguments:
   -h, --help            show this help message and exit
   -p PORT, --port PORT  the port for the proxy to listen on
   -d, --daemon          run in daemon mode
+  -e {epoll,poll,select}, --engine {epoll,poll,select}
+                        the event loop backend to use
+  -r RESTORE, --restore RESTORE
+                        the state file from a hot restart, used by
+                        #bp.proxy.restart
+  -s SESSIONS, --sessions SESSIONS
+                        run a session for each name in a comma separated
+                        list, clients pick one when they connect
 ```
 
+### Sessions
+  * To run more than one character, start the proxy with a list of sessions
+     * ```python bastproxy.py -s char1,char2```
+  * Each session is a process with its own plugins and settings in
+     data/sessions/"name"
+  * Login with the session name and the proxy password: ```char1 defaultpass```
+
 ### Connecting
   * Connect a client to the listen_port above on the host the proxy is running,
       and then login with the password
@@ -80,11 +96,15 @@ optional arguments:
      * 2nd argument = 'this is the second argument'
 """
 import asyncore
+import functools
 import os
+import pickle
 import sys
 import socket
 import time
 from libs.api import API as BASEAPI
+from libs.net.reactor import Reactor, BACKENDS, defaultbackend
+from libs.net.supervisor import Supervisor, ClientReceiver
 import libs.argp as argp
 
 # import io so we can add the "send" functions to the api
@@ -97,9 +117,9 @@ BASEAPI.starttime = time.localtime()
 BASEAPI.loading = True
 
 
-def setuppaths():
+def setuppaths(session=''):
   """
-  setup paths
+  setup paths, a session keeps its data in data/sessions/<session>
   """
   npath = os.path.abspath(__file__)
   index = npath.rfind(os.sep)
@@ -111,9 +131,14 @@ def setuppaths():
 
   API('send.msg')('setting basepath to: %s' % tpath, 'startup')
   BASEAPI.BASEPATH = tpath
+  BASEAPI.SESSION = session
+  if session:
+    BASEAPI.DATAPATH = os.path.join(tpath, 'data', 'sessions', session)
+  else:
+    BASEAPI.DATAPATH = os.path.join(tpath, 'data')
 
   try:
-    os.makedirs(os.path.join(API.BASEPATH, 'data', 'logs'))
+    os.makedirs(os.path.join(API.DATAPATH, 'logs'))
   except OSError:
     pass
 
@@ -122,18 +147,28 @@ class Listener(asyncore.dispatcher):
   """
   This is the class that listens for new clients
   """
-  def __init__(self, listen_port):
+  def __init__(self, listen_port, fd=None):
     """
     init the class
 
     required:
       listen_port - the port to listen on
+    optional:
+      fd          - the file descriptor of a listening socket inherited
+                      from a hot restart
     """
     asyncore.dispatcher.__init__(self)
-    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-    self.set_reuse_addr()
-    self.bind(("", listen_port))
-    self.listen(50)
+    if fd is not None:
+      sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+      os.close(fd)
+      sock.setblocking(0)
+      self.set_socket(sock)
+      self.accepting = True
+    else:
+      self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+      self.set_reuse_addr()
+      self.bind(("", listen_port))
+      self.listen(50)
     self.mud = None
     self.clients = []
     API('send.msg')("Listener bound on: %s" % listen_port, 'startup')
@@ -149,16 +184,20 @@ class Listener(asyncore.dispatcher):
     """
     accept a new client
     """
+    client_connection, source_addr = self.accept()
+    self.addclient(client_connection, source_addr[0], source_addr[1])
+
+  def addclient(self, client_connection, ipaddress, port, data=''):
+    """
+    add a client, data is what the client has already sent
+    """
     if not self.mud:
       from libs.net.mud import Mud
 
       # do proxy stuff here
       self.mud = Mud()
 
-    client_connection, source_addr = self.accept()
-
     try:
-      ipaddress = source_addr[0]
       if API('clients.checkbanned')(ipaddress):
         API('send.msg')("HOST: %s is banned" % ipaddress, 'net')
         client_connection.close()
@@ -168,11 +207,13 @@ class Listener(asyncore.dispatcher):
         client_connection.close()
       else:
         API('send.msg')("Accepted connection from %s : %s" %
-                        (source_addr[0], source_addr[1]), 'net')
+                        (ipaddress, port), 'net')
 
         # client keeps up with itself
         from libs.net.client import Client
-        Client(client_connection, source_addr[0], source_addr[1])
+        client = Client(client_connection, ipaddress, port)
+        if data:
+          client.feed(data)
 
     # catch everything because we don't want to exit if we can't connect a
     # client
@@ -180,37 +221,100 @@ class Listener(asyncore.dispatcher):
       API('send.traceback')('Error handling client')
 
 
-def start(listen_port):
+class SessionChannel(Listener):
+  """
+  This is the class that gets new clients for a session from the supervisor
+  """
+  def __init__(self, fd):  # pylint: disable=super-init-not-called
+    """
+    init the class
+
+    required:
+      fd - the file descriptor of the channel to the supervisor
+    """
+    asyncore.dispatcher.__init__(self)
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_DGRAM)
+    os.close(fd)
+    sock.setblocking(0)
+    self.set_socket(sock)
+    self.connected = True
+    self.receiver = ClientReceiver(sock)
+    self.mud = None
+    self.clients = []
+    API('send.msg')("Session %s waiting for clients" % API.SESSION,
+                    'startup')
+    API('events.eraise')('proxy_ready', calledfrom='listener')
+
+  def writable(self):
+    """
+    nothing is written to the supervisor
+    """
+    return False
+
+  def handle_read(self):
+    """
+    get the clients from the supervisor
+    """
+    for info, client_connection in self.receiver.receive():
+      self.addclient(client_connection, info['host'], info['port'],
+                     info['data'])
+
+
+def start(listen_port, engine=None, state=None, channel=None):
   """
   start the proxy
 
-  we do a single asyncore.loop then we check timers
+  the reactor polls the sockets and raises the global_timer event when
+  a timer is due, engine is the backend the reactor uses
+
+  state is the state of the connections from a hot restart, channel is
+  the file descriptor a session gets its clients on
   """
-  API('managers.add')('listener', Listener(listen_port))
+  reactor = Reactor(backend=engine)
+  if channel is not None:
+    API('managers.add')('listener', SessionChannel(channel))
+  elif state:
+    API('managers.add')('listener', Listener(listen_port, state['listener']))
+  else:
+    API('managers.add')('listener', Listener(listen_port))
+  if state:
+    API('proxy.restore')(state)
 
   try:
-    while True:
+    reactor.run()
+  except KeyboardInterrupt:
+    pass
 
-      asyncore.loop(timeout=.25, count=1)
+  API('send.msg')("reactor loop broken", primary='net')
 
-      if API.shutdown:
-        break
 
-      # check our timer event
-      API('events.eraise')('global_timer', {}, calledfrom="globaltimer")
+def daemonize():
+  """
+  detach from the terminal, returns True in the child process
+  """
+  os.close(0)
+  os.close(1)
+  os.close(2)
+  os.open("/dev/null", os.O_RDONLY)
+  os.open("/dev/null", os.O_RDWR)
+  os.dup(1)
+
+  return os.fork() == 0
 
-  except KeyboardInterrupt:
-    pass
 
-  API('send.msg')("asyncore loop broken", primary='net')
+def runworker(targs, session, channel):
+  """
+  run a session in a process forked by the supervisor
+  """
+  targs = dict(targs, session=session, channel=channel, daemon=False)
+  setuppaths(session)
+  runproxy(targs)
 
 
 def main():
   """
   the main function that runs everything
   """
-  setuppaths()
-
   parser = argp.ArgumentParser(description='A python mud proxy')
   parser.add_argument('-p', "--port",
                       help="the port for the proxy to listen on",
@@ -218,8 +322,46 @@ def main():
   parser.add_argument('-d', "--daemon",
                       help="run in daemon mode",
                       action='store_true')
+  parser.add_argument('-e', "--engine",
+                      help="the event loop backend to use",
+                      choices=BACKENDS,
+                      default=defaultbackend())
+  parser.add_argument('-r', "--restore",
+                      help="the state file from a hot restart, used by " \
+                            "#bp.proxy.restart",
+                      default=None)
+  parser.add_argument('-s', "--sessions",
+                      help="run a session for each name in a comma " \
+                            "separated list, clients pick one when they connect",
+                      default=None)
+  parser.add_argument("--session",
+                      help=argp.SUPPRESS,
+                      default='')
+  parser.add_argument("--channel",
+                      help=argp.SUPPRESS,
+                      type=int,
+                      default=None)
   targs = vars(parser.parse_args())
 
+  if targs['sessions']:
+    setuppaths()
+    if targs['daemon'] and not daemonize():
+      return
+    supervisor = Supervisor(int(targs['port']),
+                            [i.strip() for i in targs['sessions'].split(',')
+                             if i.strip()],
+                            functools.partial(runworker, targs),
+                            API.BASEPATH)
+    supervisor.run()
+  else:
+    setuppaths(targs['session'])
+    runproxy(targs)
+
+
+def runproxy(targs):
+  """
+  load the plugins and run the proxy
+  """
   daemon = bool(targs['daemon'])
 
   API('send.msg')('Plugin Manager - loading', 'startup')
@@ -235,35 +377,33 @@ def main():
 
   proxyp = API('plugins.getp')('proxy')
 
-  if targs['port'] != 9999:
+  if targs['port'] != 9999 and not targs['session']:
     proxyp.api('setting.change')('listenport', targs['port'])
 
   listen_port = proxyp.api('setting.gets')('listenport')
 
+  state = None
+  if targs['restore']:
+    with open(targs['restore'], 'rb') as fileobj:
+      state = pickle.load(fileobj)
+    os.remove(targs['restore'])
+
   BASEAPI.loading = False
   if not daemon:
     try:
-      start(listen_port)
+      start(listen_port, targs['engine'], state, targs['channel'])
     except KeyboardInterrupt:
       pass
 
     API('proxy.shutdown')()
 
-  else:
-    os.close(0)
-    os.close(1)
-    os.close(2)
-    os.open("/dev/null", os.O_RDONLY)
-    os.open("/dev/null", os.O_RDWR)
-    os.dup(1)
-
-    if os.fork() == 0:
-      # We are the child
-      try:
-        sys.exit(start(listen_port))
-      except KeyboardInterrupt:
-        pass
-      sys.exit(0)
+  elif daemonize():
+    # We are the child
+    try:
+      sys.exit(start(listen_port, targs['engine']))
+    except KeyboardInterrupt:
+      pass
+    sys.exit(0)
 
   API('send.msg')("exiting main function", primary='net')
 
@@ -10,11 +10,27 @@ or there are multiple instances of a class that will add the
 same function to the api.
 
 See the BasePlugin class
+
+Code that calls the same api function often can get a handle for it with
+api.handle('toplevel.name'). A handle looks the function up the first time
+it is called and keeps it until the api changes (api.add, api.overload,
+api.remove, which also happen when a plugin is loaded or unloaded), then
+looks it up again. Each handle counts how many times it was called.
+
+api.timing turns on stats for the api: functions returned by api() and
+handles are wrapped to count their calls and time them, the times go into
+histograms with 4 buckets for each power of 2 microseconds. api.stats
+returns them.
+
+api.capturestack returns a CallStack that only keeps the file, line and
+function of each frame, the source lines are read when it is formatted.
 """
 from __future__ import print_function
 import inspect
+import linecache
 import sys
-import traceback
+import thread
+from timeit import default_timer
 
 def getargs(apif):
   """
@@ -35,6 +51,171 @@ def getargs(apif):
 
   return args
 
+class APIHandle(object):
+  """
+  a handle for an api function that caches the function until the api
+  changes
+  """
+  __slots__ = ['api', 'apiname', 'func', 'generation', 'calls']
+
+  def __init__(self, api, apiname):
+    """
+    initialize the class
+    """
+    self.api = api
+    self.apiname = apiname
+    self.func = None
+    self.generation = -1
+    self.calls = 0
+
+  def resolve(self):
+    """
+    return the function, looking it up again if the api has changed,
+    None if it is not in the api
+    """
+    if self.generation != API.generation:
+      self.func = self.api.find(self.apiname)
+      if self.func is not None and API.stats is not None:
+        self.func = self.api.timed(self.apiname, self.func)
+      self.generation = API.generation
+    return self.func
+
+  def has(self):
+    """
+    see if the function is in the api
+    """
+    return self.resolve() is not None
+
+  def __call__(self, *args, **kwargs):
+    """
+    call the function
+    """
+    self.calls = self.calls + 1
+    if self.generation != API.generation:
+      self.resolve()
+    if self.func is None:
+      raise AttributeError('%s is not in the api' % self.apiname)
+    return self.func(*args, **kwargs)
+
+  def __repr__(self):
+    """
+    show the api name and the number of calls
+    """
+    return '<APIHandle %s calls=%s>' % (self.apiname, self.calls)
+
+def bucket(usec):
+  """
+  return the histogram bucket for a time in microseconds, there are 4
+  buckets for each power of 2
+  """
+  if usec < 4:
+    return usec
+  exp = usec.bit_length() - 3
+  return (exp << 2) + (usec >> exp)
+
+def bucketstart(index):
+  """
+  return the lowest time in microseconds that goes in a bucket
+  """
+  if index < 4:
+    return index
+  return ((index & 3) + 4) << ((index >> 2) - 1)
+
+class APIStat(object):
+  """
+  the number of calls and a histogram of the times for an api function
+  """
+  __slots__ = ['apiname', 'calls', 'total', 'max', 'histogram']
+
+  def __init__(self, apiname):
+    """
+    initialize the class
+    """
+    self.apiname = apiname
+    self.calls = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.histogram = {}
+
+  def record(self, elapsed):
+    """
+    add a call that took elapsed seconds
+    """
+    if elapsed < 0:
+      # the clock was changed
+      elapsed = 0.0
+    self.calls = self.calls + 1
+    self.total = self.total + elapsed
+    if elapsed > self.max:
+      self.max = elapsed
+    index = bucket(int(elapsed * 1000000))
+    self.histogram[index] = self.histogram.get(index, 0) + 1
+
+  def percentile(self, pct):
+    """
+    return the time in microseconds that pct percent of the calls were
+    under, to the end of the bucket but not over the longest call
+    """
+    needed = self.calls * pct / 100.0
+    count = 0
+    for index in sorted(self.histogram):
+      count = count + self.histogram[index]
+      if count >= needed:
+        return min(bucketstart(index + 1), int(self.max * 1000000) + 1)
+    return 0
+
+class CallStack(object):
+  """
+  the call stacks of all threads, kept as (filename, line, function)
+  tuples and formatted when they are needed
+  """
+  __slots__ = ['stacks']
+
+  def __init__(self, stacks):
+    """
+    initialize the class
+
+    stacks is a list with a list of tuples for each thread
+    """
+    self.stacks = stacks
+
+  def format(self, ignores=None):
+    """
+    return the stack as lines in the format of traceback.format_stack
+    """
+    if ignores is None:
+      ignores = []
+    callstack = []
+
+    for stack in self.stacks:
+      for filename, lineno, name in stack:
+        item = '  File "%s", line %d, in %s\n' % (filename, lineno, name)
+        line = linecache.getline(filename, lineno)
+        if line:
+          item = item + '    %s\n' % line.strip()
+        if True in [tstr in item for tstr in ignores]:
+          continue
+        for tline in item.split('\n'):
+          if tline:
+            if API.BASEPATH:
+              tline = tline.replace(API.BASEPATH + "/", "")
+            callstack.append(tline.rstrip())
+
+    return callstack
+
+def extractstack(frame):
+  """
+  return a list of (filename, line, function) for frame and its callers,
+  the outermost call first
+  """
+  stack = []
+  while frame is not None:
+    code = frame.f_code
+    stack.append((code.co_filename, frame.f_lineno, code.co_name))
+    frame = frame.f_back
+  stack.reverse()
+  return stack
+
 class API(object):
   """
   A class that exports an api for plugins and modules to use
@@ -42,10 +223,32 @@ class API(object):
   # where the main api resides
   api = {}
 
+  # changed when a function is added to, overloaded in or removed from
+  # the api, handles look their function up again when it changes
+  generation = 0
+
+  # code objects and whether they have a self variable, used to find the
+  # plugins in the call stack, cleared when the api changes
+  selfcodes = {}
+  selfcodesgeneration = 0
+
+  # APIStat for each api function when api.timing is on, otherwise None
+  stats = None
+
+  # the wrappers that time api functions
+  timedfuncs = {}
+
   # the basepath that the proxy was run from, will be dynamically set in
   # bastproxy.py
   BASEPATH = ''
 
+  # the directory for data (settings, logs, databases), BASEPATH/data or
+  # a directory for each session when the proxy runs more than one session
+  DATAPATH = ''
+
+  # the name of the session, '' if the proxy runs one session
+  SESSION = ''
+
   # a flag to show that bastproxy is loading
   loading = False
 
@@ -64,6 +267,9 @@ class API(object):
     # apis that have been overloaded will be put here
     self.overloadedapi = {}
 
+    # handles that have been made with this instance
+    self.handles = {}
+
     # the format for the time
     self.timestring = '%a %b %d %Y %H:%M:%S'
 
@@ -96,6 +302,12 @@ class API(object):
       self('api.add')('api', 'pluginstack', self.api_pluginstack)
     if not self('api.has')('api.callstack'):
       self('api.add')('api', 'callstack', self.api_callstack)
+    if not self('api.has')('api.capturestack'):
+      self('api.add')('api', 'capturestack', self.api_capturestack)
+    if not self('api.has')('api.timing'):
+      self('api.add')('api', 'timing', self.api_timing)
+    if not self('api.has')('api.stats'):
+      self('api.add')('api', 'stats', self.api_stats)
 
 
   def api_callstack(self, ignores=None):
@@ -113,22 +325,57 @@ class API(object):
      "    'convertansi':tconvertansi})", '
     """
     # pylint: enable=line-too-long
-    if ignores is None:
-      ignores = []
-    callstack = []
+    return self.capturestack(sys._getframe(1)).format(ignores) # pylint: disable=protected-access
 
-    for _, frame in sys._current_frames().items(): # pylint: disable=protected-access
-      for i in traceback.format_stack(frame)[:-1]:
-        if True in [tstr in i for tstr in ignores]:
-          continue
-        tlist = i.split('\n')
-        for tline in tlist:
-          if tline:
-            if self.BASEPATH:
-              tline = tline.replace(self.BASEPATH + "/", "")
-            callstack.append(tline.rstrip())
+  # capture the call stack to format later
+  def api_capturestack(self):
+    """
+    return a CallStack for all threads, it is formatted with its format
+    method
+    """
+    return self.capturestack(sys._getframe(1)) # pylint: disable=protected-access
 
-    return callstack
+  def capturestack(self, frame):
+    """
+    capture the stacks of all threads, the current thread starts at frame
+    """
+    stacks = []
+    current = thread.get_ident()
+    for ident, tframe in sys._current_frames().items(): # pylint: disable=protected-access
+      if ident == current:
+        stacks.append(extractstack(frame))
+      else:
+        # the innermost frame is left out, as api.callstack always did
+        stacks.append(extractstack(tframe)[:-1])
+
+    return CallStack(stacks)
+
+  def _frameselves(self, frame):
+    """
+    yield the self of each frame that is running a method, starting at
+    frame and going to the callers
+    """
+    if API.selfcodesgeneration != API.generation:
+      # plugins have been loaded or unloaded, drop their code objects
+      API.selfcodes.clear()
+      API.selfcodesgeneration = API.generation
+    selfcodes = API.selfcodes
+
+    while frame is not None:
+      code = frame.f_code
+      hasself = selfcodes.get(code)
+      if hasself is None:
+        # module and class bodies keep their names in a dictionary
+        hasself = not code.co_flags & inspect.CO_OPTIMIZED \
+                    or 'self' in code.co_varnames \
+                    or 'self' in code.co_cellvars \
+                    or 'self' in code.co_freevars
+        selfcodes[code] = hasself
+      if hasself:
+        flocals = frame.f_locals
+        if 'self' in flocals:
+          yield flocals['self']
+      frame = frame.f_back
 
   def api_pluginstack(self, skipplugin=None):
     """
@@ -139,30 +386,19 @@ class API(object):
     if not skipplugin:
       skipplugin = []
 
-    try:
-      stack = inspect.stack()
-    except IndexError:
-      return None
-
     plugins = []
 
-    for ifr in stack[1:]:
-      parentframe = ifr[0]
-
-      if 'self' in parentframe.f_locals:
-        # I don't know any way to detect call from the object method
-        # TODO: there seems to be no way to detect static method call - it will
-        #      be just a function call
-        tcs = parentframe.f_locals['self']
-        if tcs != self and isinstance(tcs, BasePlugin) and tcs.sname not in skipplugin:
-          if tcs.sname not in plugins:
-            plugins.append(tcs.sname)
-        if hasattr(tcs, 'plugin') and isinstance(tcs.plugin, BasePlugin) \
-                and tcs.plugin.sname not in skipplugin:
-          if tcs.plugin.sname not in plugins:
-            plugins.append(tcs.plugin.sname)
-
-    del stack
+    for tcs in self._frameselves(sys._getframe(1)): # pylint: disable=protected-access
+      # I don't know any way to detect call from the object method
+      # TODO: there seems to be no way to detect static method call - it will
+      #      be just a function call
+      if tcs != self and isinstance(tcs, BasePlugin) and tcs.sname not in skipplugin:
+        if tcs.sname not in plugins:
+          plugins.append(tcs.sname)
+      if hasattr(tcs, 'plugin') and isinstance(tcs.plugin, BasePlugin) \
+              and tcs.plugin.sname not in skipplugin:
+        if tcs.plugin.sname not in plugins:
+          plugins.append(tcs.plugin.sname)
 
     if 'plugins' in plugins:
       del plugins[plugins.index('plugins')]
@@ -184,26 +420,16 @@ class API(object):
     if not skipplugin:
       skipplugin = []
 
-    try:
-      stack = inspect.stack()
-    except IndexError:
-      return None
-
-    for ifr in stack[1:]:
-      parentframe = ifr[0]
-
-      if 'self' in parentframe.f_locals:
-        # I don't know any way to detect call from the object method
-        # TODO: there seems to be no way to detect static method call - it will
-        #      be just a function call
-        tcs = parentframe.f_locals['self']
-        if tcs != self and isinstance(tcs, BasePlugin) and tcs.sname not in skipplugin:
-          return tcs.sname
-        if hasattr(tcs, 'plugin') and isinstance(tcs.plugin, BasePlugin) \
-                and tcs.plugin.sname not in skipplugin:
-          return tcs.plugin.sname
-
-    del stack
+    for tcs in self._frameselves(sys._getframe(1)): # pylint: disable=protected-access
+      # I don't know any way to detect call from the object method
+      # TODO: there seems to be no way to detect static method call - it will
+      #      be just a function call
+      if tcs != self and isinstance(tcs, BasePlugin) and tcs.sname not in skipplugin:
+        return tcs.sname
+      if hasattr(tcs, 'plugin') and isinstance(tcs.plugin, BasePlugin) \
+              and tcs.plugin.sname not in skipplugin:
+        return tcs.plugin.sname
+
     return None
 
   # add a function to the api
@@ -223,6 +449,7 @@ class API(object):
       self.get('send.error')('api.add - %s already exists' % fullapi)
 
     self.__class__.api[fullapi] = function
+    API.generation = API.generation + 1
 
   # overload a function in the api
   def overload(self, toplevel, name, function):
@@ -245,6 +472,7 @@ class API(object):
       self.get('send.error')('api.overload - %s already exists' % fullapi)
 
     self.overloadedapi[fullapi] = function
+    API.generation = API.generation + 1
 
   # get a manager
   def getmanager(self, name):
@@ -284,22 +512,93 @@ class API(object):
       if testfor in i:
         del self.overloadedapi[i]
 
+    API.generation = API.generation + 1
+
+  def find(self, apiname, nooverload=False):
+    """
+    find an api function, returns None if it is not in the api
+    """
+    func = None
+    if not nooverload:
+      func = self.overloadedapi.get(apiname)
+    if func is None:
+      func = self.api.get(apiname)
+    return func
+
   def get(self, apiname, nooverload=False):
     """
     get an api function
     """
-    if not nooverload:
-      try:
-        return self.overloadedapi[apiname]
-      except KeyError:
-        pass
+    func = self.find(apiname, nooverload)
+    if func is None:
+      raise AttributeError('%s is not in the api' % apiname)
 
-    try:
-      return self.api[apiname]
-    except KeyError:
-      pass
+    if API.stats is not None:
+      return self.timed(apiname, func)
 
-    raise AttributeError('%s is not in the api' % apiname)
+    return func
+
+  def timed(self, apiname, func):
+    """
+    return a wrapper for an api function that adds its calls to the stats
+    """
+    key = (apiname, func)
+    wrapper = API.timedfuncs.get(key)
+    if wrapper is None:
+      if apiname not in API.stats:
+        API.stats[apiname] = APIStat(apiname)
+      stat = API.stats[apiname]
+
+      def wrapper(*args, **kwargs):
+        """
+        time the function
+        """
+        start = default_timer()
+        try:
+          return func(*args, **kwargs)
+        finally:
+          stat.record(default_timer() - start)
+
+      wrapper.__doc__ = func.__doc__
+      API.timedfuncs[key] = wrapper
+
+    return wrapper
+
+  # turn the stats for api functions on or off
+  def api_timing(self, flag=None):
+    """  turn the stats for api functions on or off
+    @Yflag@w  = True to turn them on, False to turn them off, toggle if
+                  not given
+
+    this function returns True if the stats are on"""
+    if flag is None:
+      flag = API.stats is None
+
+    if flag and API.stats is None:
+      API.stats = {}
+    elif not flag and API.stats is not None:
+      API.stats = None
+      API.timedfuncs.clear()
+
+    # handles look their function up again to get or drop the wrappers
+    API.generation = API.generation + 1
+    return API.stats is not None
+
+  # return the stats for api functions
+  def api_stats(self, reset=False):
+    """  return the stats for api functions
+    @Yreset@w  = clear the stats after returning them
+
+    this function returns a list of APIStat, the most total time first"""
+    if API.stats is None:
+      return []
+
+    stats = sorted(API.stats.values(), key=lambda x: x.total, reverse=True)
+    if reset:
+      API.stats.clear()
+      API.timedfuncs.clear()
+      API.generation = API.generation + 1
+    return stats
 
   __call__ = get
 
@@ -328,11 +627,16 @@ class API(object):
     """
     see if something exists in the api
     """
-    try:
-      self.get(apiname)
-      return True
-    except AttributeError:
-      return False
+    return self.find(apiname) is not None
+
+  def handle(self, apiname):
+    """
+    return a handle for an api function, the handle uses the overloaded
+    functions of this instance
+    """
+    if apiname not in self.handles:
+      self.handles[apiname] = APIHandle(self, apiname)
+    return self.handles[apiname]
 
   # get the details for an api function
   def api_detail(self, apiname):
@@ -350,15 +654,8 @@ class API(object):
     if apiname:
       name, cmdname = apiname.split('.')
       tdict = {'name':name, 'cmdname':cmdname, 'apiname':apiname}
-      try:
-        apia = self.get(apiname, nooverload=True)
-      except AttributeError:
-        pass
-
-      try:
-        apio = self.get(apiname)
-      except AttributeError:
-        pass
+      apia = self.find(apiname, nooverload=True)
+      apio = self.find(apiname)
 
       if not apia and not apio:
         tmsg.append('%s is not in the api' % apiname)
@@ -454,7 +751,7 @@ class API(object):
       if toplevel not in toplevels:
         toplevels.append(toplevel)
         tmsg.append('@G%-10s@w' % toplevel)
-      apif = self.get(i)
+      apif = self.find(i)
       comments = inspect.getcomments(apif)
       if comments:
         comments = comments.strip()
@@ -495,6 +792,16 @@ def test():
   print('dict api.api', api.api)
   print('dict api.overloadapi', api.overloadedapi)
 
+  thandle = api.handle('test.three')
+  print('handle test.three has', thandle.has())
+  api.add('test', 'three', testapi)
+  print('handle test.three', thandle('called test.three'), thandle)
+  api.remove('test')
+  print('handle test.three has after remove', thandle.has())
+  api.add('test', 'api', testapi)
+  api.add('test', 'over', testapi)
+  api.add('test', 'some.api', testapi)
+
   print('\n'.join(api.api_list(toplevel="test")))
   print('--------------------')
   print('\n'.join(api.api_list()))
@@ -1,12 +1,32 @@
 """
 handle output and input functions, adds items under the send api
+
+send.msg drops a message without passing it to the log plugin when none
+of its tags are in log.wanted, the datatypes that go to the clients, the
+console or a file. send.msgf takes a format and its arguments and only
+formats the message when it is not dropped.
+
+send.execute splits a command into a queue of commands and passes them
+through io_execute_event one at a time, a command that an event function
+changes into more commands (an alias, a speedwalk) puts them at the front
+of the queue. The commands for the mud are collected and sent in one
+to_mud_event when the outermost send.execute finishes, so commands that
+functions execute while it runs (loop) go in the same write. send.mud
+sends the collected commands first to keep the order.
+
+send.client with hold=True keeps the text to send it with the texts held
+after it in one to_client_event, joined with \r\n. Held texts are sent
+by send.flushclient or before any other text is sent to the clients, so
+the clients get everything in the order it was sent.
 """
 from __future__ import print_function
+import collections
 import time
 import sys
 import traceback
 import re
 from libs.api import API
+from libs.records import CommandTrace
 
 class ProxyIO(object):  # pylint: disable=too-few-public-methods
   """
@@ -14,9 +34,12 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
     APIs for this class
      'send.msg'       : send data through the messaging system for
                           logging purposes
+     'send.msgf'      : send.msg with a format and arguments, only
+                          formatted if the message is logged
      'send.error'     : send an error
      'send.traceback' : send a traceback
      'send.client'    : send data to the clients
+     'send.flushclient' : send the data held by send.client
      'send.mud'       : send data to the mud
      'send.execute'   : send data through the parser
   """
@@ -26,10 +49,27 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
     """
     self.currenttrace = None
     self.api = API()
+    self.splitre = re.compile(self.api.splitre)
+
+    # the depth of send.execute calls and the commands for the mud that
+    # are sent when the outermost one finishes
+    self.executedepth = 0
+    self.mudbatch = []
+    self.showinhistory = True
+
+    # the texts held by send.client and its raw, dtype and client
+    self.heldclient = []
+    self.heldargs = None
+
+    self.raiseevent = self.api.handle('events.eraise')
+    self.logwanted = self.api.handle('log.wanted')
+    self.logmsg = self.api.handle('log.msg')
     self.api('api.add')('send', 'msg', self._api_msg)
+    self.api('api.add')('send', 'msgf', self._api_msgf)
     self.api('api.add')('send', 'error', self._api_error)
     self.api('api.add')('send', 'traceback', self._api_traceback)
     self.api('api.add')('send', 'client', self._api_client)
+    self.api('api.add')('send', 'flushclient', self._api_flushclient)
     self.api('api.add')('send', 'mud', self._api_tomud)
     self.api('api.add')('send', 'execute', self._api_execute)
     self.api('managers.add')('io', self)
@@ -45,15 +85,55 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
     If a plugin called this function, it will be automatically added to the tags
 
     this function returns no values"""
-    tags = []
-    plugin = self.api('api.callerplugin')()
+    self.sendmsg(tmsg, None, primary, secondary)
+
+  # send a message that is formatted only if it is logged
+  def _api_msgf(self, fmt, *args, **kwargs):
+    """  send a message through the log plugin, formatted only if it is logged
+      @Yfmt@w        = the format of the message
+      @Yargs@w       = the arguments for the format
+      @Yprimary@w    = the primary data tag of the message (default: None)
+      @Ysecondary@w  = the secondary data tag of the message
+                          (default: None)
+
+    If a plugin called this function, it will be automatically added to the tags
 
-    tags.extend(self.api('api.pluginstack')())
+    this function returns no values"""
+    self.sendmsg(fmt, args, kwargs.get('primary'), kwargs.get('secondary'))
 
+  def sendmsg(self, tmsg, fmtargs, primary, secondary):
+    """
+    send a message to the log plugin if it has a tag that is logged,
+    tmsg is formatted with fmtargs if they are given
+    """
+    tags = []
     if not isinstance(secondary, list):
       tags.append(secondary)
     else:
       tags.extend(secondary)
+    if primary:
+      tags.append(primary)
+
+    # the explicit tags are checked first, walking the call stack for
+    # plugins costs more
+    wanted = self.logwanted() if self.logwanted.has() else None
+    kept = wanted is None or 'plugins' in wanted \
+              or wanted.intersection(tags)
+    if not kept and tags and not wanted:
+      return
+
+    # the caller plugin is in the stack, or it is the plugin manager,
+    # which is left out of the stack
+    stack = self.api('api.pluginstack')()
+    if not kept and (tags or stack) and not wanted.intersection(stack):
+      return
+
+    if fmtargs:
+      tmsg = tmsg % fmtargs
+
+    plugin = self.api('api.callerplugin')()
+
+    tags.extend(stack)
 
     ttags = set(tags) # take out duplicates
     tags = list(ttags)
@@ -76,7 +156,7 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
       print('Did not get any tags for %s' % tmsg)
 
     try:
-      self.api('log.msg')(tmsg, tags=tags)
+      self.logmsg(tmsg, tags=tags)
     except (AttributeError, RuntimeError): #%s - %-10s :
       print('%s - %-10s : %s' % (time.strftime(self.api.timestring,
                                                time.localtime()),
@@ -126,12 +206,14 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
       pass
 
   # send text to the clients
-  def _api_client(self, text, raw=False, preamble=True, dtype='fromproxy', client=None):  # pylint: disable=too-many-arguments
+  def _api_client(self, text, raw=False, preamble=True, dtype='fromproxy', client=None, hold=False):  # pylint: disable=too-many-arguments
     """  handle a traceback
       @Ytext@w      = The text to send to the clients
       @Yraw@w       = if True, don't convert colors or add the preamble
       @Ypreamble@w  = if True, send the preamble, defaults to True
       @Ydtype@w     = datatype, defaults to "fromproxy"
+      @Yhold@w      = if True, hold the text to send it with the next
+                        held texts, see send.flushclient
 
     this function returns no values"""
 
@@ -151,6 +233,36 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
       text = test
       text = "\n".join(text)
 
+    if hold:
+      if self.heldclient and self.heldargs != (raw, dtype, client):
+        self._api_flushclient()
+      self.heldargs = (raw, dtype, client)
+      self.heldclient.append(text)
+      return
+
+    if self.heldclient:
+      self._api_flushclient()
+
+    self.clientevent(text, raw, dtype, client)
+
+  # send the data held by send.client
+  def _api_flushclient(self):
+    """  send the texts held by send.client to the clients in one write
+
+    this function returns no values"""
+    if not self.heldclient:
+      return
+
+    text = '\r\n'.join(self.heldclient)
+    raw, dtype, client = self.heldargs
+    self.heldclient = []
+    self.heldargs = None
+    self.clientevent(text, raw, dtype, client)
+
+  def clientevent(self, text, raw, dtype, client):
+    """
+    raise to_client_event for text
+    """
     try:
       self.api('events.eraise')('to_client_event', {'original':text,
                                                     'raw':raw, 'dtype':dtype,
@@ -167,90 +279,113 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
       @Ycommand@w      = the command to send through the interpreter
 
     this function returns no values"""
-    self.api('send.msg')('execute: got command %s' % repr(command),
-                         primary='inputparse')
+    self.api('send.msgf')('execute: got command %r', command,
+                          primary='inputparse')
 
     newtrace = False
     if not self.currenttrace:
       newtrace = True
-      self.currenttrace = {}
-      self.currenttrace['fromclient'] = False
-      self.currenttrace['internal'] = True
-      self.currenttrace['changes'] = []
-      self.currenttrace['showinhistory'] = showinhistory
-      self.currenttrace['addedtohistory'] = False
-      self.currenttrace['originalcommand'] = command.strip()
-      self.currenttrace['fromplugin'] = self.api('api.callerplugin')()
-
-      if fromclient:
-        self.currenttrace['fromclient'] = True
-        self.currenttrace['internal'] = False
-
-      self.api('events.eraise')('io_execute_trace_started', self.currenttrace,
-                                calledfrom="io")
+      self.currenttrace = CommandTrace(command.strip(), fromclient,
+                                       showinhistory,
+                                       self.api('api.callerplugin')())
 
-    if command == '\r\n':
-      self.api('send.msg')('sending %s (cr) to the mud' % repr(command),
-                           primary='inputparse')
-      self.api('events.eraise')('to_mud_event', {'data':command,
-                                                 'dtype':'fromclient',
-                                                 'showinhistory':showinhistory,
-                                                 'trace':self.currenttrace},
-                                calledfrom="io")
-    else:
+      self.raiseevent('io_execute_trace_started', self.currenttrace,
+                      calledfrom="io")
 
-      command = command.strip()
-
-      commands = command.split('\r\n')
-      if len(commands) > 1:
-        self.currenttrace['changes'].append({'flag':'Splitcr',
-                                             'data':'split command: "%s" into: "%s"' % \
-                                              (command, ", ".join(commands)),
-                                             'plugin':'io'})
-
-      for tcommand in commands:
-        newdata = self.api('events.eraise')('io_execute_event',
-                                            {'fromdata':tcommand,
-                                             'fromclient':fromclient,
-                                             'internal':not fromclient,
-                                             'showinhistory':showinhistory,
-                                             'trace':self.currenttrace},
-                                            calledfrom="io")
-
-        if 'fromdata' in newdata:
-          tcommand = newdata['fromdata']
-          tcommand = tcommand.strip()
-
-        if tcommand:
-          datalist = re.split(self.api.splitre, tcommand)
-          if len(datalist) > 1:
-            self.api('send.msg')('broke %s into %s' % (tcommand, datalist),
-                                 primary='inputparse')
-            self.currenttrace['changes'].append(
-                {'flag':'Splitchar',
-                 'data':'split command: "%s" into: "%s"' % \
-                   (tcommand, ", ".join(datalist)),
-                 'plugin':'io'})
-            for cmd in datalist:
-              self.api('send.execute')(cmd, showinhistory=showinhistory)
-          else:
-            tcommand = tcommand.replace('||', '|')
-            if tcommand[-1] != '\n':
-              tcommand = "".join([tcommand, '\n'])
-            self.api('send.msg')('sending %s to the mud' % tcommand.strip(),
-                                 primary='inputparse')
-            self.api('events.eraise')('to_mud_event',
-                                      {'data':tcommand,
-                                       'dtype':'fromclient',
-                                       'showinhistory':showinhistory,
-                                       'trace':self.currenttrace},
-                                      calledfrom="io")
+    if not self.executedepth:
+      self.showinhistory = showinhistory
+    self.executedepth = self.executedepth + 1
+    try:
+      self.parse(command, fromclient, showinhistory)
+    finally:
+      self.executedepth = self.executedepth - 1
+      if not self.executedepth:
+        self.flushmud()
 
     if newtrace:
-      self.api('events.eraise')('io_execute_trace_finished', self.currenttrace,
-                                calledfrom="io")
+      self.raiseevent('io_execute_trace_finished', self.currenttrace,
+                      calledfrom="io")
       self.currenttrace = None
 
+  def parse(self, command, fromclient, showinhistory):
+    """
+    split a command into commands, pass each one through io_execute_event
+    and add the ones for the mud to the batch
+
+    the queue has (True, data, fromclient) for data that still has to be
+    split on newlines and (False, command, fromclient) for a single
+    command, the parts of a command split on the command separator are
+    not from the client, as when they were executed with send.execute
+    """
+    queue = collections.deque([(True, command, fromclient)])
+    while queue:
+      unsplit, command, fromclient = queue.popleft()
+
+      if unsplit:
+        if command == '\r\n':
+          self.api('send.msgf')('sending %r (cr) to the mud', command,
+                                primary='inputparse')
+          self.mudbatch.append(command)
+          continue
+
+        command = command.strip()
+        commands = command.split('\r\n')
+        if len(commands) > 1 and self.currenttrace.recording:
+          self.currenttrace.add('Splitcr', 'io',
+                                'split command: "%s" into: "%s"',
+                                command, ", ".join(commands))
+        queue.extendleft([(False, tcommand, fromclient)
+                          for tcommand in reversed(commands)])
+        continue
+
+      newdata = self.raiseevent('io_execute_event',
+                                {'fromdata':command,
+                                 'fromclient':fromclient,
+                                 'internal':not fromclient,
+                                 'showinhistory':showinhistory,
+                                 'trace':self.currenttrace},
+                                calledfrom="io")
+
+      if 'fromdata' in newdata:
+        command = newdata['fromdata']
+        command = command.strip()
+
+      if not command:
+        continue
+
+      datalist = self.splitre.split(command)
+      if len(datalist) > 1:
+        self.api('send.msgf')('broke %s into %s', command, datalist,
+                              primary='inputparse')
+        if self.currenttrace.recording:
+          self.currenttrace.add('Splitchar', 'io',
+                                'split command: "%s" into: "%s"',
+                                command, ", ".join(datalist))
+        queue.extendleft([(True, cmd, False) for cmd in reversed(datalist)])
+      else:
+        command = command.replace('||', '|')
+        if command[-1] != '\n':
+          command = "".join([command, '\n'])
+        self.api('send.msgf')('sending %s to the mud', command.strip(),
+                              primary='inputparse')
+        self.mudbatch.append(command)
+
+  def flushmud(self):
+    """
+    send the commands collected by send.execute to the mud in one write
+    """
+    if not self.mudbatch:
+      return
+
+    data = "".join(self.mudbatch)
+    self.mudbatch = []
+    self.raiseevent('to_mud_event',
+                    {'data':data,
+                     'dtype':'fromclient',
+                     'showinhistory':self.showinhistory,
+                     'trace':self.currenttrace},
+                    calledfrom="io")
+
   # send data directly to the mud
   def _api_tomud(self, data, raw=False, dtype='fromclient'):
     """ send data directly to the mud
@@ -263,9 +398,12 @@ class ProxyIO(object):  # pylint: disable=too-few-public-methods
     this function returns no values
     """
 
+    # commands from send.execute go first
+    self.flushmud()
+
     if not raw and data and data[-1] != '\n':
       data = "".join([data, '\n'])
-    self.api('events.eraise')('to_mud_event',
+    self.raiseevent('to_mud_event',
                               {'data':data,
                                'dtype':dtype,
                                'raw':raw},
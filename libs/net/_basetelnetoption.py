@@ -32,6 +32,33 @@ class BaseTelnetOption(object):
     self.telnetobj.msg('handleopt for option: %s, command: %s, sbdata: %s' % \
                         (ord(self.option), command, sbdata), mtype='option')
 
+  def handoffready(self):
+    """
+    check if the option can be handed to a new process for a hot
+    restart, an option that can't be handed over in its current state
+    gets ready and returns False until it is
+    """
+    return True
+
+  def cancelhandoff(self):
+    """
+    a hot restart was cancelled, undo what handoffready did
+    """
+    pass
+
+  def getstate(self):
+    """
+    return the state of the option for a hot restart, None if there
+    is nothing to restore
+    """
+    return None
+
+  def setstate(self, state): # pylint: disable=unused-argument
+    """
+    restore the state from getstate in the new process
+    """
+    pass
+
   def reset(self, onclose=False): # pylint: disable=unused-argument
     """
     reset and option
@@ -2,30 +2,68 @@
 $Id$
 
 this module holds the proxy client class
+
+A client that does not keep up with its output is held to watermarks
+on its output: once the buffer and the output added in the current pass
+of the event loop are over the high watermark, new output goes to a
+backlog that is released when the buffer drains to the low watermark.
+If the backlog grows past the high watermark too, the policy decides
+what happens:
+  drop       - the oldest output in the backlog is thrown away
+  skip       - the same, and the client is told how many lines it missed
+  disconnect - the client is disconnected
+
+Closing a client never blocks, what is left in the buffer is sent by
+the event loop for up to CLOSETIMEOUT seconds. A closing client is not
+read from.
+
+A client created with a state from getstate is a connection handed over
+by a hot restart, it is not asked for the password again.
 """
+from collections import deque
 import time
 
-from libs.net.telnetlib import Telnet
+from libs.net.telnetlib import Telnet, IAC, GA
 
 PASSWORD = 0
 CONNECTED = 1
 CLOSING = 2
 
+# the default output buffer watermarks in bytes and slow client policy,
+# the clients plugin sets them from its settings
+HIGHWATER = 512 * 1024
+LOWWATER = 128 * 1024
+POLICIES = ['drop', 'skip', 'disconnect']
+
+# the seconds a closing client has to take what is left in its buffer
+CLOSETIMEOUT = 5
+
 class Client(Telnet):
   """
   a class to hand a proxy client
   """
-  def __init__(self, sock, host, port):
+  def __init__(self, sock, host, port, state=None):
     """
     init the class
+
+    state is the state of a client from before a hot restart
     """
     Telnet.__init__(self, host=host, port=port, sock=sock)
 
     self.ttype = 'Client'
+    self.state = PASSWORD
     self.connectedtime = None
     self.pwtries = 0
     self.banned = False
     self.viewonly = False
+    self.backlog = deque()
+    self.backlogsize = 0
+    self.skipped = 0
+    self.droppedlines = 0
+    self.policy = 'skip'
+    self.aborting = False
+    self.closehandle = None
+    self.setbackpressure(HIGHWATER, LOWWATER, 'skip')
 
     if sock:
       self.connected = True
@@ -34,12 +72,15 @@ class Client(Telnet):
     self.api('events.register')('to_client_event',
                                 self.addtooutbufferevent, prio=99)
 
+    self.restoring = state is not None
     self.api('options.prepareclient')(self)
 
-    self.state = PASSWORD
-    self.addtooutbufferevent({'original':self.api('colors.convertcolors')(
-        '@R#BP@w: @RPlease enter the proxy password:@w'),
-                              'dtype':'passwd'})
+    if state:
+      self.setstate(state)
+    else:
+      self.addtooutbufferevent({'original':self.api('colors.convertcolors')(
+          '@R#BP@w: @RPlease enter the proxy password:@w'),
+                                'dtype':'passwd'})
 
   def addtooutbufferevent(self, args):
     """
@@ -61,24 +102,129 @@ class Client(Telnet):
       if (dtype == 'fromproxy' or dtype == 'frommud') \
             and self.state == CONNECTED:
         outbuffer = "".join([outbuffer, '\r\n'])
-        Telnet.addtooutbuffer(self, outbuffer, raw)
+        self.queue(outbuffer, raw)
+      elif dtype == 'passthrough' and self.state == CONNECTED:
+        # data from the mud that was not split into lines
+        self.queue(outbuffer, raw)
+      elif dtype == 'prompt' and self.state == CONNECTED:
+        # no newline after a prompt, GA tells the client where it ends
+        self.queue(outbuffer, raw)
+        self.queue(IAC + GA, True)
       elif len(dtype) == 1 and ord(dtype) in self.options \
             and self.state == CONNECTED:
-        Telnet.addtooutbuffer(self, outbuffer, raw)
+        self.queue(outbuffer, raw, droppable=False)
       elif dtype == 'passwd' and self.state == PASSWORD:
         outbuffer = "".join([outbuffer, '\r\n'])
-        Telnet.addtooutbuffer(self, outbuffer, raw)
+        self.queue(outbuffer, raw, droppable=False)
+
+  def setbackpressure(self, high, low, policy):
+    """
+    set the output buffer watermarks, in bytes, and the slow client policy
+    """
+    self.policy = policy if policy in POLICIES else 'skip'
+    self.outbuffer.setwatermarks(high, low, onhigh=self.onhigh,
+                                 onlow=self.onlow)
+
+  def queue(self, data, raw=False, droppable=True):
+    """
+    add data to the output, or to the backlog if the client is behind
+
+    data that is not droppable (telnet options, the password prompt)
+    is never thrown away
+    """
+    if self.outbuffer.overhigh or self.backlog or \
+        len(self.outbuffer) + self.pendingsize > self.outbuffer.highwater:
+      self.backlog.append((data, raw, droppable))
+      self.backlogsize = self.backlogsize + len(data)
+      if self.backlogsize > self.outbuffer.highwater:
+        self.overflow()
+    else:
+      Telnet.addtooutbuffer(self, data, raw)
+
+  def onhigh(self, size):
+    """
+    the output buffer went over the high watermark
+    """
+    self.api('send.msg')('%s - %s: client is behind, %s bytes buffered' % \
+                              (self.host, self.port, size), primary='net')
+
+  def flush(self):
+    """
+    move the data added in this pass to the output buffer and send the
+    backlog if the buffer drained before it went over the high watermark
+    """
+    Telnet.flush(self)
+    if self.backlog and not self.outbuffer.overhigh and \
+        self.state != CLOSING:
+      self.onlow(len(self.outbuffer))
+
+  def onlow(self, size): # pylint: disable=unused-argument
+    """
+    the output buffer drained to the low watermark, send the backlog
+    """
+    if self.skipped and self.policy == 'skip':
+      Telnet.addtooutbuffer(self, self.api('colors.convertcolors')(
+          '@R#BP@w: @R%s lines skipped@w\r\n' % self.skipped))
+    self.skipped = 0
+    while self.backlog:
+      data, raw, _ = self.backlog.popleft()
+      Telnet.addtooutbuffer(self, data, raw)
+    self.backlogsize = 0
+
+  def overflow(self):
+    """
+    the backlog went over the high watermark, apply the policy
+    """
+    if self.policy == 'disconnect':
+      self.api('send.msg')('%s - %s: disconnecting slow client' % \
+                              (self.host, self.port), primary='net')
+      self.aborting = True
+      self.handle_close()
+      return
+
+    # throw away the oldest output until the backlog is under the
+    # low watermark
+    kept = []
+    while self.backlog and self.backlogsize > self.outbuffer.lowwater:
+      data, raw, droppable = self.backlog.popleft()
+      if droppable:
+        self.backlogsize = self.backlogsize - len(data)
+        lines = data.count('\n') or 1
+        self.skipped = self.skipped + lines
+        self.droppedlines = self.droppedlines + lines
+      else:
+        kept.append((data, raw, droppable))
+    self.backlog.extendleft(reversed(kept))
+
+  def readable(self):
+    """
+    a closing client is not read from, it only gets what is left in
+    its buffer
+    """
+    return self.state != CLOSING
 
   def handle_read(self):
     """
     handle a read
     """
-    if not self.connected:
+    if not self.connected or self.state == CLOSING:
       return
     Telnet.handle_read(self)
 
-    data = self.getdata()
+    self.handledata(self.getdata())
 
+  def feed(self, data):
+    """
+    handle data the client sent before it was created, the supervisor
+    passes on what a client sent after the session name
+    """
+    self.parse(data)
+    self.handledata(self.getdata())
+
+  def handledata(self, data):
+    """
+    handle data from the client, the password or commands
+    """
     if data:
       if self.state == CONNECTED:
         if self.viewonly:
@@ -132,11 +278,58 @@ class Client(Telnet):
                     '@R#BP@w: @RPlease try again! Proxy Password:@w'),
                  'dtype':'passwd'})
 
+  def getstate(self):
+    """
+    return the state of the client for a hot restart
+    """
+    state = Telnet.getstate(self)
+    state.update({'state':self.state,
+                  'viewonly':self.viewonly,
+                  'pwtries':self.pwtries,
+                  'ttype':self.ttype,
+                  'connectedtime':self.connectedtime,
+                  'backlog':list(self.backlog),
+                  'skipped':self.skipped,
+                  'droppedlines':self.droppedlines})
+    return state
+
+  def setstate(self, state):
+    """
+    restore the client in the new process, the backlog is queued
+    again after what was left in the output buffer
+    """
+    Telnet.setstate(self, state)
+    self.state = state['state']
+    self.viewonly = state['viewonly']
+    self.pwtries = state['pwtries']
+    self.ttype = state['ttype']
+    self.connectedtime = state['connectedtime']
+    self.skipped = state['skipped']
+    self.droppedlines = state['droppedlines']
+    for data, raw, droppable in state['backlog']:
+      self.queue(data, raw, droppable)
+
+  def handle_write(self):
+    """
+    write to the client, finish closing when a closing client has
+    been sent everything
+    """
+    sent = Telnet.handle_write(self)
+    if self.state == CLOSING and not self.outbuffer:
+      self.closenow()
+    return sent
+
   def handle_close(self):
     """
     handle a close
+
+    the client is closed when what is left in the buffer has been sent,
+    or after CLOSETIMEOUT seconds
     """
-    if self.state != CLOSING:
+    if self.state == CLOSING:
+      # called again when the socket closes or a write fails
+      self.closenow()
+    else:
       self.state = CLOSING
       self.api('send.client')("%s - %s: Client Disconnected" % \
                                   (self.host, self.port))
@@ -145,7 +338,27 @@ class Client(Telnet):
       self.api('events.eraise')('client_disconnected', {'client':self},
                                 calledfrom="client")
       self.api('events.unregister')('to_client_event', self.addtooutbufferevent)
-      if self.connected:
-        while self.outbuffer:
-          self.handle_write()
-        Telnet.handle_close(self)
+      self.api('options.resetoptions')(self, True)
+      self.backlog.clear()
+      self.backlogsize = 0
+      if self.connected and not self.aborting:
+        # flush tries one write right away
+        self.flush()
+      if self.outbuffer and self.connected and not self.aborting and \
+          not self.api.shutdown:
+        self.closehandle = self.api('reactor.calllater')(CLOSETIMEOUT,
+                                                         self.closenow)
+      else:
+        self.closenow()
+
+  def closenow(self):
+    """
+    close the socket
+    """
+    if self.closehandle:
+      self.api('reactor.cancel')(self.closehandle)
+      self.closehandle = None
+    self.pending = []
+    self.outbuffer.clear()
+    if self.connected:
+      Telnet.handle_close(self)
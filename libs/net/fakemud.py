@@ -0,0 +1,657 @@
+"""
+This module is a stand-in mud for load and soak testing the proxy
+
+It negotiates like Aardwolf: it offers MCCP2, GMCP and A102, asks for
+the terminal type, has a login that ends with "[ Press Return to
+continue ]" and sends GMCP char and room data once a character is in the
+game. Each character can be flooded with:
+  * combat spam, a number of lines per second
+  * GMCP char.vitals, a number of times per second
+  * an inventory dump in the invdata format plugins.aardwolf.eq parses,
+     every number of seconds
+
+usage: python -m libs.net.fakemud [-h] [-p PORT] [-c COMBAT] [-v VITALS]
+                                  [-i INVENTORY] [-n ITEMS] [-r REPORT]
+
+  -p PORT      - the port to listen on (default: 4000)
+  -c COMBAT    - lines of combat spam per second (default: 0)
+  -v VITALS    - char.vitals per second (default: 0)
+  -i INVENTORY - seconds between inventory dumps (default: 0)
+  -n ITEMS     - the number of items in the inventory (default: 50)
+  -r REPORT    - seconds between reports of what was sent (default: 60)
+
+Any name and password logs in. The floods can be changed by a client:
+  fake combat <lines per second>
+  fake vitals <per second>
+  fake inventory <seconds>
+  fake stop   - stop all floods
+  fake stats  - show what was sent and received
+
+Other commands:
+  look, score, invdata [container], eqdata, echo <text>, quit
+
+When a client does not read, the floods skip what they would send while
+more than MAXBUFFER bytes are waiting, fake stats shows how much.
+"""
+from __future__ import print_function
+import asyncore
+import json
+import random
+import socket
+import sys
+import time
+import zlib
+
+import libs.argp as argp
+from libs.net.telnetlib import IAC, DONT, DO, WONT, WILL, SB, SE, GA, TTYPE
+
+MCCP2 = chr(86)
+GMCP = chr(201)
+A102 = chr(102)
+
+TTYPEIS = chr(0)
+TTYPESEND = chr(1)
+
+# the states of a connection
+NAME = 0
+PASSWORD = 1
+MOTD = 2
+PLAYING = 3
+
+# the seconds between runs of the floods
+FLOODTICK = .1
+
+# floods skip while more than this many bytes wait to be sent
+MAXBUFFER = 4 * 1024 * 1024
+
+# the item types from plugins.aardwolf.itemu
+CONTAINER = 11
+ITEMTYPES = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 12, 13, 14, 19]
+ITEMFLAGS = ['', 'K', 'G', 'H', 'M', 'KM', 'GH', 'KGHM']
+ITEMNAMES = ['a steel sword', 'a wooden shield', 'a potion of healing',
+             'a scroll of recall', 'a leather cap', 'a silver ring',
+             'a loaf of bread', 'a waterskin', 'a glowing orb',
+             'an iron key', 'a cloak of shadows', 'a pair of boots']
+
+COMBAT = [
+    '\x1b[0;37mYour slash \x1b[1;33m*** DEVASTATES ***\x1b[0;37m a training '
+    'dummy! [%d]\x1b[0m',
+    '\x1b[0;37mYour pierce \x1b[1;31m<<< ERADICATES >>>\x1b[0;37m a training '
+    'dummy! [%d]\x1b[0m',
+    '\x1b[0;32mA training dummy\'s punch \x1b[0;31mscratches\x1b[0;32m you. '
+    '[%d]\x1b[0m',
+    '\x1b[0;36mYou dodge a training dummy\'s attack. [%d]\x1b[0m',
+    '\x1b[1;35mA training dummy is covered in blood. [%d]\x1b[0m',
+]
+
+ROOM = {'num':32418, 'name':'The Grand City of Aylor', 'zone':'aylor',
+        'terrain':'city', 'details':'',
+        'exits':{'n':32419, 's':32417, 'e':32420},
+        'coord':{'id':0, 'x':30, 'y':19, 'cont':0}}
+
+
+def makeitems(count):
+  """
+  make the items for the inventory, every tenth item is a container
+  with five items in it, returns the items and the containers
+  """
+  rand = random.Random(count)
+  items = []
+  containers = {}
+  for index in range(count):
+    serial = 300000000 + index
+    itype = CONTAINER if index % 10 == 9 else rand.choice(ITEMTYPES)
+    items.append([serial, rand.choice(ITEMFLAGS), rand.choice(ITEMNAMES),
+                  rand.randint(1, 201), itype, rand.randint(0, 1), -1, -1])
+    if itype == CONTAINER:
+      containers[serial] = []
+      for inside in range(5):
+        containers[serial].append(
+            [400000000 + index * 10 + inside, rand.choice(ITEMFLAGS),
+             rand.choice(ITEMNAMES), rand.randint(1, 201),
+             rand.choice(ITEMTYPES), 0, -1, -1])
+  return items, containers
+
+
+def dataline(item):
+  """
+  format an item for invdata and eqdata
+  """
+  return ','.join([str(i) for i in item])
+
+
+class MudConnection(asyncore.dispatcher):
+  """
+  a character connected to the fake mud
+  """
+  def __init__(self, server, sock, addr):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self, sock)
+    self.server = server
+    self.addr = addr
+    self.state = NAME
+    self.name = ''
+    self.inbuffer = ''
+    self.linebuffer = ''
+    self.pending = []
+    self.outbuffer = ''
+    self.closing = False
+    self.compressor = None
+    self.gmcp = False
+    self.a102 = set()
+    self.ttype = ''
+    self.floods = {}
+    self.combatcount = 0
+    self.combatcarry = 0.0
+    self.vitals = {'hp':10000, 'mana':8000, 'moves':7000}
+    self.stats = {'commands':0, 'lines':0, 'gmcp':0, 'bytes':0, 'wire':0,
+                  'skipped':0, 'received':0}
+
+    self.queue(IAC + WILL + MCCP2 + IAC + WILL + GMCP + IAC + WILL + A102 +
+               IAC + DO + TTYPE)
+    self.queue('\r\n\x1b[1;37mWelcome to the fake Aardwolf\x1b[0m\r\n\r\n'
+               'What be thy name, adventurer? ')
+
+  def queue(self, data):
+    """
+    add data to send at the end of this pass
+    """
+    self.pending.append(data)
+    self.stats['bytes'] = self.stats['bytes'] + len(data)
+
+  def sendline(self, line):
+    """
+    send a line of text
+    """
+    self.stats['lines'] = self.stats['lines'] + 1
+    self.queue(line.replace(IAC, IAC + IAC) + '\r\n')
+
+  def sendgmcp(self, module, data):
+    """
+    send a GMCP message if the client wants GMCP
+    """
+    if self.gmcp:
+      self.stats['gmcp'] = self.stats['gmcp'] + 1
+      message = '%s %s' % (module, json.dumps(data))
+      self.queue(IAC + SB + GMCP + message.replace(IAC, IAC + IAC) + IAC + SE)
+
+  def sendprompt(self):
+    """
+    send the prompt, marked with GA
+    """
+    self.queue('\r\n\x1b[0;37m[%(hp)s/10000hp %(mana)s/8000mn ' \
+                 '%(moves)s/7000mv]\x1b[0m ' % self.vitals + IAC + GA)
+
+  def flush(self):
+    """
+    compress and move what was queued during this pass to the outbuffer
+    """
+    if not self.pending:
+      return
+    data = ''.join(self.pending)
+    self.pending = []
+    if self.compressor:
+      data = self.compressor.compress(data) + \
+              self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    self.stats['wire'] = self.stats['wire'] + len(data)
+    self.outbuffer = self.outbuffer + data
+
+  def writable(self):
+    """
+    check if there is something to send
+    """
+    return bool(self.outbuffer) or self.closing
+
+  def handle_write(self):
+    """
+    send what is in the outbuffer, close after quit
+    """
+    if self.outbuffer:
+      sent = self.send(self.outbuffer)
+      self.outbuffer = self.outbuffer[sent:]
+    if self.closing and not self.outbuffer and not self.pending:
+      self.handle_close()
+
+  def handle_read(self):
+    """
+    read telnet options and lines
+    """
+    data = self.recv(65536)
+    if not data:
+      return
+    self.stats['received'] = self.stats['received'] + len(data)
+    self.linebuffer = self.linebuffer + self.parse(data)
+    while '\n' in self.linebuffer and not self.closing:
+      line, self.linebuffer = self.linebuffer.split('\n', 1)
+      self.handleline(line.strip('\r'))
+
+  def handle_close(self):
+    """
+    the connection closed
+    """
+    self.server.removeconnection(self)
+    self.close()
+
+  def parse(self, data):
+    """
+    handle the telnet sequences in data, returns the text
+    """
+    data = self.inbuffer + data
+    self.inbuffer = ''
+    text = []
+    index = 0
+    while index < len(data):
+      nextiac = data.find(IAC, index)
+      if nextiac == -1:
+        text.append(data[index:])
+        break
+      text.append(data[index:nextiac])
+      index = nextiac
+      if index + 1 >= len(data):
+        self.inbuffer = data[index:]
+        break
+      command = data[index + 1]
+      if command == IAC:
+        text.append(IAC)
+        index = index + 2
+      elif command in (DO, DONT, WILL, WONT):
+        if index + 2 >= len(data):
+          self.inbuffer = data[index:]
+          break
+        self.handleoption(command, data[index + 2])
+        index = index + 3
+      elif command == SB:
+        end = data.find(IAC + SE, index + 2)
+        while end != -1 and data[index + 2:end].replace(IAC + IAC, '') \
+                                                .endswith(IAC):
+          # the IAC before SE was an escaped IAC
+          end = data.find(IAC + SE, end + 1)
+        if end == -1:
+          self.inbuffer = data[index:]
+          break
+        sbdata = data[index + 2:end].replace(IAC + IAC, IAC)
+        if sbdata:
+          self.handlesb(sbdata[0], sbdata[1:])
+        index = end + 2
+      else:
+        index = index + 2
+    return ''.join(text)
+
+  def handleoption(self, command, option):
+    """
+    handle DO, DONT, WILL and WONT from the client
+    """
+    if option == MCCP2:
+      if command == DO and not self.compressor:
+        # the start of the stream is sent before compressing
+        self.queue(IAC + SB + MCCP2 + IAC + SE)
+        self.flush()
+        self.compressor = zlib.compressobj(6)
+      elif command == DONT and self.compressor:
+        self.flush()
+        data = self.compressor.flush(zlib.Z_FINISH)
+        self.stats['wire'] = self.stats['wire'] + len(data)
+        self.outbuffer = self.outbuffer + data
+        self.compressor = None
+    elif option == GMCP:
+      self.gmcp = command == DO
+    elif option == A102:
+      if command == DONT:
+        self.a102.clear()
+    elif option == TTYPE and command == WILL:
+      self.queue(IAC + SB + TTYPE + TTYPESEND + IAC + SE)
+
+  def handlesb(self, option, data):
+    """
+    handle a subnegotiation from the client
+    """
+    if option == TTYPE and data[:1] == TTYPEIS:
+      self.ttype = data[1:]
+    elif option == A102 and len(data) >= 2:
+      if ord(data[1]) == 1:
+        self.a102.add(ord(data[0]))
+      else:
+        self.a102.discard(ord(data[0]))
+    elif option == GMCP:
+      self.handlegmcp(data.strip())
+
+  def handlegmcp(self, message):
+    """
+    answer GMCP requests the way Aardwolf does
+    """
+    if message == 'request char':
+      self.sendchar()
+    elif message == 'request room':
+      self.sendgmcp('room.info', ROOM)
+    elif message == 'request quest':
+      self.sendgmcp('comm.quest', {'action':'ready'})
+
+  def sendchar(self):
+    """
+    send the GMCP char modules
+    """
+    self.sendgmcp('char.base', {'name':self.name, 'class':'Mage',
+                                'subclass':'Enchanter', 'race':'Elf',
+                                'clan':'', 'pretitle':'', 'perlevel':1000,
+                                'tier':0, 'remorts':1, 'redos':'0'})
+    self.sendgmcp('char.status', {'level':201, 'tnl':0, 'hunger':100,
+                                  'thirst':100, 'align':2500, 'state':3,
+                                  'pos':'Standing', 'enemy':'',
+                                  'enemypct':0})
+    self.sendgmcp('char.maxstats', {'maxhp':10000, 'maxmana':8000,
+                                    'maxmoves':7000})
+    self.sendgmcp('char.vitals', self.vitals)
+
+  def handleline(self, line):
+    """
+    handle a line from the client
+    """
+    if self.state == NAME:
+      self.name = line.strip().capitalize() or 'Fake'
+      self.state = PASSWORD
+      self.queue('Password: ')
+    elif self.state == PASSWORD:
+      self.state = MOTD
+      self.queue('\r\n[ Press Return to continue ]\r\n')
+    elif self.state == MOTD:
+      self.state = PLAYING
+      self.server.log('%s logged in from %s:%s' % \
+                          (self.name, self.addr[0], self.addr[1]))
+      self.sendchar()
+      self.sendgmcp('room.info', ROOM)
+      self.look()
+      for name, value in self.server.floods.items():
+        self.setflood(name, value)
+    else:
+      self.stats['commands'] = self.stats['commands'] + 1
+      self.command(line.strip())
+
+  def command(self, line):
+    """
+    run a command
+    """
+    words = line.split()
+    cmd = words[0].lower() if words else ''
+    args = words[1:]
+    if not cmd:
+      pass
+    elif cmd == 'look':
+      self.look()
+    elif cmd == 'score':
+      self.sendline('%s the Elf Enchanter, level 201' % self.name)
+      self.sendline('Hp: %(hp)s Mana: %(mana)s Moves: %(moves)s' % \
+                      self.vitals)
+    elif cmd == 'invdata':
+      self.invdata(args[0] if args else None)
+    elif cmd == 'eqdata':
+      self.eqdata()
+    elif cmd == 'echo':
+      self.sendline(line[len(words[0]):].strip())
+    elif cmd == 'fake':
+      self.fake(args)
+    elif cmd == 'quit':
+      self.sendline('Goodbye.')
+      self.closing = True
+      return
+    else:
+      self.sendline('Huh?')
+    self.sendprompt()
+
+  def look(self):
+    """
+    show the room
+    """
+    self.sendline('\x1b[1;36m%s\x1b[0m' % ROOM['name'])
+    self.sendline('   The streets of Aylor are busy with adventurers.')
+    self.sendline('\x1b[0;32m[ Exits: north south east ]\x1b[0m')
+
+  def invdata(self, container=None):
+    """
+    send the inventory or the items in a container
+    """
+    if container is None:
+      self.sendline('{invdata}')
+      items = self.server.items
+    else:
+      try:
+        items = self.server.containers[int(container)]
+      except (ValueError, KeyError):
+        self.sendline('You do not have that container.')
+        return
+      self.sendline('{invdata %s}' % container)
+    for item in items:
+      self.sendline(dataline(item))
+    self.sendline('{/invdata}')
+
+  def eqdata(self):
+    """
+    send what is worn, the first item of the inventory in each slot
+    """
+    self.sendline('{eqdata}')
+    for slot, item in enumerate(self.server.items[:25]):
+      self.sendline(dataline(item[:6] + [slot, -1]))
+    self.sendline('{/eqdata}')
+
+  def fake(self, args):
+    """
+    change the floods or show the stats
+    """
+    if args and args[0] == 'stop':
+      for name in self.floods.keys():
+        self.setflood(name, 0)
+      self.sendline('All floods stopped.')
+    elif args and args[0] == 'stats':
+      for name in sorted(self.stats):
+        self.sendline('%-10s : %s' % (name, self.stats[name]))
+      for name in sorted(self.floods):
+        self.sendline('%-10s : %s' % (name, self.floods[name]['value']))
+      self.sendline('%-10s : %s' % ('mccp', bool(self.compressor)))
+      self.sendline('%-10s : %s' % ('gmcp', self.gmcp))
+      self.sendline('%-10s : %s' % ('a102', sorted(self.a102)))
+      self.sendline('%-10s : %s' % ('ttype', self.ttype))
+    elif len(args) == 2 and args[0] in ['combat', 'vitals', 'inventory']:
+      try:
+        value = float(args[1])
+      except ValueError:
+        value = -1
+      if value < 0:
+        self.sendline('fake %s needs a number' % args[0])
+      else:
+        self.setflood(args[0], value)
+        self.sendline('%s flood set to %s' % (args[0], value))
+    else:
+      self.sendline('fake combat|vitals|inventory <number>, fake stop, ' \
+                      'fake stats')
+
+  def setflood(self, name, value):
+    """
+    start, change or stop a flood
+
+    combat is lines per second, vitals is messages per second and
+    inventory is seconds between dumps
+    """
+    if not value:
+      self.floods.pop(name, None)
+      return
+    if name == 'combat':
+      interval = FLOODTICK
+    elif name == 'vitals':
+      interval = 1.0 / value
+    else:
+      interval = value
+    self.floods[name] = {'value':value, 'interval':interval,
+                         'next':time.time() + interval}
+
+  def runfloods(self, now):
+    """
+    run the floods that are due, returns when the next one is due
+    """
+    nextdue = None
+    for name, flood in self.floods.items():
+      if flood['next'] <= now:
+        if len(self.outbuffer) > MAXBUFFER:
+          self.stats['skipped'] = self.stats['skipped'] + 1
+        else:
+          getattr(self, 'flood' + name)(flood)
+        # don't try to catch up after a stall
+        flood['next'] = max(flood['next'] + flood['interval'], now)
+      if nextdue is None or flood['next'] < nextdue:
+        nextdue = flood['next']
+    return nextdue
+
+  def floodcombat(self, flood):
+    """
+    send a round of combat spam
+    """
+    self.combatcarry = self.combatcarry + flood['value'] * flood['interval']
+    lines = int(self.combatcarry)
+    self.combatcarry = self.combatcarry - lines
+    for _ in range(lines):
+      self.combatcount = self.combatcount + 1
+      self.sendline(COMBAT[self.combatcount % len(COMBAT)] % \
+                      random.randint(1, 2000))
+    if lines:
+      self.vitals['hp'] = random.randint(5000, 10000)
+      self.sendprompt()
+
+  def floodvitals(self, flood): # pylint: disable=unused-argument
+    """
+    send char.vitals
+    """
+    self.vitals['mana'] = random.randint(4000, 8000)
+    self.sendgmcp('char.vitals', self.vitals)
+
+  def floodinventory(self, flood): # pylint: disable=unused-argument
+    """
+    send the inventory
+    """
+    self.invdata()
+    self.sendprompt()
+
+
+class FakeMud(asyncore.dispatcher):
+  """
+  listen for connections and run the floods
+  """
+  def __init__(self, port, floods, items, report):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self)
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(('', port))
+    self.listen(50)
+    self.floods = floods
+    self.items, self.containers = makeitems(items)
+    self.report = report
+    self.connections = []
+    self.totals = {}
+
+  @staticmethod
+  def log(msg):
+    """
+    print a message
+    """
+    print('%s - fakemud    : %s' % \
+            (time.strftime('%a %b %d %Y %H:%M:%S', time.localtime()), msg))
+    sys.stdout.flush()
+
+  def handle_accept(self):
+    """
+    accept a new connection
+    """
+    pair = self.accept()
+    if pair:
+      sock, addr = pair
+      self.connections.append(MudConnection(self, sock, addr))
+      self.log('connection from %s:%s' % addr)
+
+  def removeconnection(self, connection):
+    """
+    a connection closed
+    """
+    if connection in self.connections:
+      self.connections.remove(connection)
+      for name, value in connection.stats.items():
+        self.totals[name] = self.totals.get(name, 0) + value
+      self.log('%s:%s disconnected' % connection.addr)
+
+  def showreport(self):
+    """
+    log what was sent and received
+    """
+    totals = dict(self.totals)
+    for connection in self.connections:
+      for name, value in connection.stats.items():
+        totals[name] = totals.get(name, 0) + value
+    self.log(', '.join(['connections: %s' % len(self.connections)] +
+                       ['%s: %s' % (i, totals[i]) for i in sorted(totals)]))
+
+  def run(self):
+    """
+    run until interrupted
+    """
+    self.log('listening on %s' % self.socket.getsockname()[1])
+    nextreport = time.time() + self.report if self.report else None
+    try:
+      while True:
+        now = time.time()
+        nextdue = nextreport
+        for connection in self.connections[:]:
+          due = connection.runfloods(now)
+          if due is not None and (nextdue is None or due < nextdue):
+            nextdue = due
+          connection.flush()
+        timeout = 1 if nextdue is None else min(max(nextdue - now, 0), 1)
+        asyncore.loop(timeout=timeout, count=1)
+        for connection in self.connections[:]:
+          connection.flush()
+        if nextreport and time.time() >= nextreport:
+          self.showreport()
+          nextreport = time.time() + self.report
+    except KeyboardInterrupt:
+      pass
+    self.showreport()
+
+
+def main():
+  """
+  start the fake mud
+  """
+  parser = argp.ArgumentParser(description='a fake mud for testing')
+  parser.add_argument('-p', '--port',
+                      help='the port to listen on',
+                      type=int,
+                      default=4000)
+  parser.add_argument('-c', '--combat',
+                      help='lines of combat spam per second',
+                      type=float,
+                      default=0)
+  parser.add_argument('-v', '--vitals',
+                      help='char.vitals per second',
+                      type=float,
+                      default=0)
+  parser.add_argument('-i', '--inventory',
+                      help='seconds between inventory dumps',
+                      type=float,
+                      default=0)
+  parser.add_argument('-n', '--items',
+                      help='the number of items in the inventory',
+                      type=int,
+                      default=50)
+  parser.add_argument('-r', '--report',
+                      help='seconds between reports of what was sent',
+                      type=float,
+                      default=60)
+  targs = vars(parser.parse_args())
+
+  floods = {'combat':targs['combat'], 'vitals':targs['vitals'],
+            'inventory':targs['inventory']}
+  FakeMud(targs['port'], floods, targs['items'], targs['report']).run()
+
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,60 @@
 """
 This file holds the class that connects to the mud
+
+The connection is made without blocking the event loop:
+  * the hostname is resolved in the reactor executor
+  * the socket connects in non blocking mode, mudconnect is raised
+     when the connection has been established
+  * an attempt that takes longer than the timeout is cancelled
+  * if an attempt fails or the mud closes the connection, the proxy
+     reconnects after a delay that doubles with each failed attempt
+     (with random jitter) up to RECONNECTMAX seconds
+
+A line without a newline at the end is held until the rest of it
+arrives, except for prompts: when the mud sends IAC GA or IAC EOR
+after a prompt, the prompt is sent to the clients right away through
+the from_mud_prompt event. For muds that don't mark prompts, a held
+line is sent as a prompt after promptdelay milliseconds without data
+(0 turns this off).
+
+When no function needs the data as lines (nothing but passive
+functions registered to the events in LINEEVENTS), data from the mud is
+sent to the clients as it was read, without splitting it into lines.
+The mud switches back to lines as soon as a function registers.
+
+The lines from a read go through the from_mud_batch event, and each
+line goes through from_mud_event before the next one. The lines are
+sent to the clients in one write when the batch is done, or earlier
+when a function sends something else to the clients, so the clients
+get a line before anything sent after it was processed.
+
+For a hot restart, the connection and a partial line in lastmsg are
+handed to the new process with getstate and setstate.
+
+Everything read from the mud is written to the rawmud log, one read per
+line as the time it was read and the bytes escaped with string_escape,
+so libs.net.replay can play a session back.
 """
+import functools
+import random
+import socket
+import sys
 import time
-from libs.net.telnetlib import Telnet
+from libs.net.telnetlib import Telnet, IAC, GA, ENDREC
+from libs.records import Line
+
+DISCONNECTED = 0
+RESOLVING = 1
+CONNECTING = 2
+CONNECTED = 3
+
+# the reconnect delay in seconds, before jitter
+RECONNECTMIN = 2
+RECONNECTMAX = 300
+
+# the events that need the mud data split into lines
+LINEEVENTS = ['from_mud_batch', 'from_mud_event', 'from_mud_prompt',
+              'muddata_trace_started', 'muddata_trace_finished']
 
 
 class Mud(Telnet):
@@ -18,6 +70,26 @@ class Mud(Telnet):
     self.lastmsg = ''
     self.ttype = 'BastProxy'
     self.connectedtime = None
+    self.connstate = DISCONNECTED
+    self.connectattempt = 0
+    self.connecttimeout = 30
+    self.autoreconnect = False
+    self.reconnectattempts = 0
+    self.timeouthandle = None
+    self.reconnecthandle = None
+    self.promptdelay = 0
+    self.prompthandle = None
+    self.marksprompts = False
+    self.passthroughbytes = 0
+    self.tracefinished = False
+    # handles for the api functions used for every read
+    self.getevent = self.api.handle('events.gete')
+    self.raiseevent = self.api.handle('events.eraise')
+    self.raisebatch = self.api.handle('events.eraisebatch')
+    self.sendclient = self.api.handle('send.client')
+    self.flushclient = self.api.handle('send.flushclient')
+    self.writefile = self.api.handle('log.writefile')
+    self.samplestack = self.api.handle('profile.samplestack')
     self.api('events.register')('to_mud_event', self.addtooutbuffer,
                                 prio=99)
     self.api('options.prepareserver')(self)
@@ -30,8 +102,51 @@ class Mud(Telnet):
     """
     Telnet.handle_read(self)
 
-    data = self.getdata()
-    if data:
+    self.handledata(self.getdata())
+
+    self.scheduleprompt()
+
+  def scheduleprompt(self):
+    """
+    send a held partial line as a prompt after promptdelay ms without
+    data, if the mud doesn't mark prompts
+    """
+    if self.prompthandle:
+      self.api('reactor.cancel')(self.prompthandle)
+      self.prompthandle = None
+    if self.lastmsg and self.promptdelay and not self.marksprompts:
+      self.prompthandle = self.api('reactor.calllater')(
+          self.promptdelay / 1000.0, self.promptidle)
+
+  def needslines(self):
+    """
+    check if any function needs the data from the mud as lines
+    """
+    for eventname in LINEEVENTS:
+      event = self.getevent(eventname)
+      if event is not None and event.hasactive():
+        return True
+    return False
+
+  def passthrough(self, data):
+    """
+    send data to the clients as it was read
+    """
+    if self.lastmsg:
+      # a partial line was held before switching
+      data = "".join([self.lastmsg, data])
+      self.lastmsg = ''
+    self.passthroughbytes = self.passthroughbytes + len(data)
+    self.sendclient(data, dtype='passthrough')
+
+  def handledata(self, data):
+    """
+    split data into lines and process them, the data after the
+    last newline is kept in lastmsg
+    """
+    if data and not self.needslines():
+      self.passthrough(data)
+    elif data:
       ndata = "".join([self.lastmsg, data])
 
       # don't care about \r
@@ -40,87 +155,285 @@ class Mud(Telnet):
       # split on \n
       ndatal = alldata.split('\n')
       self.lastmsg = ndatal[-1]
-      for i in ndatal[:-1]:
-        tosend = i
-        try:
-          tnoansi = self.api('colors.stripansi')(tosend)
-        except AttributeError:
-          tnoansi = tosend
-        try:
-          tconvertansi = self.api('colors.convertansi')(tosend)
-        except AttributeError:
-          tconvertansi = tosend
-        if tosend != tconvertansi:
-          self.api('send.msg')('converted %s to %s' % (repr(tosend),
-                                                       tconvertansi),
-                               'ansi')
-        trace = {}
-        trace['dtype'] = 'frommud'
-        trace['original'] = tosend
-        trace['changes'] = []
-
-        data = {'original':tosend,
-                'data':tosend,
-                'dtype':'frommud',
-                'noansi':tnoansi,
-                'convertansi':tconvertansi,
-                'trace':trace}
-
-        self.api('events.eraise')('muddata_trace_started', data,
-                                  calledfrom='proxy')
-
-        # this event can be used to transform the data
-        newdata = self.api('events.eraise')('from_mud_event',
-                                            data,
-                                            calledfrom="mud")
-
-        self.api('events.eraise')('muddata_trace_finished', data,
-                                  calledfrom='proxy')
-
-        # use the original key in the returned dictionary
-        # TODO: make this so that it uses a key just named data
-        if 'original' in newdata:
-          tosend = newdata['original']
-
-        # omit the data if it has been flagged
-        if 'omit' in newdata and newdata['omit']:
-          tosend = None
-
-        if tosend != None:
-          #data cannot be transformed here, it goes straight to the client
-          if self.api('api.has')('colors.stripansi'):
-            tnoansi = self.api('colors.stripansi')(tosend)
-          else:
-            tnoansi = tosend
-          if self.api('api.has')('colors.convertansi'):
-            tconvertansi = self.api('colors.convertansi')(tosend)
-          else:
-            tconvertansi = tosend
-          self.api('send.client')(tosend, dtype='frommud')
-
-  def connectmud(self, mudhost, mudport):
+      if len(ndatal) > 1:
+        self.processlines(ndatal[:-1])
+
+  def handle_command(self, command):
+    """
+    a GA or EOR from the mud marks the end of a prompt
+    """
+    if command in [GA, ENDREC]:
+      self.marksprompts = True
+      self.handledata(self.getdata())
+      if self.lastmsg:
+        self.sendprompt()
+      else:
+        self.sendclient(IAC + GA, raw=True, dtype='passthrough')
+    else:
+      Telnet.handle_command(self, command)
+
+  def promptidle(self):
+    """
+    no data came after a partial line, send it as a prompt
+    """
+    self.prompthandle = None
+    self.sendprompt()
+
+  def sendprompt(self):
+    """
+    send the partial line in lastmsg to the clients as a prompt
+    """
+    if not self.lastmsg:
+      return
+    prompt = Line(self.lastmsg)
+    self.lastmsg = ''
+
+    newprompt = self.raiseevent('from_mud_prompt', prompt, calledfrom="mud")
+
+    if newprompt['omit'] or newprompt['original'] is None:
+      return
+
+    self.sendclient(newprompt['original'], dtype='prompt')
+
+  def haslisteners(self, eventname):
+    """
+    check if any functions are registered to an event
+    """
+    event = self.getevent(eventname)
+    return event is not None and not event.isempty()
+
+  def processlines(self, lines):
+    """
+    send a batch of lines through the from_mud_batch event, each line
+    goes through the functions registered to from_mud_event before the
+    next one
+
+    the lines are held and sent to the clients in one write, anything
+    else sent to the clients while the batch is processed sends the
+    lines before it first
+    """
+    # the noansi and convertansi views of a line are only computed
+    # if a plugin uses them
+    batch = [Line(tosend) for tosend in lines]
+
+    self.tracefinished = self.haslisteners('muddata_trace_finished')
+
+    if self.haslisteners('muddata_trace_started'):
+      for data in batch:
+        self.raiseevent('muddata_trace_started', data, calledfrom='proxy')
+
+    # this event can be used to transform the data, functions registered
+    # to from_mud_event get one line at a time
+    try:
+      self.raisebatch('from_mud_batch', 'from_mud_event', batch,
+                      calledfrom="mud", linedone=self.linedone)
+    finally:
+      self.flushclient()
+
+  def linedone(self, newdata):
+    """
+    hold a line for the clients when the functions are done with it
+    """
+    if self.tracefinished:
+      self.raiseevent('muddata_trace_finished', newdata,
+                      calledfrom='proxy')
+
+    # omit the data if it has been flagged
+    if 'omit' in newdata and newdata['omit']:
+      return
+
+    # use the original key in the returned dictionary
+    # TODO: make this so that it uses a key just named data
+    if 'original' in newdata and newdata['original'] is not None:
+      #data cannot be transformed here, it goes straight to the client
+      self.sendclient(newdata['original'], dtype='frommud', hold=True)
+
+  def connectmud(self, mudhost, mudport, timeout=30, reconnect=True):
     """
     connect to the mud
+
+    required:
+      mudhost   - the hostname or ip of the mud
+      mudport   - the port of the mud
+    optional:
+      timeout   - the seconds to wait for a connection
+      reconnect - reconnect if the connection fails or is lost
+    """
+    if self.connstate != DISCONNECTED:
+      return
+    self.host = mudhost
+    self.port = mudport
+    self.connecttimeout = timeout
+    self.autoreconnect = reconnect
+    self.reconnectattempts = 0
+    self.startconnect()
+
+  def startconnect(self):
+    """
+    start a connection attempt by resolving the hostname
+    """
+    self.reconnecthandle = None
+    if self.connstate != DISCONNECTED:
+      return
+    self.connectattempt = self.connectattempt + 1
+    self.connstate = RESOLVING
+    self.pending = []
+    self.outbuffer.clear()
+    self.api('send.msg')('Connecting to mud %s:%s' % (self.host, self.port),
+                         'net')
+    self.timeouthandle = self.api('reactor.calllater')(
+        self.connecttimeout, self.connecttimedout, self.connectattempt)
+    self.api('reactor.runinexecutor')(
+        socket.getaddrinfo, (self.host, self.port, 0, socket.SOCK_STREAM),
+        callback=functools.partial(self.resolved, self.connectattempt),
+        errback=functools.partial(self.resolvefailed, self.connectattempt))
+
+  def resolved(self, attempt, addrinfo):
+    """
+    the hostname was resolved, start connecting
+    """
+    if attempt != self.connectattempt or self.connstate != RESOLVING:
+      return
+    family, socktype, _, _, address = addrinfo[0]
+    self.connstate = CONNECTING
+    try:
+      self.create_socket(family, socktype)
+      self.connect(address)
+    except socket.error as err:
+      self.connectfailed(err)
+
+  def resolvefailed(self, attempt, excinfo):
+    """
+    the hostname could not be resolved
+    """
+    if attempt != self.connectattempt or self.connstate != RESOLVING:
+      return
+    self.connectfailed(excinfo[1])
+
+  def connecttimedout(self, attempt):
+    """
+    the connection attempt took too long
+    """
+    self.timeouthandle = None
+    if attempt != self.connectattempt or \
+        self.connstate not in [RESOLVING, CONNECTING]:
+      return
+    self.connectfailed('timed out after %s seconds' % self.connecttimeout)
+
+  def connectfailed(self, reason):
+    """
+    a connection attempt failed
     """
-    if self.connected:
+    self.api('reactor.cancel')(self.timeouthandle)
+    self.timeouthandle = None
+    self.api('send.msg')('Could not connect to mud %s:%s: %s' % \
+                            (self.host, self.port, reason), 'net')
+    self.api('send.client')(self.api('colors.convertcolors')(
+        '@R#BP@w: Could not connect to the mud: %s' % reason))
+    if self.socket:
+      self.close()
+    self.connstate = DISCONNECTED
+    self.schedulereconnect()
+
+  def schedulereconnect(self):
+    """
+    schedule a reconnect with exponential backoff and jitter
+    """
+    if not self.autoreconnect or self.api.shutdown or self.reconnecthandle:
       return
-    self.outbuffer = ''
-    self.doconnect(mudhost, mudport)
+    delay = min(RECONNECTMAX, RECONNECTMIN * (2 ** self.reconnectattempts))
+    delay = random.uniform(delay / 2.0, delay)
+    self.reconnectattempts = self.reconnectattempts + 1
+    self.api('send.client')(self.api('colors.convertcolors')(
+        '@R#BP@w: Reconnecting to the mud in %.1f seconds' % delay))
+    self.reconnecthandle = self.api('reactor.calllater')(delay,
+                                                          self.startconnect)
+
+  def handle_connect(self):
+    """
+    the connection to the mud has been established
+    """
+    self.api('reactor.cancel')(self.timeouthandle)
+    self.timeouthandle = None
+    self.connstate = CONNECTED
+    self.reconnectattempts = 0
+    Telnet.handle_connect(self)
     self.connectedtime = time.localtime()
     self.api('send.msg')('Connected to mud', 'net')
     self.api('events.eraise')('mudconnect', {}, calledfrom="mud")
 
+  def handle_error(self):
+    """
+    handle an error, a failed non blocking connect shows up here
+    """
+    if self.connstate == CONNECTING:
+      self.connectfailed(sys.exc_info()[1])
+    else:
+      Telnet.handle_error(self)
+
+  def disconnect(self):
+    """
+    disconnect from the mud and do not reconnect
+    """
+    self.autoreconnect = False
+    self.api('reactor.cancel')(self.reconnecthandle)
+    self.reconnecthandle = None
+    self.api('reactor.cancel')(self.timeouthandle)
+    self.timeouthandle = None
+    if self.connstate == CONNECTED:
+      self.handle_close()
+    elif self.connstate != DISCONNECTED:
+      if self.socket:
+        self.close()
+      self.connstate = DISCONNECTED
+
+  def getstate(self):
+    """
+    return the state of the connection for a hot restart
+    """
+    state = Telnet.getstate(self)
+    state.update({'lastmsg':self.lastmsg,
+                  'connectedtime':self.connectedtime,
+                  'marksprompts':self.marksprompts,
+                  'autoreconnect':self.autoreconnect,
+                  'connecttimeout':self.connecttimeout,
+                  'passthroughbytes':self.passthroughbytes})
+    return state
+
+  def setstate(self, state):
+    """
+    restore the connection in the new process
+    """
+    Telnet.setstate(self, state)
+    self.connstate = CONNECTED
+    self.lastmsg = state['lastmsg']
+    self.connectedtime = state['connectedtime']
+    self.marksprompts = state['marksprompts']
+    self.autoreconnect = state['autoreconnect']
+    self.connecttimeout = state['connecttimeout']
+    self.passthroughbytes = state['passthroughbytes']
+
   def handle_close(self):
     """
     hand closing the connection
     """
+    if self.connstate == CONNECTING:
+      self.connectfailed('connection closed')
+      return
+    self.connstate = DISCONNECTED
     self.api('send.msg')('Disconnected from mud', 'net')
     self.api('send.client')(self.api('colors.convertcolors')(
         '@R#BP@w: The mud closed the connection'))
     self.api('options.resetoptions')(self, True)
     Telnet.handle_close(self)
     self.connectedtime = None
+    self.lastmsg = ''
+    self.marksprompts = False
+    if self.prompthandle:
+      self.api('reactor.cancel')(self.prompthandle)
+      self.prompthandle = None
     self.api('events.eraise')('muddisconnect', {}, calledfrom="mud")
+    self.schedulereconnect()
 
   def addtooutbuffer(self, data, raw=False):
     """
@@ -147,29 +460,36 @@ class Mud(Telnet):
       datastr = data
 
     if len(dtype) == 1 and ord(dtype) in self.options:
-      if trace:
-        trace['changes'].append({'flag':'Sent',
-                                 'data':'"%s" to mud with raw: %s and datatype: %s' %
-                                        (repr(datastr.strip()), raw, dtype),
-                                 'plugin':'proxy',
-                                 'callstack':self.api('api.callstack')()})
+      if trace and trace.recording:
+        trace.add('Sent', 'proxy',
+                  '"%r" to mud with raw: %s and datatype: %s',
+                  datastr.strip(), raw, dtype, callstack=self.capturestack())
       Telnet.addtooutbuffer(self, datastr, raw)
     elif dtype == 'fromclient':
-      if trace:
-        trace['changes'].append({'flag':'Sent',
-                                 'data':'"%s" to mud with raw: %s and datatype: %s' %
-                                        (datastr.strip(), raw, dtype),
-                                 'plugin':'proxy',
-                                 'callstack':self.api('api.callstack')()})
+      if trace and trace.recording:
+        trace.add('Sent', 'proxy',
+                  '"%s" to mud with raw: %s and datatype: %s',
+                  datastr.strip(), raw, dtype, callstack=self.capturestack())
       Telnet.addtooutbuffer(self, datastr, raw)
 
+  def capturestack(self):
+    """
+    capture the function stack for a command trace if the profile plugin
+    wants it, None otherwise
+    """
+    if self.samplestack.has() and self.samplestack():
+      return self.api('api.capturestack')()
+    return None
+
   def fill_rawq(self):
     """
-    Fill raw queue from exactly one recv() system call.
+    Fill the raw queue with all the data that is available, once per read
+    event, and log it to rawmud with a timestamp.
 
-    Block if no data is immediately available.  Set self.eof when
-    connection is closed.
+    Never blocks. Set self.eof when connection is closed.
     """
     buf = Telnet.fill_rawq(self)
-    self.api('log.writefile')('rawmud', buf)
+    if buf:
+      self.writefile('rawmud', '%.6f %s' % \
+                         (time.time(), buf.encode('string_escape')))
     return buf
@@ -0,0 +1,185 @@
+"""
+This module holds the output buffer for telnet connections
+
+Data is kept as a deque of the strings that were added to it and an
+offset into the first one, so adding data and partial sends never copy
+what is already queued. Small strings at the front of the queue are
+joined into one string (at most maxsend bytes) the first time they are
+sent, so every byte is copied at most once.
+
+If the socket has sendmsg, the chunks are sent with one scatter/gather
+call instead.
+
+The buffer also tracks high and low watermarks, in bytes, so the owner
+can be told when a connection falls behind and when it has caught up.
+"""
+from collections import deque
+
+# the most bytes to hand to a single send call
+MAXSEND = 65536
+
+# the most chunks to hand to a single sendmsg call
+MAXCHUNKS = 64
+
+class OutBuffer(object):
+  """
+  a queue of output chunks
+  """
+  def __init__(self, maxsend=MAXSEND):
+    """
+    initialize the instance
+    """
+    self.chunks = deque()
+    self.offset = 0
+    self.size = 0
+    self.maxsend = maxsend
+    self.highwater = None
+    self.lowwater = None
+    self.onhigh = None
+    self.onlow = None
+    self.overhigh = False
+
+  def __len__(self):
+    """
+    the number of bytes waiting to be sent
+    """
+    return self.size
+
+  def __nonzero__(self):
+    """
+    True if there is data waiting to be sent
+    """
+    return self.size > 0
+
+  __bool__ = __nonzero__
+
+  def setwatermarks(self, high=None, low=None, onhigh=None, onlow=None):
+    """
+    set the watermarks
+
+    optional:
+      high   - onhigh is called when the buffer grows past this many bytes
+      low    - onlow is called when the buffer shrinks to this many bytes
+                after going over the high watermark, defaults to high / 2
+      onhigh - a function called with the buffer size
+      onlow  - a function called with the buffer size
+    """
+    self.highwater = high
+    if high is not None and low is None:
+      low = high // 2
+    self.lowwater = low
+    self.onhigh = onhigh
+    self.onlow = onlow
+    self.overhigh = False
+    self.checkwatermarks()
+
+  def checkwatermarks(self):
+    """
+    check the size against the watermarks and call the callbacks
+    """
+    if self.highwater is None:
+      return
+
+    if not self.overhigh and self.size > self.highwater:
+      self.overhigh = True
+      if self.onhigh:
+        self.onhigh(self.size)
+    elif self.overhigh and self.size <= self.lowwater:
+      self.overhigh = False
+      if self.onlow:
+        self.onlow(self.size)
+
+  def append(self, data):
+    """
+    add a string to the end of the buffer
+    """
+    if data:
+      self.chunks.append(data)
+      self.size = self.size + len(data)
+      if self.highwater is not None and not self.overhigh:
+        self.checkwatermarks()
+
+  def clear(self):
+    """
+    throw away everything in the buffer
+    """
+    self.chunks.clear()
+    self.offset = 0
+    self.size = 0
+    self.checkwatermarks()
+
+  def drain(self):
+    """
+    remove everything from the buffer and return it as a string
+    """
+    if self.offset:
+      self.chunks[0] = self.chunks[0][self.offset:]
+      self.offset = 0
+    data = ''.join(self.chunks)
+    self.chunks.clear()
+    self.size = 0
+    self.checkwatermarks()
+    return data
+
+  def peek(self):
+    """
+    return a memoryview of the data to send next
+
+    if the first chunk is small, it is joined with the chunks after it
+    up to maxsend bytes and the joined string replaces them in the queue
+    """
+    if not self.chunks:
+      return ''
+
+    first = self.chunks[0]
+    if len(first) - self.offset < self.maxsend and len(self.chunks) > 1:
+      joined = [first[self.offset:] if self.offset else first]
+      total = len(joined[0])
+      self.chunks.popleft()
+      while self.chunks and total + len(self.chunks[0]) <= self.maxsend:
+        chunk = self.chunks.popleft()
+        joined.append(chunk)
+        total = total + len(chunk)
+      first = ''.join(joined)
+      self.chunks.appendleft(first)
+      self.offset = 0
+
+    return memoryview(first)[self.offset:self.offset + self.maxsend]
+
+  def views(self):
+    """
+    return a list of memoryviews of the data to send next, for sendmsg
+    """
+    views = []
+    total = 0
+    for chunk in self.chunks:
+      if not views and self.offset:
+        view = memoryview(chunk)[self.offset:]
+      else:
+        view = memoryview(chunk)
+      views.append(view)
+      total = total + len(view)
+      if total >= self.maxsend or len(views) >= MAXCHUNKS:
+        break
+
+    return views
+
+  def consume(self, sent):
+    """
+    remove the number of bytes that were sent from the front of the buffer
+    """
+    if not sent:
+      return
+
+    self.size = self.size - sent
+    while sent:
+      left = len(self.chunks[0]) - self.offset
+      if sent < left:
+        self.offset = self.offset + sent
+        break
+      sent = sent - left
+      self.chunks.popleft()
+      self.offset = 0
+
+    if self.overhigh:
+      self.checkwatermarks()
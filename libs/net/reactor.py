@@ -0,0 +1,508 @@
+"""
+This module holds the event loop for the proxy
+
+It replaces the asyncore.loop polling loop. All sockets are still
+asyncore.dispatcher instances that live in asyncore.socket_map, so Telnet,
+Mud, Client and Listener keep the same contract (readable, writable,
+handle_read, handle_write, handle_close, ...)
+
+The differences from asyncore.loop:
+  * uses epoll on Linux (falls back to poll, then select)
+  * keeps the registration between passes and only changes it when the
+     readable/writable state of a dispatcher changes
+  * the poll timeout comes from the next due timer, so the loop sleeps
+     until there is something to do instead of waking up every .25 seconds
+  * functions can be scheduled to run after a delay with subsecond
+     precision with calllater
+  * blocking work (smtp, sqlite, dns) can be run in a pool of worker
+     threads with runinexecutor, the result is handed back to a callback
+     that runs in the event loop
+  * output is coalesced per pass: dispatchers that get data call
+     flushlater and their flush method is called once at the end of
+     the pass, so many small writes become one send
+
+APIs for the reactor
+  'reactor.calllater'     : call a function after a number of seconds
+  'reactor.cancel'        : cancel a function from calllater
+  'reactor.runinexecutor' : run a blocking function in a worker thread
+"""
+import asyncore
+import errno
+import heapq
+import select
+import socket
+import sys
+import threading
+import time
+import Queue
+
+from libs.api import API
+
+READFLAGS = select.POLLIN | select.POLLPRI
+WRITEFLAGS = select.POLLOUT
+ERRORFLAGS = select.POLLERR | select.POLLHUP | select.POLLNVAL
+
+BACKENDS = ['epoll', 'poll', 'select']
+
+def defaultbackend():
+  """
+  return the best backend available on this platform
+  """
+  for backend in BACKENDS:
+    if hasattr(select, backend):
+      return backend
+
+  return 'select'
+
+class SelectPoller(object):
+  """
+  a poller with the same interface as select.poll that uses select.select
+  """
+  def __init__(self):
+    """
+    initialize the instance
+    """
+    self.fds = {}
+
+  def register(self, fd, flags):
+    """
+    register a file descriptor
+    """
+    self.fds[fd] = flags
+
+  modify = register
+
+  def unregister(self, fd):
+    """
+    unregister a file descriptor
+    """
+    del self.fds[fd]
+
+  def poll(self, timeout=None):
+    """
+    poll the file descriptors, timeout is in seconds
+    """
+    rlist = [fd for fd in self.fds if self.fds[fd] & READFLAGS]
+    wlist = [fd for fd in self.fds if self.fds[fd] & WRITEFLAGS]
+    elist = self.fds.keys()
+    if not elist:
+      if timeout:
+        time.sleep(timeout)
+      return []
+    rlist, wlist, elist = select.select(rlist, wlist, elist, timeout)
+    events = {}
+    for fd in rlist:
+      events[fd] = events.get(fd, 0) | select.POLLIN
+    for fd in wlist:
+      events[fd] = events.get(fd, 0) | select.POLLOUT
+    for fd in elist:
+      events[fd] = events.get(fd, 0) | select.POLLPRI
+    return events.items()
+
+class Waker(asyncore.dispatcher):
+  """
+  a dispatcher that wakes the event loop up from other threads
+  """
+  def __init__(self, reactor, socketmap=None):
+    """
+    initialize the instance
+    """
+    self.reactor = reactor
+    rsock, self.wsock = socket.socketpair()
+    self.wsock.setblocking(0)
+    asyncore.dispatcher.__init__(self, rsock, map=socketmap)
+    self.lock = threading.Lock()
+    self.pending = []
+
+  def callsoon(self, func, **kwargs):
+    """
+    queue a function to be called in the event loop, can be called from
+    any thread
+    """
+    with self.lock:
+      self.pending.append((func, kwargs))
+    try:
+      self.wsock.send('x')
+    except socket.error:
+      # the socket buffer is full, so the loop will wake up anyway
+      pass
+
+  def writable(self):
+    """
+    the waker never has anything to write
+    """
+    return False
+
+  def handle_read(self):
+    """
+    run everything that was queued from other threads
+    """
+    try:
+      self.recv(4096)
+    except socket.error:
+      pass
+
+    with self.lock:
+      pending = self.pending
+      self.pending = []
+
+    for func, kwargs in pending:
+      try:
+        func(**kwargs)
+      except Exception: # pylint: disable=broad-except
+        self.reactor.api('send.traceback')('error in function %s' % func)
+
+  def handle_error(self):
+    """
+    show the traceback for an error in the waker
+    """
+    self.reactor.api('send.traceback')('Waker error:')
+
+class Executor(object):
+  """
+  a pool of worker threads to run blocking functions
+  """
+  def __init__(self, waker, maxworkers=4):
+    """
+    initialize the instance
+    """
+    self.waker = waker
+    self.maxworkers = maxworkers
+    self.workqueue = Queue.Queue()
+    self.workers = []
+    self.idle = 0
+    self.lock = threading.Lock()
+    self.submitted = 0
+    self.finished = 0
+
+  def submit(self, func, args=None, callback=None, errback=None):
+    """
+    run func(*args) in a worker thread
+
+    callback(result) or errback(exc_info) will be called in the
+    event loop when the function finishes
+    """
+    self.submitted = self.submitted + 1
+    with self.lock:
+      if not self.idle and len(self.workers) < self.maxworkers:
+        worker = threading.Thread(target=self.work,
+                                  name='bpworker%s' % len(self.workers))
+        worker.daemon = True
+        self.workers.append(worker)
+        worker.start()
+    self.workqueue.put((func, args or (), callback, errback))
+
+  def work(self):
+    """
+    the loop for a worker thread
+    """
+    while True:
+      with self.lock:
+        self.idle = self.idle + 1
+      func, args, callback, errback = self.workqueue.get()
+      with self.lock:
+        self.idle = self.idle - 1
+      try:
+        result = func(*args)
+      except Exception: # pylint: disable=broad-except
+        self.waker.callsoon(self.done, workfunc=func, errback=errback,
+                            excinfo=sys.exc_info())
+      else:
+        self.waker.callsoon(self.done, workfunc=func, callback=callback,
+                            result=result)
+
+  def done(self, workfunc, callback=None, result=None, errback=None,
+           excinfo=None):
+    """
+    called in the event loop after a worker finishes
+    """
+    self.finished = self.finished + 1
+    if excinfo:
+      if errback:
+        errback(excinfo)
+      else:
+        self.waker.reactor.api('send.error')(
+            'error in executor function %s: %s' % (workfunc, excinfo[1]))
+    elif callback:
+      callback(result)
+
+class Reactor(object):
+  """
+  an event loop for asyncore dispatchers
+  """
+  def __init__(self, backend=None, socketmap=None):
+    """
+    initialize the instance
+
+    optional:
+      backend   - 'epoll', 'poll' or 'select', defaults to the best available
+      socketmap - the map of dispatchers, defaults to asyncore.socket_map
+    """
+    self.api = API()
+    self.nextcall = self.api.handle('timers.nextcall')
+    self.map = asyncore.socket_map if socketmap is None else socketmap
+    self.backend = backend or defaultbackend()
+    if self.backend == 'epoll':
+      self.poller = select.epoll()
+    elif self.backend == 'poll':
+      self.poller = select.poll()
+    else:
+      self.poller = SelectPoller()
+
+    # fd : (dispatcher, flags)
+    self.registered = {}
+
+    # a heap of [when, sequence, function, args]
+    self.deadlines = []
+    self.sequence = 0
+
+    self.running = False
+    self.passes = 0
+    self.events = 0
+    self.timerraises = 0
+
+    # dispatchers to flush at the end of the pass
+    self.dirty = {}
+    self.flushes = 0
+    self.writerequests = 0
+    self.sendcalls = 0
+
+    self.waker = Waker(self, socketmap)
+    self.executor = Executor(self.waker)
+
+    self.api('managers.add')('reactor', self)
+    self.api('api.add')('reactor', 'calllater', self.calllater)
+    self.api('api.add')('reactor', 'cancel', self.cancel)
+    self.api('api.add')('reactor', 'runinexecutor', self.runinexecutor)
+
+  def calllater(self, seconds, func, *args):
+    """
+    call a function after a number of seconds (can be a float)
+
+    returns a handle that can be passed to cancel
+    """
+    self.sequence = self.sequence + 1
+    handle = [time.time() + seconds, self.sequence, func, args]
+    heapq.heappush(self.deadlines, handle)
+    return handle
+
+  def runinexecutor(self, func, args=None, callback=None, errback=None):
+    """
+    run a blocking function in a worker thread
+
+    required:
+      func     - the function to run
+    optional:
+      args     - a tuple of arguments for the function
+      callback - called in the event loop with the return value
+      errback  - called in the event loop with sys.exc_info() if the
+                  function raised an exception
+
+    the function must not use the api or touch sockets, it runs
+    outside of the event loop
+    """
+    self.executor.submit(func, args, callback, errback)
+
+  @staticmethod
+  def cancel(handle):
+    """
+    cancel a function scheduled with calllater
+    """
+    if handle:
+      handle[2] = None
+
+  def nexttimeout(self):
+    """
+    get the number of seconds until something needs to be done
+
+    returns None if there is nothing scheduled
+    """
+    # dispatchers that were still getting data when flushall gave up
+    # are flushed on the next pass
+    if self.dirty:
+      return 0
+
+    nextcall = None
+    while self.deadlines and self.deadlines[0][2] is None:
+      heapq.heappop(self.deadlines)
+    if self.deadlines:
+      nextcall = self.deadlines[0][0]
+
+    if self.nextcall.has():
+      timercall = self.nextcall()
+      if timercall is not None and (nextcall is None or timercall < nextcall):
+        nextcall = timercall
+
+    if nextcall is None:
+      return None
+
+    return max(nextcall - time.time(), 0)
+
+  def runcalllaters(self):
+    """
+    run the functions that are due
+    """
+    now = time.time()
+    while self.deadlines and self.deadlines[0][0] <= now:
+      _, _, func, args = heapq.heappop(self.deadlines)
+      if func:
+        try:
+          func(*args)
+        except Exception: # pylint: disable=broad-except
+          self.api('send.traceback')('error in scheduled function %s' % func)
+
+  def checktimers(self):
+    """
+    raise the global_timer event if a timer is due
+    """
+    if self.nextcall.has():
+      timercall = self.nextcall()
+      if timercall is None or timercall > time.time():
+        return
+
+    self.timerraises = self.timerraises + 1
+    self.api('events.eraise')('global_timer', {}, calledfrom="globaltimer")
+
+  def _unregister(self, fd):
+    """
+    unregister a file descriptor from the poller
+    """
+    del self.registered[fd]
+    try:
+      self.poller.unregister(fd)
+    except (IOError, OSError, KeyError, ValueError):
+      # the fd was closed, so epoll already forgot about it
+      pass
+
+  def updateregistrations(self):
+    """
+    sync the poller with the readable/writable state of the dispatchers
+    """
+    for fd in self.registered.keys():
+      if fd not in self.map or self.map[fd] is not self.registered[fd][0]:
+        self._unregister(fd)
+
+    for fd, obj in self.map.items():
+      flags = 0
+      if obj.readable():
+        flags |= READFLAGS
+      # accepting sockets should not be writable
+      if obj.writable() and not obj.accepting:
+        flags |= WRITEFLAGS
+      if flags:
+        # Only check for exceptions if object was either readable
+        # or writable.
+        flags |= ERRORFLAGS
+
+      if fd in self.registered:
+        if self.registered[fd][1] == flags:
+          continue
+        if not flags:
+          self._unregister(fd)
+          continue
+        try:
+          self.poller.modify(fd, flags)
+        except (IOError, OSError):
+          self.poller.register(fd, flags)
+        self.registered[fd] = (obj, flags)
+      elif flags:
+        self.poller.register(fd, flags)
+        self.registered[fd] = (obj, flags)
+
+  def poll(self, timeout):
+    """
+    poll the dispatchers and run the handlers for sockets with events
+
+    timeout is in seconds, None to wait until there is an event
+    """
+    self.updateregistrations()
+
+    if self.backend == 'epoll':
+      ptimeout = -1 if timeout is None else timeout
+    elif self.backend == 'poll':
+      ptimeout = None if timeout is None else int(timeout * 1000)
+    else:
+      ptimeout = timeout
+
+    try:
+      events = self.poller.poll(ptimeout)
+    except (IOError, OSError, select.error, socket.error) as err:
+      if err.args[0] != errno.EINTR:
+        raise
+      events = []
+
+    for fd, flags in events:
+      obj = self.map.get(fd)
+      if obj is None:
+        continue
+      self.events = self.events + 1
+      asyncore.readwrite(obj, flags)
+
+  def flushlater(self, obj):
+    """
+    flush a dispatcher at the end of this pass, called for each write
+    """
+    self.writerequests = self.writerequests + 1
+    self.dirty[id(obj)] = obj
+
+  def countsend(self):
+    """
+    count a send syscall
+    """
+    self.sendcalls = self.sendcalls + 1
+
+  def flushall(self):
+    """
+    flush the dispatchers that got data during this pass
+    """
+    # flushing can cause more writes (a close sends a message to the
+    # other clients), so loop a few times, what is left is flushed on
+    # the next pass
+    for _ in range(5):
+      if not self.dirty:
+        break
+      dirty = self.dirty
+      self.dirty = {}
+      for obj in dirty.values():
+        self.flushes = self.flushes + 1
+        try:
+          obj.flush()
+        except Exception: # pylint: disable=broad-except
+          obj.handle_error()
+
+  def runonce(self, timeout=None):
+    """
+    do a single pass of the loop
+    """
+    self.passes = self.passes + 1
+    self.poll(timeout)
+    self.runcalllaters()
+    self.checktimers()
+    self.flushall()
+
+  def run(self):
+    """
+    run the loop until the proxy is shutdown
+    """
+    self.running = True
+    try:
+      while not self.api.shutdown:
+        self.runonce(self.nexttimeout())
+    finally:
+      self.running = False
+
+  def getstats(self):
+    """
+    return stats for the reactor
+    """
+    return {'Backend':self.backend,
+            'Passes':self.passes,
+            'Events':self.events,
+            'Timer Checks':self.timerraises,
+            'Dispatchers':len(self.map),
+            'Write Requests':self.writerequests,
+            'Send Calls':self.sendcalls,
+            'Syscalls Saved':max(self.writerequests - self.sendcalls, 0),
+            'Executor Jobs':'%s/%s' % (self.executor.finished,
+                                       self.executor.submitted),
+            'Executor Threads':len(self.executor.workers)}
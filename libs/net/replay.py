@@ -0,0 +1,576 @@
+"""
+This module plays back a recorded mud session to benchmark the proxy
+
+The mud writes everything it reads to the rawmud log (data/logs/rawmud),
+each read with the time it happened. The replay loads the plugins into a
+scratch data directory, connects a Mud to a local socket that sends the
+recorded reads and attaches a number of fake clients that read whatever
+the proxy sends them.
+
+The reads are logged after they are decompressed, except the one that
+starts MCCP2, so the replay decompresses that read itself and the Mud it
+plays to does not handle MCCP2.
+
+usage: python -m libs.net.replay [-h] [-c CLIENTS] [-s SPEED] [-m]
+                                 [-d DATADIR] [-e {epoll,poll,select}]
+                                 capture [capture ...]
+
+  -c CLIENTS - the number of fake clients (default: 1)
+  -s SPEED   - 1 plays the reads at the recorded times, 2 twice as fast,
+                 0 as fast as possible: each read is sent when the proxy
+                 has read the one before it (default: 0)
+  -m         - the clients accept MCCP2
+  -d DATADIR - the data directory to load the plugins with, use a copy of
+                 data/ to replay with your plugins and settings
+                 (default: an empty temporary directory)
+
+The report has:
+  lines/sec        - lines from the mud per second of wall time
+  latency p50/p99  - per line, from the read of the mud data to the last
+                       client write that had it
+  cpu by plugin    - the cpu time of the functions each plugin registered
+                       to events, not counting events they raised
+"""
+from __future__ import print_function
+import asyncore
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
+
+import libs.argp as argp
+from libs.api import API as BASEAPI
+from libs.net.reactor import Reactor, BACKENDS, defaultbackend
+from libs.net.telnetlib import IAC, WILL, DO, SB, SE
+# import io so we can add the "send" functions to the api
+from libs import io      # pylint: disable=unused-import
+
+API = BASEAPI()
+
+MCCP2 = chr(86)
+STARTSTREAM = IAC + SB + MCCP2 + IAC + SE
+
+# a line in a rawmud log, the log timestamp is optional
+RECORDRE = re.compile(r'^(?:\w+ \w+ \d+ \d+ [\d:]+ : )?(\d+\.\d+) (.*)$')
+
+# stop if nothing happened for this many seconds
+IDLETIMEOUT = 10
+
+
+def readcapture(filenames):
+  """
+  read the reads from rawmud logs, returns a list of (time, data) and
+  the number of lines that were skipped
+  """
+  reads = []
+  skipped = 0
+  for filename in filenames:
+    with open(filename, 'r') as fileobj:
+      for line in fileobj:
+        match = RECORDRE.match(line.rstrip('\n'))
+        if not match:
+          skipped = skipped + 1
+          continue
+        try:
+          data = match.group(2).decode('string_escape')
+        except ValueError:
+          skipped = skipped + 1
+          continue
+        if data:
+          reads.append((float(match.group(1)), data))
+
+  return uncompressreads(reads), skipped
+
+
+def uncompressreads(reads):
+  """
+  the mud logs its reads after they are decompressed, except the read
+  that starts MCCP2, which is logged as it came from the socket with the
+  compressed data after the start of the stream, decompress that data so
+  the whole capture is plain text
+
+  the start of the stream can be split across two reads, then the second
+  one is logged as it came from the socket
+  """
+  newreads = []
+  previous = ''
+  for rtime, data in reads:
+    # the end of the previous read, for a start that was split
+    tail = previous[-(len(STARTSTREAM) - 1):]
+    previous = data
+    i = (tail + data).find(STARTSTREAM)
+    if i != -1:
+      i = i + len(STARTSTREAM) - len(tail)
+      decomp = zlib.decompressobj(15)
+      try:
+        data = data[:i] + decomp.decompress(data[i:]) + decomp.unused_data
+      except zlib.error:
+        pass
+    newreads.append((rtime, data))
+
+  return newreads
+
+
+def socketpair():
+  """
+  a connected pair of local tcp sockets, so the proxy sets TCP_NODELAY
+  and cork on them as it does with a real connection
+  """
+  listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  listener.bind(('127.0.0.1', 0))
+  listener.listen(1)
+  first = socket.create_connection(listener.getsockname())
+  second, _ = listener.accept()
+  listener.close()
+  first.setblocking(0)
+  second.setblocking(0)
+  return first, second
+
+
+def percentile(latencies, fraction):
+  """
+  the latency below which a fraction of the lines are, latencies is a
+  sorted list of (latency, number of lines)
+  """
+  total = sum(i[1] for i in latencies)
+  if not total:
+    return 0
+  needed = fraction * total
+  count = 0
+  for latency, lines in latencies:
+    count = count + lines
+    if count >= needed:
+      return latency
+  return latencies[-1][0]
+
+
+class Feeder(asyncore.dispatcher):
+  """
+  the mud end of the connection, sends the recorded reads
+  """
+  def __init__(self, sock, reads, speed, replay):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self, sock)
+    self.reads = deque(reads)
+    self.speed = speed
+    self.replay = replay
+    self.buffer = ''
+    self.sent = 0
+    self.first = reads[0][0] if reads else 0
+    self.start = None
+
+  def nextdue(self):
+    """
+    the seconds until the next read is due, None if there are none left
+    or the reads are not timed
+    """
+    if not self.reads or not self.speed:
+      # as fast as possible waits for the proxy to read, so the loop
+      # waits on the sockets
+      return None
+    due = self.start + (self.reads[0][0] - self.first) / self.speed
+    return max(due - time.time(), 0)
+
+  def readable(self):
+    """
+    read what the proxy sends to the mud
+    """
+    return True
+
+  def writable(self):
+    """
+    check if there is a read to send
+    """
+    if not self.buffer and self.reads:
+      if self.speed:
+        ready = self.nextdue() == 0
+      else:
+        # one read at a time, so the proxy gets the data in the same
+        # pieces it got it from the mud
+        ready = self.replay.mudbytes >= self.sent
+      if ready:
+        self.buffer = self.reads.popleft()[1]
+    return bool(self.buffer)
+
+  def handle_write(self):
+    """
+    send the current read
+    """
+    sent = self.send(self.buffer)
+    self.buffer = self.buffer[sent:]
+    self.sent = self.sent + sent
+
+  def handle_read(self):
+    """
+    throw away what the proxy sends
+    """
+    self.recv(65536)
+
+  def handle_close(self):
+    """
+    the proxy closed the connection
+    """
+    self.close()
+
+
+class FakeClient(asyncore.dispatcher):
+  """
+  the client end of a connection, reads what the proxy sends
+  """
+  def __init__(self, sock, mccp):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self, sock)
+    self.mccp = mccp
+    self.buffer = ''
+    self.received = 0
+
+  def writable(self):
+    """
+    only answers to options are sent
+    """
+    return bool(self.buffer)
+
+  def handle_write(self):
+    """
+    send the answers
+    """
+    sent = self.send(self.buffer)
+    self.buffer = self.buffer[sent:]
+
+  def handle_read(self):
+    """
+    read and count the data
+    """
+    data = self.recv(65536)
+    self.received = self.received + len(data)
+    if self.mccp and IAC + WILL + MCCP2 in data:
+      self.buffer = self.buffer + IAC + DO + MCCP2
+
+  def handle_close(self):
+    """
+    the proxy closed the connection
+    """
+    self.close()
+
+
+class PluginTimer(object):
+  """
+  add up the cpu time of the event functions of each plugin
+  """
+  def __init__(self):
+    """
+    initialize the instance
+    """
+    self.times = {}
+    self.stack = []
+    self.original = None
+    self.efuncclass = None
+
+  def start(self, efuncclass):
+    """
+    start timing the execute method of the event function class
+    """
+    self.efuncclass = efuncclass
+    self.original = efuncclass.__dict__['execute']
+    timer = self
+    original = self.original
+
+    def execute(efunc, args):
+      """
+      time an event function
+      """
+      timer.stack.append(0.0)
+      start = time.clock()
+      try:
+        return original(efunc, args)
+      finally:
+        elapsed = time.clock() - start
+        inner = timer.stack.pop()
+        # functions from the mud and the clients have no plugin
+        plugin = efunc.funcplugin or '(no plugin)'
+        timer.times[plugin] = timer.times.get(plugin, 0) + elapsed - inner
+        if timer.stack:
+          timer.stack[-1] = timer.stack[-1] + elapsed
+
+    efuncclass.execute = execute
+
+  def stop(self):
+    """
+    stop timing
+    """
+    if self.efuncclass:
+      self.efuncclass.execute = self.original
+      self.efuncclass = None
+
+
+class Replay(object):
+  """
+  play back reads from the mud through the proxy
+  """
+  def __init__(self, reads, clients=1, speed=0, mccp=False, engine=None):
+    """
+    initialize the instance
+    """
+    self.reads = reads
+    self.numclients = clients
+    self.speed = speed
+    self.mccp = mccp
+    self.engine = engine
+    self.reactor = None
+    self.mud = None
+    self.feeder = None
+    self.clients = []
+    self.fakeclients = []
+    self.pending = deque()
+    self.latencies = {}
+    self.mudbytes = 0
+    self.lines = 0
+    self.lastactivity = 0
+    self.timer = PluginTimer()
+
+  def setup(self):
+    """
+    create the reactor, the mud and the clients
+    """
+    from libs.net.mud import Mud, CONNECTED
+    from libs.net.client import Client, CONNECTED as LOGGEDIN
+
+    self.reactor = Reactor(backend=self.engine)
+
+    self.mud = Mud()
+    # the capture is plain text, so the mud must not start decompressing
+    # when it sees the start of an MCCP2 stream
+    self.mud.option_handlers.pop(ord(MCCP2), None)
+    mudsock, feedsock = socketpair()
+    self.mud.set_socket(mudsock)
+    self.mud.host = '127.0.0.1'
+    self.mud.port = feedsock.getsockname()[1]
+    self.mud.connstate = CONNECTED
+    self.mud.handle_connect()
+    self.feeder = Feeder(feedsock, self.reads, self.speed, self)
+
+    original = self.mud.fill_rawq
+    def fill_rawq():
+      """
+      note the time and the lines of each read
+      """
+      buf = original()
+      if buf:
+        self.mudbytes = self.mudbytes + len(buf)
+        lines = buf.count('\n')
+        self.lines = self.lines + lines
+        if lines:
+          self.pending.append((time.time(), lines))
+      return buf
+    self.mud.fill_rawq = fill_rawq
+
+    password = API('proxy.proxypw')()
+    for _ in range(self.numclients):
+      proxysock, clientsock = socketpair()
+      self.fakeclients.append(FakeClient(clientsock, self.mccp))
+      client = Client(proxysock, '127.0.0.1', clientsock.getsockname()[1])
+      client.feed(password + '\r\n')
+      client.lastdrain = 0
+      self.watchclient(client)
+      self.clients.append(client)
+
+    if [i for i in self.clients if i.state != LOGGEDIN]:
+      raise ValueError('the fake clients could not login')
+
+  @staticmethod
+  def isdrained(client):
+    """
+    check if a client has been sent everything
+    """
+    return not (client.pending or client.outbuffer or client.backlog)
+
+  def watchclient(self, client):
+    """
+    note when a client has been sent everything
+    """
+    original = client.handle_write
+    def handle_write():
+      """
+      write and check if the client is drained
+      """
+      sent = original()
+      if self.isdrained(client):
+        client.lastdrain = time.time()
+      return sent
+    client.handle_write = handle_write
+
+  def checkpending(self):
+    """
+    reads that came before every client was drained are done, their
+    lines took until the last write
+    """
+    if not self.pending:
+      return
+    for client in self.clients:
+      if not self.isdrained(client):
+        return
+    lastdrain = max(i.lastdrain for i in self.clients)
+    while self.pending:
+      readtime, lines = self.pending.popleft()
+      latency = max(lastdrain - readtime, 0)
+      # bucket by 10 microseconds
+      bucket = round(latency, 5)
+      self.latencies[bucket] = self.latencies.get(bucket, 0) + lines
+
+  def finished(self):
+    """
+    check if all reads were sent and handled
+    """
+    return not self.feeder.reads and not self.feeder.buffer and \
+        self.mudbytes >= self.feeder.sent and not self.pending
+
+  def run(self):
+    """
+    run the replay and return the results
+    """
+    import plugins.core.events
+    self.timer.start(plugins.core.events.EFunc)
+
+    self.feeder.start = time.time()
+    self.lastactivity = time.time()
+    startcpu = time.clock()
+    starttime = time.time()
+    lastbytes = 0
+
+    try:
+      while not self.finished():
+        timeout = self.reactor.nexttimeout()
+        due = self.feeder.nextdue()
+        if due is not None and (timeout is None or due < timeout):
+          timeout = due
+        self.reactor.runonce(min(timeout, 1) if timeout is not None else 1)
+        self.checkpending()
+        if self.mudbytes != lastbytes:
+          lastbytes = self.mudbytes
+          self.lastactivity = time.time()
+        elif time.time() - self.lastactivity > IDLETIMEOUT:
+          print('replay: nothing happened for %s seconds, stopping' % \
+                  IDLETIMEOUT)
+          break
+    finally:
+      self.timer.stop()
+
+    walltime = time.time() - starttime
+    cputime = time.clock() - startcpu
+    return {'walltime':walltime,
+            'cputime':cputime,
+            'lines':self.lines,
+            'bytes':self.mudbytes,
+            'received':sum(i.received for i in self.fakeclients),
+            'latencies':sorted(self.latencies.items()),
+            'plugins':self.timer.times}
+
+
+def report(results, reads, clients, speed):
+  """
+  format the results of a replay
+  """
+  tmsg = []
+  walltime = results['walltime'] or 1e-9
+  tmsg.append('%-20s : %s' % ('Reads', len(reads)))
+  tmsg.append('%-20s : %s' % ('Lines', results['lines']))
+  tmsg.append('%-20s : %s' % ('Bytes from mud', results['bytes']))
+  tmsg.append('%-20s : %s' % ('Bytes to clients', results['received']))
+  tmsg.append('%-20s : %s' % ('Clients', clients))
+  tmsg.append('%-20s : %s' % ('Speed', speed or 'as fast as possible'))
+  tmsg.append('%-20s : %.3f s' % ('Wall time', results['walltime']))
+  tmsg.append('%-20s : %.3f s' % ('CPU time', results['cputime']))
+  tmsg.append('%-20s : %.0f' % ('Lines/sec', results['lines'] / walltime))
+  tmsg.append('%-20s : %.3f ms' % \
+                ('Latency p50', percentile(results['latencies'], .5) * 1000))
+  tmsg.append('%-20s : %.3f ms' % \
+                ('Latency p99', percentile(results['latencies'], .99) * 1000))
+  tmsg.append('')
+  tmsg.append('%-20s : %-10s : %s' % ('Plugin', 'CPU (s)', '% of CPU'))
+  tmsg.append('-' * 45)
+  cputime = results['cputime'] or 1e-9
+  intotal = 0
+  for plugin, ptime in sorted(results['plugins'].items(),
+                              key=lambda x: x[1], reverse=True):
+    intotal = intotal + ptime
+    tmsg.append('%-20s : %-10.4f : %.1f' % (plugin, ptime,
+                                            ptime * 100 / cputime))
+  tmsg.append('%-20s : %-10.4f : %.1f' % ('(proxy)', cputime - intotal,
+                                          (cputime - intotal) * 100 / cputime))
+  return tmsg
+
+
+def main():
+  """
+  load the plugins and replay the captures
+  """
+  parser = argp.ArgumentParser(description='replay a recorded mud session')
+  parser.add_argument('capture',
+                      help='a rawmud log',
+                      nargs='+')
+  parser.add_argument('-c', '--clients',
+                      help='the number of fake clients',
+                      type=int,
+                      default=1)
+  parser.add_argument('-s', '--speed',
+                      help='1 for the recorded speed, 0 for as fast as ' \
+                            'possible',
+                      type=float,
+                      default=0)
+  parser.add_argument('-m', '--mccp',
+                      help='the clients accept MCCP2',
+                      action='store_true')
+  parser.add_argument('-d', '--datadir',
+                      help='the data directory for the plugins',
+                      default=None)
+  parser.add_argument('-e', "--engine",
+                      help="the event loop backend to use",
+                      choices=BACKENDS,
+                      default=defaultbackend())
+  targs = vars(parser.parse_args())
+
+  reads, skipped = readcapture(targs['capture'])
+  if skipped:
+    print('replay: skipped %s lines that are not reads' % skipped)
+  if not reads:
+    print('replay: no reads found')
+    return 1
+
+  BASEAPI.BASEPATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                  os.pardir, os.pardir))
+  if targs['datadir']:
+    BASEAPI.DATAPATH = os.path.abspath(targs['datadir'])
+  else:
+    BASEAPI.DATAPATH = tempfile.mkdtemp(prefix='bpreplay')
+  BASEAPI.loading = True
+
+  try:
+    from plugins import PluginMgr
+    pluginmgr = PluginMgr()
+    pluginmgr.load()
+    BASEAPI.loading = False
+
+    replay = Replay(reads, targs['clients'], targs['speed'], targs['mccp'],
+                    targs['engine'])
+    replay.setup()
+    results = replay.run()
+    API('proxy.shutdown')()
+  finally:
+    if not targs['datadir']:
+      shutil.rmtree(BASEAPI.DATAPATH, ignore_errors=True)
+
+  print('\n'.join(report(results, reads, targs['clients'], targs['speed'])))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,502 @@
+"""
+This module holds the supervisor that runs more than one session
+
+A session is one mud character: a worker process with its own plugins,
+settings and data directory (data/sessions/<name>). The supervisor
+listens on the proxy port and asks a new client for the session and the
+proxy password ("name password"). The client socket is then passed to
+the worker with SCM_RIGHTS over a unix datagram socket, along with what
+the client sent after the session name, and the worker takes over the
+connection. Both ends of the channel are non-blocking dispatchers, the
+supervisor queues clients for a worker that is not reading and the worker
+keeps the info of a client until its file descriptor arrives, so neither
+can stall the other.
+
+Workers are forked after the plugin modules the sessions use have been
+imported, so the libraries they pull in and their module level data are
+loaded once and shared. Each worker is its own process, so the sessions are
+spread over the cores. A worker that exits is started again.
+
+The supervisor does not load plugins or use the api, it only moves
+connections to the workers.
+"""
+from __future__ import print_function
+import asyncore
+import errno
+import os
+import pickle
+import re
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from _multiprocessing import sendfd, recvfd
+
+import libs.imputils as imputils
+from libs.persistentdict import PersistentDict
+
+# the seconds a client has to pick a session
+LOGINTIMEOUT = 60
+
+# the tries a client gets to pick a session
+LOGINTRIES = 3
+
+# the seconds to wait before starting a worker that exited again
+RESTARTDELAY = 5
+
+# the seconds workers have to exit on their own when stopping
+STOPWAIT = 10
+
+# telnet sequences in what a client sends before picking a session
+TELNETRE = re.compile('\xff\xfa.*?\xff\xf0|\xff[\xfb-\xfe].|\xff.', re.DOTALL)
+
+PROMPT = '#BP: Please enter the session and the proxy password:\r\n'
+
+
+class WorkerChannel(asyncore.dispatcher):
+  """
+  the supervisor end of the channel to a worker
+
+  clients are queued and sent when the channel is writable, so a worker
+  that is not reading its channel does not stop the supervisor
+  """
+  def __init__(self, supervisor, name, sock):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self, sock)
+    self.supervisor = supervisor
+    self.name = name
+    # [info datagram or None once it is sent, socket, host, port, time]
+    self.queue = []
+    self.closed = False
+
+  def queueclient(self, sock, host, port, data):
+    """
+    queue a client socket and what it has sent so far for the worker
+    """
+    self.queue.append([pickle.dumps({'host':host, 'port':port,
+                                     'data':data}, 2),
+                       sock, host, port, time.time()])
+
+  def readable(self):
+    """
+    nothing is read from a worker
+    """
+    return False
+
+  def writable(self):
+    """
+    write when there are clients for the worker
+    """
+    return bool(self.queue)
+
+  def handle_write(self):
+    """
+    send the info and then the file descriptor of each queued client
+    """
+    while self.queue:
+      item = self.queue[0]
+      try:
+        if item[0]:
+          self.socket.send(item[0])
+          item[0] = None
+        sendfd(self.socket.fileno(), item[1].fileno())
+      except (socket.error, OSError) as err:
+        if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+          return
+        self.dropclient(err)
+        continue
+      self.queue.pop(0)
+      item[1].close()
+      self.supervisor.log('%s:%s connected to session %s' % \
+                              (item[2], item[3], self.name))
+
+  def dropclient(self, reason):
+    """
+    close the first queued client
+    """
+    item = self.queue.pop(0)
+    item[1].close()
+    self.supervisor.log('could not pass %s:%s to session %s: %s' % \
+                            (item[2], item[3], self.name, reason))
+
+  def expire(self):
+    """
+    close clients the worker has not taken in time, the first one can
+    have had its info sent, the worker drops that info when the info of
+    the next client arrives
+    """
+    while self.queue and time.time() - self.queue[0][4] > LOGINTIMEOUT:
+      self.dropclient('the session did not take it in time')
+
+  def handle_close(self):
+    """
+    the worker end was closed
+    """
+    self.close()
+
+  def handle_error(self):
+    """
+    drop the client that was being sent on an error
+    """
+    if self.queue:
+      self.dropclient(sys.exc_info()[1])
+
+  def close(self):
+    """
+    close the channel and the clients that were not sent
+    """
+    for item in self.queue:
+      item[1].close()
+    self.queue = []
+    self.closed = True
+    asyncore.dispatcher.close(self)
+
+
+class ClientReceiver(object):
+  """
+  receive clients from the supervisor on the worker end of a non-blocking
+  channel, the info and the file descriptor of a client can arrive in
+  separate reads
+
+  the supervisor can drop a client after its info was sent and before its
+  file descriptor was, so each datagram is looked at before it is read:
+  sendfd sends a single byte with the file descriptor, the info is always
+  longer. Info that is not followed by a file descriptor is replaced by
+  the info of the next client, a file descriptor without info is closed.
+  """
+  def __init__(self, channel):
+    """
+    initialize the instance
+    """
+    self.channel = channel
+    self.info = None
+
+  def receive(self):
+    """
+    receive what is waiting on the channel, returns a list of the info
+    dictionary and the socket of each client
+    """
+    clients = []
+    while True:
+      try:
+        data = self.channel.recv(65536, socket.MSG_PEEK)
+        if len(data) > 1:
+          self.channel.recv(65536)
+          try:
+            self.info = pickle.loads(data)
+          except (EOFError, KeyError, ValueError, pickle.UnpicklingError):
+            self.info = None
+          continue
+        fd = recvfd(self.channel.fileno())
+      except (socket.error, OSError):
+        # nothing is waiting or the supervisor is gone
+        return clients
+      except RuntimeError:
+        # a datagram without a file descriptor
+        continue
+      if self.info is None:
+        os.close(fd)
+        continue
+      sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+      os.close(fd)
+      clients.append((self.info, sock))
+      self.info = None
+
+
+class LoginClient(asyncore.dispatcher):
+  """
+  a client that has not picked a session yet
+  """
+  def __init__(self, supervisor, sock, host, port):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self, sock)
+    self.supervisor = supervisor
+    self.host = host
+    self.port = port
+    self.buffer = ''
+    self.tries = 0
+    self.started = time.time()
+    self.outbuffer = ''
+    if len(supervisor.sessions) == 1:
+      self.handoff(list(supervisor.sessions)[0], '')
+    else:
+      self.outbuffer = PROMPT
+
+  def writable(self):
+    """
+    write the prompt
+    """
+    return bool(self.outbuffer)
+
+  def handle_write(self):
+    """
+    send what is left of the prompt
+    """
+    sent = self.send(self.outbuffer)
+    self.outbuffer = self.outbuffer[sent:]
+
+  def handle_read(self):
+    """
+    read until the client has sent a line
+    """
+    data = self.recv(4096)
+    if not data:
+      return
+    self.buffer = self.buffer + data
+    if len(self.buffer) > 4096:
+      self.close()
+      return
+    while '\n' in self.buffer and self.socket:
+      line, self.buffer = self.buffer.split('\n', 1)
+      telnet = ''.join(TELNETRE.findall(line))
+      words = TELNETRE.sub('', line).strip().split(None, 1)
+      if words and words[0] in self.supervisor.sessions:
+        rest = words[1] + '\r\n' if len(words) > 1 else ''
+        self.handoff(words[0], telnet + rest + self.buffer)
+        return
+      self.tries = self.tries + 1
+      if self.tries >= LOGINTRIES:
+        self.close()
+        return
+      self.buffer = telnet + self.buffer
+      self.outbuffer = self.outbuffer + '#BP: Unknown session\r\n' + PROMPT
+
+  def handoff(self, name, data):
+    """
+    pass the connection to the worker for a session
+    """
+    channel = self.supervisor.sessions[name]['channel']
+    if channel and not channel.closed:
+      # the channel keeps its own copy of the socket until it is sent
+      channel.queueclient(socket.fromfd(self.socket.fileno(),
+                                        socket.AF_INET, socket.SOCK_STREAM),
+                          self.host, self.port, data)
+    else:
+      self.supervisor.log('could not pass %s:%s to session %s' % \
+                              (self.host, self.port, name))
+    self.close()
+
+  def handle_close(self):
+    """
+    the client left before picking a session
+    """
+    self.close()
+
+  def handle_error(self):
+    """
+    drop the client on an error
+    """
+    self.supervisor.log('error with client %s:%s: %s' % \
+                            (self.host, self.port, sys.exc_info()[1]))
+    self.close()
+
+
+class SessionListener(asyncore.dispatcher):
+  """
+  listen for clients for the supervisor
+  """
+  def __init__(self, supervisor, port):
+    """
+    initialize the instance
+    """
+    asyncore.dispatcher.__init__(self)
+    self.supervisor = supervisor
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind(("", port))
+    self.listen(50)
+
+  def handle_accept(self):
+    """
+    accept a new client
+    """
+    pair = self.accept()
+    if pair:
+      sock, addr = pair
+      LoginClient(self.supervisor, sock, addr[0], addr[1])
+
+
+class Supervisor(object):
+  """
+  run a worker process for each session and pass clients to them
+  """
+  def __init__(self, port, names, runworker, basepath):
+    """
+    initialize the instance
+
+    required:
+      port      - the port to listen on
+      names     - the names of the sessions
+      runworker - called in a new worker process with the name of the
+                    session and the file descriptor of its channel,
+                    does not return
+      basepath  - the directory bastproxy is in
+    """
+    self.port = port
+    self.runworker = runworker
+    self.basepath = basepath
+    self.sessions = {}
+    for name in names:
+      self.sessions[name] = {'pid':None, 'channel':None, 'exited':0}
+    self.listener = None
+    self.running = False
+
+  def log(self, msg):
+    """
+    print a message
+    """
+    print('%s - supervisor : %s' % \
+            (time.strftime('%a %b %d %Y %H:%M:%S', time.localtime()), msg))
+
+  def preload(self):
+    """
+    import the plugin modules the sessions load so the workers share them
+    """
+    modules = set()
+    for name in self.sessions:
+      filename = os.path.join(self.basepath, 'data', 'sessions', name,
+                              'plugins', 'loadedplugins.txt')
+      if os.path.exists(filename):
+        modules.update(PersistentDict(filename, 'r').keys())
+
+    for modpath in modules:
+      imploc, _ = imputils.get_module_name(modpath)
+      try:
+        __import__('plugins.' + imploc)
+      except Exception: # pylint: disable=broad-except
+        self.log('could not preload %s' % imploc)
+
+    # the plugin manager loads a plugin only if its module has not been
+    # imported, so only what the plugins imported is kept
+    for modname in list(sys.modules):
+      if modname.startswith('plugins.') and sys.modules[modname] and \
+          'SNAME' in sys.modules[modname].__dict__:
+        imputils.deletemodule(modname)
+    self.log('preloaded %s plugin modules' % len(modules))
+
+  def startworker(self, name):
+    """
+    fork a worker for a session
+    """
+    session = self.sessions[name]
+    if session['channel']:
+      session['channel'].close()
+    channel, workerchannel = socket.socketpair(socket.AF_UNIX,
+                                               socket.SOCK_DGRAM)
+    pid = os.fork()
+    if pid == 0:
+      # the worker keeps only its end of the channel
+      for obj in list(asyncore.socket_map.values()):
+        obj.close()
+      for other in self.sessions.values():
+        if other['channel']:
+          other['channel'].close()
+      channel.close()
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      try:
+        self.runworker(name, workerchannel.fileno())
+      except Exception: # pylint: disable=broad-except
+        traceback.print_exc()
+      finally:
+        sys.stdout.flush()
+        os._exit(0) # pylint: disable=protected-access
+
+    workerchannel.close()
+    session['pid'] = pid
+    session['channel'] = WorkerChannel(self, name, channel)
+    self.log('started session %s with pid %s' % (name, pid))
+
+  def reap(self):
+    """
+    start workers that exited again
+    """
+    while True:
+      try:
+        pid, _ = os.waitpid(-1, os.WNOHANG)
+      except OSError as err:
+        if err.errno == errno.ECHILD:
+          return
+        raise
+      if not pid:
+        break
+      for name in self.sessions:
+        if self.sessions[name]['pid'] == pid:
+          self.log('session %s exited' % name)
+          self.sessions[name]['pid'] = None
+          self.sessions[name]['exited'] = time.time()
+
+    if not self.running:
+      return
+    for name in self.sessions:
+      session = self.sessions[name]
+      if not session['pid'] and \
+          time.time() - session['exited'] >= RESTARTDELAY:
+        self.startworker(name)
+
+  def expirelogins(self):
+    """
+    close clients that did not pick a session in time or that a
+    session did not take in time
+    """
+    for obj in asyncore.socket_map.values():
+      if isinstance(obj, LoginClient) and \
+          time.time() - obj.started > LOGINTIMEOUT:
+        obj.close()
+      elif isinstance(obj, WorkerChannel):
+        obj.expire()
+
+  def interrupted(self, signum, frame): # pylint: disable=unused-argument
+    """
+    stop on SIGTERM
+    """
+    raise KeyboardInterrupt
+
+  def run(self):
+    """
+    start the workers and pass clients to them until interrupted
+    """
+    signal.signal(signal.SIGTERM, self.interrupted)
+    self.preload()
+    self.listener = SessionListener(self, self.port)
+    self.running = True
+    for name in self.sessions:
+      self.startworker(name)
+    self.log('listening on %s for sessions: %s' % \
+                (self.port, ', '.join(sorted(self.sessions))))
+
+    try:
+      while self.running:
+        asyncore.loop(timeout=1, count=1)
+        self.reap()
+        self.expirelogins()
+    except KeyboardInterrupt:
+      pass
+
+    self.stop()
+
+  def stop(self):
+    """
+    stop the workers, a ctrl-c in a terminal has already interrupted
+    them, so they get STOPWAIT seconds to exit on their own
+    """
+    self.running = False
+    self.listener.close()
+    end = time.time() + STOPWAIT
+    while time.time() < end and \
+        [i for i in self.sessions.values() if i['pid']]:
+      time.sleep(.1)
+      self.reap()
+    for name in self.sessions:
+      if self.sessions[name]['pid']:
+        try:
+          os.kill(self.sessions[name]['pid'], signal.SIGINT)
+          os.waitpid(self.sessions[name]['pid'], 0)
+        except OSError:
+          pass
+    self.log('all sessions stopped')
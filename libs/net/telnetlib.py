@@ -8,9 +8,13 @@ J. Reynolds
 from __future__ import print_function
 
 import asyncore
+import errno
+import fcntl
+import os
 import socket
 
 from libs.api import API
+from libs.net.outbuffer import OutBuffer
 
 __all__ = ["Telnet"]
 
@@ -23,6 +27,15 @@ DEBUGLEVEL = 3
 # Telnet protocol defaults
 TELNET_PORT = 23
 
+# the read size starts at READSIZE and doubles up to MAXREADSIZE while
+# reads fill it, it shrinks back to MINREADSIZE when they don't
+READSIZE = 4096
+MINREADSIZE = 1024
+MAXREADSIZE = 65536
+
+# the most bytes to read in one handle_read so other sockets get a turn
+MAXREAD = 262144
+
 # Telnet protocol characters (don't change)
 IAC = chr(255) # "Interpret As Command"
 DONT = chr(254)
@@ -42,6 +55,17 @@ EC = chr(247)  # Erase Character
 EL = chr(248)  # Erase Line
 GA = chr(249)  # Go Ahead
 SB = chr(250)  # Subnegotiation Begin
+ENDREC = chr(239)  # End of Record, sent after a prompt when EOR is on
+
+NEGOTIATE = (DO, DONT, WILL, WONT)
+
+# states for the telnet parser
+TN_DATA = 0      # plain text
+TN_IAC = 1       # after an IAC
+TN_OPTION = 2    # after IAC DO/DONT/WILL/WONT, waiting for the option
+TN_SBOPTION = 3  # after IAC SB, waiting for the option
+TN_SB = 4        # in a subnegotiation
+TN_SBIAC = 5     # after an IAC in a subnegotiation
 
 
 # Telnet protocol options code (don't change)
@@ -116,8 +140,9 @@ CODES = {255: "IAC",
          251: "WILL",
          250: "SB",
          249: "GA",
+         241: "NOP",
          240: "SE",
-         239: "TELOPT_EOR",
+         239: "EOR",
          0:   "<IS>",
          1:   "[<ECHO> or <SEND/MODE>]",
          3:   "<SGA>",
@@ -176,14 +201,33 @@ class Telnet(asyncore.dispatcher):
     self.cookedq = ''
     self.eof = 0
     self.sbdataq = ''
-    self._sbdatabuffer = ''
-    self.outbuffer = ''
+    self.readsize = READSIZE
+    self.readevents = 0
+    self.reads = 0
+    self.bytesread = 0
+    self.tnstate = TN_DATA
+    self.tncommand = None
+    self.sboption = None
+    self.sbparts = []
+    self.outbuffer = OutBuffer()
+    # data added since the last flush, converted and moved to the
+    # outbuffer once per pass of the reactor
+    self.pending = []
+    self.pendingsize = 0
+    self.reactor = self.api('managers.getm')('reactor')
+    self.cork = False
     self.options = {}
     self.option_callback = self.handleopt
     self.option_handlers = {}
     self.connected = False
     self.ttype = 'Unknown'
     self.debug_types = []
+    # set while a connection from a hot restart is being restored,
+    # the option handlers don't offer themselves again
+    self.restoring = False
+
+    if sock:
+      self.setnodelay(True)
 
   @staticmethod
   def ccode(newchar):
@@ -208,7 +252,7 @@ class Telnet(asyncore.dispatcher):
 
     if ord(option) in self.option_handlers:
       self.msg('calling handleopt for: %s' % optstr, mtype='OPTION')
-      self.option_handlers[ord(option)].handleopt(command, data)
+      return self.option_handlers[ord(option)].handleopt(command, data)
     elif command == WILL:
       self.msg('Sending IAC WONT %s' % optstr, mtype='OPTION')
       self.send("".join([IAC, WONT, option]))
@@ -229,20 +273,29 @@ class Telnet(asyncore.dispatcher):
       else:
         self.msg('should look at the sbdataq: %s' % self.sbdataq, mtype='OPTION')
 
+    return False
+
   def readdatafromsocket(self):
     """
-    read 1024 bytes from the socket
+    read up to readsize bytes from the socket
+
+    returns '' if there is nothing to read and None if the connection
+    was closed
     """
     try:
-      buf = self.recv(1024)
-      self.msg("recv %r" % buf)
-      return buf
+      buf = self.recv(self.readsize)
     except socket.error as err:  # pylint: disable=broad-except
+      if err.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EINTR):
+        return ''
       if err.args[0] == 110:
         self.connected = False
       self.handle_error()
+      return None
 
-    return None
+    if not buf:
+      return None
+
+    return buf
 
   def __del__(self):
     """
@@ -279,6 +332,9 @@ class Telnet(asyncore.dispatcher):
   def doconnect(self, hostname, hostport):
     """
     connect to a host and port
+
+    the socket is non blocking, handle_connect is called when the
+    connection has been established
     """
     self.host = hostname
     self.port = hostport
@@ -286,7 +342,15 @@ class Telnet(asyncore.dispatcher):
     self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
     self.set_reuse_addr()
     self.connect((self.host, self.port))
+
+  def handle_connect(self):
+    """
+    the connection has been established
+    """
+    self.msg('connected')
     self.connected = True
+    self.eof = 0
+    self.setnodelay(True)
     for i in self.option_handlers:
       self.option_handlers[i].onconnect()
 
@@ -299,14 +363,36 @@ class Telnet(asyncore.dispatcher):
     self.close()
     self.options = {}
     self.eof = 1
+    self.resetparser()
 
   def handle_write(self):
     """
-    write to a connection
+    write to a connection, returns the number of bytes sent
+    """
+    self.msg('Handle_write: %s bytes' % len(self.outbuffer))
+    if hasattr(self.socket, 'sendmsg'):
+      sent = self.sendmsg(self.outbuffer.views())
+    else:
+      sent = self.send(self.outbuffer.peek())
+    self.outbuffer.consume(sent)
+    if self.reactor:
+      self.reactor.countsend()
+    return sent
+
+  def sendmsg(self, buffers):
+    """
+    send a list of buffers with one call, handles errors the same
+    way as asyncore.dispatcher.send
     """
-    self.msg('Handle_write: %s' % self.outbuffer)
-    sent = self.send(self.outbuffer)
-    self.outbuffer = self.outbuffer[sent:]
+    try:
+      return self.socket.sendmsg(buffers)
+    except socket.error as err:
+      if err.args[0] == errno.EWOULDBLOCK:
+        return 0
+      elif err.args[0] in asyncore._DISCONNECTED: # pylint: disable=protected-access
+        self.handle_close()
+        return 0
+      raise
 
   def addtooutbuffer(self, data, raw=False):
     """
@@ -319,9 +405,58 @@ class Telnet(asyncore.dispatcher):
     if not raw and IAC in data:
       data = data.replace(IAC, IAC+IAC)
 
-    data = self.convert_outdata(data)
+    self.pending.append(data)
+    self.pendingsize = self.pendingsize + len(data)
+    if self.reactor:
+      self.reactor.flushlater(self)
+    else:
+      self.flush()
+
+  def flush(self):
+    """
+    convert the data added since the last flush and try to send it
+
+    called by the reactor at the end of each pass, so everything
+    written to a connection during a pass goes out in one send
+    """
+    if self.pending:
+      data = ''.join(self.pending)
+      self.pending = []
+      self.pendingsize = 0
+      self.outbuffer.append(self.convert_outdata(data))
+
+    if self.outbuffer and self.connected and not self.connecting:
+      # cork if it will take more than one send
+      cork = self.cork and len(self.outbuffer) > self.outbuffer.maxsend
+      if cork:
+        self.setcork(True)
+      self.handle_write()
+      if cork and self.socket:
+        self.setcork(False)
 
-    self.outbuffer = "".join([self.outbuffer, data])
+  def setnodelay(self, flag):
+    """
+    turn Nagle's algorithm off (True) or on (False) for the socket
+    """
+    self.settcpoption(socket.TCP_NODELAY, flag)
+
+  def setcork(self, flag):
+    """
+    hold back partial packets while corked, linux only
+    """
+    if hasattr(socket, 'TCP_CORK'):
+      self.settcpoption(socket.TCP_CORK, flag)
+
+  def settcpoption(self, option, flag):
+    """
+    set a tcp option on the socket
+    """
+    if not self.socket:
+      return
+    try:
+      self.socket.setsockopt(socket.IPPROTO_TCP, option, int(bool(flag)))
+    except socket.error:
+      self.msg('could not set tcp option %s' % option)
 
   def convert_outdata(self, outbuffer):
     """
@@ -335,8 +470,8 @@ class Telnet(asyncore.dispatcher):
     """
     find out if the connection has data to write
     """
-    #self.msg( 'writable', self.ttype, len(self.outbuffer) > 0)
-    return len(self.outbuffer) > 0
+    # a non blocking connect finishes when the socket becomes writable
+    return self.connecting or len(self.outbuffer) > 0
 
   def handle_error(self):
     """
@@ -357,7 +492,7 @@ class Telnet(asyncore.dispatcher):
       self.rawq_get()
     except EOFError:
       self.sbdataq = ""
-      self._sbdatabuffer = ""
+      self.resetparser()
       return
 
     while self.rawq:
@@ -394,156 +529,259 @@ class Telnet(asyncore.dispatcher):
     """
     self.option_callback = callback
 
-  def handle_subdata(self, data): # pylint: disable=too-many-branches,too-many-statements
-    """
-    handle data that has an IAC in it
+  def handle_command(self, command):
     """
-    marker = -1
+    handle a two byte command (IAC command) that is not an option
 
-    self.msg('handle_subdata with data: "%s"' % data, mtype='OPTION')
-    self.msg('# of IACS: %s' % (data.count(IAC)), mtype="OPTION")
-
-    if self._sbdatabuffer:
-      self.msg('had previous sb data: "%s"' % self._sbdatabuffer, mtype='OPTION')
-      data = "".join([self._sbdatabuffer, data])
-      self.msg('data now: "%s"' % data, mtype='OPTION')
-      self._sbdatabuffer = ''
+    override this to act on commands like GA or NOP, they are
+    not added to the cooked data
+    """
+    self.msg('received IAC %s' % self.ccode(command), mtype='OPTION')
 
-    i = data.find(IAC)
+  def convert_indata(self, data):
+    """
+    override this to convert data read from the socket before it is
+    parsed (decompress it, ...)
+    """
+    # this function can be overridden so disabling pylint warning
+    # pylint: disable=no-self-use
+    return data
 
-    while i != -1:
-      if i + 1 >= len(data):
-        marker = i
-        break
+  def parse(self, data): # pylint: disable=too-many-branches,too-many-statements
+    """
+    walk the data once, put text on the cooked queue and call the
+    option callback for each option
 
-      if i != 0:
-        # put everything before the IAC on the cookedq
-        self.msg('i != 0: everything goes into cooked queue that is before it',
-                 mtype="OPTION")
-        self.msg('i != 0: cooked q was "%s"' % self.cookedq,
-                 mtype="OPTION")
-        self.cookedq = "".join([self.cookedq, data[:i]])
-        self.msg('i != 0: cooked q is now "%s"' % self.cookedq,
-                 mtype="OPTION")
-        data = data[i:]
-        self.msg('i != 0: data changed to "%s"' % data,
-                 mtype="OPTION")
-        i = data.find(IAC)
-
-      if data[i+1] == NOP:
-        self.msg('received IAC NOP', mtype='OPTION')
-        data = "".join([data[:i], data[i+2:]])
-
-      elif data[i+1] == IAC:
-        self.msg('received IAC IAC', mtype='OPTION')
-        data = "".join([data[:i], data[i+1:]])
-        i = i + 1
+    the state is kept between calls, so a sequence can be split
+    across reads
 
-      else:
-        if i + 2 >= len(data):
-          self.msg('not enough data to figure out IAC sequence', mtype='OPTION')
-          marker = i
+    if the option callback returns True, the data after that option
+    is in a different encoding (MCCP) and is run through convert_indata
+    before it is parsed
+    """
+    state = self.tnstate
+    cooked = []
+    pos = 0
+    end = len(data)
+    while pos < end:
+      if state == TN_DATA:
+        i = data.find(IAC, pos)
+        if i == -1:
+          cooked.append(data[pos:] if pos else data)
           break
-
-        # handles DO/DONT/WILL/WONT
-        if data[i+1] in [DO, DONT, WILL, WONT]:
-          self.msg('DDWW: got a do, dont, will, or wont', mtype='OPTION')
-          cmd = data[i+1]
-          optionnum = data[i+2]
-          self.sbdataq = ""
-          self.option_callback(cmd, optionnum)
-
-          data = "".join([data[:i], data[i+3:]])
-          self.msg('DDWW: data was changed to: "%s"' % data, mtype='OPTION')
-
-
-        # handles SB...SE stuff
-        elif data[i+1] == SB:
-          self.msg('SBSE - data: "%s"' % data, mtype="OPTION")
-          optionnum = data[i+2]
-          cmd = SB
-          sei = data.find(SE, i)
-          self.msg('SBSE - Found: SB: %s, SE: %s' % (i, sei), mtype="OPTION")
-          if sei == -1:
-            marker = i
-            break
-
-          #self.logControl("receive: " + _cc(option))
-          self.sbdataq = data[i+3:sei-1]
-          self.msg('SBSE: sbdataq "%s"' % self.sbdataq, mtype="OPTION")
-
-          # before each option, put the remaining data back on
-          # the rawq, make the callback and then let things settle
-          self.rawq = "".join([data[:i], data[sei+1:]])
-          self.msg('SBSE - setting rawq to "%s"' % self.rawq, mtype="OPTION")
-          self.msg('SBSE - calling option_callback', mtype="OPTION")
-          self.option_callback(cmd, optionnum)
-
-          return ""
-
-        # in case they passed us something weird we remove the IAC and
-        # move on
+        if i > pos:
+          cooked.append(data[pos:i])
+        pos = i + 1
+        state = TN_IAC
+
+      elif state == TN_IAC:
+        char = data[pos]
+        pos = pos + 1
+        if char == IAC:
+          cooked.append(IAC)
+          state = TN_DATA
+        elif char in NEGOTIATE:
+          self.tncommand = char
+          state = TN_OPTION
+        elif char == SB:
+          state = TN_SBOPTION
+        else:
+          state = TN_DATA
+          # the command marks a position in the data (GA after a
+          # prompt), so the text before it goes on the queue first
+          if cooked:
+            cooked.insert(0, self.cookedq)
+            self.cookedq = ''.join(cooked)
+            cooked = []
+          self.handle_command(char)
+
+      elif state == TN_OPTION:
+        option = data[pos]
+        pos = pos + 1
+        state = self.tnstate = TN_DATA
+        self.sbdataq = ''
+        if self.option_callback(self.tncommand, option) and pos < end:
+          data = self.convert_indata(data[pos:])
+          pos = 0
+          end = len(data)
+
+      elif state == TN_SBOPTION:
+        self.sboption = data[pos]
+        pos = pos + 1
+        self.sbparts = []
+        state = TN_SB
+
+      elif state == TN_SB:
+        i = data.find(IAC, pos)
+        if i == -1:
+          self.sbparts.append(data[pos:])
+          break
+        if i > pos:
+          self.sbparts.append(data[pos:i])
+        pos = i + 1
+        state = TN_SBIAC
+
+      elif state == TN_SBIAC:
+        char = data[pos]
+        pos = pos + 1
+        if char == IAC:
+          self.sbparts.append(IAC)
+          state = TN_SB
+        elif char == SE:
+          state = self.tnstate = TN_DATA
+          self.sbdataq = ''.join(self.sbparts)
+          self.sbparts = []
+          if self.option_callback(SB, self.sboption) and pos < end:
+            data = self.convert_indata(data[pos:])
+            pos = 0
+            end = len(data)
         else:
-          data = "".join([data[:i], data[i+1:]])
-          self.msg('Weird IAC sequence: data was changed to: "%s"' % data, mtype='OPTION')
+          # IAC followed by anything else is not valid in a subnegotiation
+          state = TN_SB
 
-      i = data.find(IAC, i)
+    self.tnstate = state
 
-    if marker != -1:
-      self.msg('MARKER - not 1 with data %s' % data, mtype='OPTION')
-      self._sbdatabuffer = data[marker:]
-      self.msg('MARKER - _sbdatabuffer: "%s"' % self._sbdatabuffer, mtype='OPTION')
-      data = data[:marker]
-      self.msg('MARKER - data changed to "%s"' % self._sbdatabuffer, mtype='OPTION')
+    if cooked:
+      if self.cookedq:
+        cooked.insert(0, self.cookedq)
+      self.cookedq = ''.join(cooked)
 
-    return data
+  def resetparser(self):
+    """
+    reset the state of the parser
+    """
+    self.tnstate = TN_DATA
+    self.tncommand = None
+    self.sboption = None
+    self.sbparts = []
 
   def process_rawq(self):
     """
     Transfer from raw queue to cooked queue.
-
-    Set self.eof when connection is closed.  Don't block unless in
-    the midst of an IAC sequence.
     """
-    self.msg('PROCESS_RAWQ: rawq "%s"' % self.rawq, mtype='OPTION')
-    newdata = self.rawq
+    data = self.rawq
     self.rawq = ''
-    if IAC in newdata:
-      parseddata = self.handle_subdata(newdata)
-    else:
-      parseddata = newdata
-
-    self.msg('PROCESS_RAWQ: parseddata "%s"' % parseddata, mtype='OPTION')
-
-    self.cookedq = "".join([self.cookedq, parseddata])
+    self.parse(data)
 
   def rawq_get(self):
     """
-    Get next char from raw queue.
+    Fill the raw queue if it is empty.
 
-    Block if no data is immediately available.  Raise EOFError
-    when connection is closed.
+    Raise EOFError when the connection is closed and there is no
+    data left.
     """
     if not self.rawq:
       self.fill_rawq()
-      if self.eof:
+      if self.eof and not self.rawq:
         raise EOFError
 
   def fill_rawq(self):
     """
-    Fill raw queue from exactly one recv() system call.
+    Fill the raw queue with everything that is available on the socket.
 
-    Block if no data is immediately available.  Set self.eof when
-    connection is closed.
+    Reads until the socket has no more data or MAXREAD bytes were read.
+    The read size doubles while reads fill it and is halved when a read
+    uses less than a quarter of it. Set self.eof when connection is closed.
     """
-    buf = self.readdatafromsocket()
-    if buf is None:
-      self.eof = True
-    else:
-      self.eof = (not buf)
-    if not self.eof:
-      self.rawq = "".join([self.rawq, buf])
-      self.msg('rawq: %s' % self.rawq)
-      return buf
+    self.readevents = self.readevents + 1
+    bufs = []
+    total = 0
+    while total < MAXREAD:
+      buf = self.readdatafromsocket()
+      if buf is None:
+        self.eof = True
+        break
+      if not buf:
+        break
+      self.reads = self.reads + 1
+      bufs.append(buf)
+      total = total + len(buf)
+      if len(buf) < self.readsize:
+        if self.readsize > MINREADSIZE and len(buf) < self.readsize // 4:
+          self.readsize = self.readsize // 2
+        break
+      if self.readsize < MAXREADSIZE:
+        self.readsize = self.readsize * 2
+
+    if not bufs:
+      return ''
+
+    self.bytesread = self.bytesread + total
+    buf = self.convert_indata(bufs[0] if len(bufs) == 1 else ''.join(bufs))
+    self.rawq = "".join([self.rawq, buf])
+    return buf
+
+  def getstate(self):
+    """
+    return the state of the connection for a hot restart
+
+    the socket is left open and its file descriptor is inherited by
+    the new process, what has not been sent yet goes with the state
+    """
+    self.flush()
+    handlers = {}
+    for option in self.option_handlers:
+      hstate = self.option_handlers[option].getstate()
+      if hstate is not None:
+        handlers[option] = hstate
+    inheritable(self.socket.fileno())
+    return {'fd':self.socket.fileno(),
+            'family':self.socket.family,
+            'host':self.host,
+            'port':self.port,
+            'options':dict(self.options),
+            'handlers':handlers,
+            'tnstate':self.tnstate,
+            'tncommand':self.tncommand,
+            'sboption':self.sboption,
+            'sbparts':self.sbparts,
+            'sbdataq':self.sbdataq,
+            'rawq':self.rawq,
+            'cookedq':self.cookedq,
+            'outbuffer':self.outbuffer.drain()}
+
+  def setstate(self, state):
+    """
+    restore a connection from getstate in the new process
+    """
+    sock = socket.fromfd(state['fd'], state['family'], socket.SOCK_STREAM)
+    os.close(state['fd'])
+    sock.setblocking(0)
+    self.set_socket(sock)
+    self.connected = True
+    self.host = state['host']
+    self.port = state['port']
+    self.options = state['options']
+    self.tnstate = state['tnstate']
+    self.tncommand = state['tncommand']
+    self.sboption = state['sboption']
+    self.sbparts = state['sbparts']
+    self.sbdataq = state['sbdataq']
+    self.rawq = state['rawq']
+    self.cookedq = state['cookedq']
+    self.outbuffer.append(state['outbuffer'])
+    for option in state['handlers']:
+      if option in self.option_handlers:
+        self.option_handlers[option].setstate(state['handlers'][option])
+    self.restoring = False
+
+  def getreadstats(self):
+    """
+    return the read counters
+    """
+    return {'Read Events':self.readevents,
+            'Reads':self.reads,
+            'Bytes Read':self.bytesread,
+            'Bytes/Read':self.bytesread // self.reads if self.reads else 0,
+            'Reads/Event':'%.2f' % (float(self.reads) / self.readevents) \
+                                if self.readevents else 0,
+            'Read Size':self.readsize}
+
+
+def inheritable(fd):
+  """
+  let a new process started with exec inherit a file descriptor
+  """
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
 
-    return ''
@@ -0,0 +1,406 @@
+"""
+This module holds record classes for data that flows through the proxy
+
+Line is a line of data from the mud. The views of the line that plugins
+use (noansi, convertansi, colorline) are computed the first time they
+are used and then cached, so a line nobody looks at in color form never
+pays for the conversion.
+
+A Line also acts like the dictionary that was used before it, so
+plugins that use line['original'] or line['omit'] keep working.
+
+Trace and CommandTrace keep the changes made to a line or a command.
+A change is added with trace.add(flag, plugin, format, *args) and the
+format is only filled in when the change is shown. Changes are recorded
+for every trace while the profile plugin is loaded, and for one in
+TRACESAMPLE traces otherwise, the other traces drop them without
+formatting anything. Traces also act like the dictionaries that were
+used before them.
+"""
+from libs.api import API
+
+# a trace records its changes for one in this many lines and commands when
+# the profile plugin is not loaded
+TRACESAMPLE = 100
+
+class NoChanges(list):
+  """
+  the changes of a trace that is not recorded, appends are dropped
+  """
+  __slots__ = ()
+
+  def append(self, item):
+    """
+    drop the change
+    """
+    pass
+
+  def extend(self, items):
+    """
+    drop the changes
+    """
+    pass
+
+  def insert(self, index, item):
+    """
+    drop the change
+    """
+    pass
+
+  def __iadd__(self, items):
+    """
+    drop the changes
+    """
+    return self
+
+# shared by all traces that are not recorded
+NOCHANGES = NoChanges()
+
+class TraceChange(object):
+  """
+  a change in a trace, data is formatted when it is used
+
+  flag        - the kind of change, 'Modify', 'Omit', 'Sent'
+  plugin      - the plugin that made the change
+  data        - the description of the change
+  extra       - other keys, 'eventname', 'callstack'
+  """
+  __slots__ = ('flag', 'plugin', 'fmt', 'args', 'extra')
+
+  def __init__(self, flag, plugin, fmt, args, extra):
+    """
+    initialize the instance
+    """
+    self.flag = flag
+    self.plugin = plugin
+    self.fmt = fmt
+    self.args = args
+    self.extra = extra
+
+  @property
+  def data(self):
+    """
+    the description of the change
+    """
+    if self.args:
+      return self.fmt % self.args
+    return self.fmt
+
+  def __getitem__(self, key):
+    """
+    get a key like a dictionary
+    """
+    if key in ('flag', 'plugin', 'data'):
+      return getattr(self, key)
+    if self.extra and key in self.extra:
+      return self.extra[key]
+    raise KeyError(key)
+
+  def __contains__(self, key):
+    """
+    check for a key like a dictionary
+    """
+    return key in ('flag', 'plugin', 'data') or \
+              bool(self.extra and key in self.extra)
+
+  def get(self, key, default=None):
+    """
+    get a key with a default like a dictionary
+    """
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def __repr__(self):
+    """
+    return a representation of the change
+    """
+    return 'TraceChange(%r, %r, %r)' % (self.flag, self.plugin, self.data)
+
+class Trace(object):
+  """
+  the changes made to a line from the mud
+
+  dtype       - the datatype of the line
+  original    - the line as it came from the mud
+  changes     - a list of TraceChange, or of dictionaries added by
+                  plugins that append them to changes
+  """
+  __slots__ = ('dtype', 'original', 'changes', 'extra')
+
+  # the keys that map to attributes
+  mapkeys = ('dtype', 'original', 'changes')
+
+  api = API()
+  profiling = api.handle('profile.tracing')
+  count = 0
+
+  def __init__(self, dtype, original):
+    """
+    initialize the instance
+    """
+    self.dtype = dtype
+    self.original = original
+    self.extra = None
+    if Trace.recordnext():
+      self.changes = []
+    else:
+      self.changes = NOCHANGES
+
+  @staticmethod
+  def recordnext():
+    """
+    check if the next trace should record its changes
+    """
+    if Trace.profiling.has():
+      return True
+    Trace.count = Trace.count + 1
+    if Trace.count >= TRACESAMPLE:
+      Trace.count = 0
+      return True
+    return False
+
+  @property
+  def recording(self):
+    """
+    True if the changes are recorded
+    """
+    return self.changes is not NOCHANGES
+
+  def add(self, flag, plugin, fmt, *args, **extra):
+    """
+    add a change, fmt is formatted with args when the change is shown,
+    keyword arguments are kept as other keys of the change
+    """
+    if self.changes is not NOCHANGES:
+      self.changes.append(TraceChange(flag, plugin, fmt, args, extra or None))
+
+  def __getitem__(self, key):
+    """
+    get a key like a dictionary
+    """
+    if key in self.mapkeys:
+      return getattr(self, key)
+    if self.extra and key in self.extra:
+      return self.extra[key]
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    """
+    set a key like a dictionary
+    """
+    if key in self.mapkeys:
+      setattr(self, key, value)
+    else:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[key] = value
+
+  def __contains__(self, key):
+    """
+    check for a key like a dictionary
+    """
+    return key in self.mapkeys or bool(self.extra and key in self.extra)
+
+  def get(self, key, default=None):
+    """
+    get a key with a default like a dictionary
+    """
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def keys(self):
+    """
+    return the keys like a dictionary
+    """
+    keys = list(self.mapkeys)
+    if self.extra:
+      keys.extend(self.extra.keys())
+    return keys
+
+  def copy(self):
+    """
+    return a shallow copy that shares the changes, events.eraise copies
+    its arguments
+    """
+    cls = type(self)
+    newtrace = cls.__new__(cls)
+    for attr in self.mapkeys:
+      setattr(newtrace, attr, getattr(self, attr))
+    newtrace.extra = dict(self.extra) if self.extra else None
+    return newtrace
+
+  def __repr__(self):
+    """
+    return a representation of the trace
+    """
+    return '%s(%r, %s changes)' % (type(self).__name__, self.original,
+                                   len(self.changes))
+
+class CommandTrace(Trace):
+  """
+  the changes made to a command while send.execute runs it
+
+  originalcommand - the command that was executed
+  fromclient      - True if a client sent the command
+  internal        - True if the proxy or a plugin executed it
+  showinhistory   - if the command should be shown in the history
+  addedtohistory  - set when the command is added to the history
+  fromplugin      - the plugin that executed the command
+  """
+  __slots__ = ('originalcommand', 'fromclient', 'internal', 'showinhistory',
+               'addedtohistory', 'fromplugin')
+
+  mapkeys = Trace.mapkeys + __slots__
+
+  def __init__(self, command, fromclient, showinhistory, fromplugin):
+    """
+    initialize the instance
+    """
+    Trace.__init__(self, 'fromclient', command)
+    self.originalcommand = command
+    self.fromclient = fromclient
+    self.internal = not fromclient
+    self.showinhistory = showinhistory
+    self.addedtohistory = False
+    self.fromplugin = fromplugin
+
+class Line(object):
+  """
+  a line of data from the mud
+
+  original    - the text that will be sent to the clients, plugins can
+                  change this
+  data        - the line as it came from the mud
+  dtype       - the datatype, 'frommud'
+  trace       - the trace of the changes made to the line
+  omit        - set to True to not send the line to the clients
+  eventname   - the event the line is being processed by
+
+  lazy views of data:
+    noansi      - the line with ansi codes stripped
+    convertansi - the line with ansi codes converted to @ colors
+    colorline   - the same as convertansi, the name triggers use
+  """
+  __slots__ = ('original', 'data', 'dtype', 'trace', 'omit', 'eventname',
+               '_noansi', '_convertansi', 'extra')
+
+  api = API()
+  stripansi = api.handle('colors.stripansi')
+  convertansifunc = api.handle('colors.convertansi')
+
+  # the keys that map to attributes
+  mapkeys = ('original', 'data', 'dtype', 'trace', 'omit', 'eventname',
+             'noansi', 'convertansi', 'colorline')
+
+  def __init__(self, data, dtype='frommud'):
+    """
+    initialize the instance
+    """
+    self.original = data
+    self.data = data
+    self.dtype = dtype
+    self.trace = Trace(dtype, data)
+    self.omit = False
+    self.eventname = None
+    self._noansi = None
+    self._convertansi = None
+    self.extra = None
+
+  @property
+  def noansi(self):
+    """
+    the line with ansi codes stripped
+    """
+    if self._noansi is None:
+      if self.stripansi.has():
+        self._noansi = self.stripansi(self.data)
+      else:
+        self._noansi = self.data
+    return self._noansi
+
+  @property
+  def convertansi(self):
+    """
+    the line with ansi codes converted to @ colors
+    """
+    if self._convertansi is None:
+      if self.convertansifunc.has():
+        self._convertansi = self.convertansifunc(self.data)
+        if self._convertansi != self.data:
+          self.api('send.msgf')('converted %r to %s', self.data,
+                                self._convertansi, primary='ansi')
+      else:
+        self._convertansi = self.data
+    return self._convertansi
+
+  colorline = convertansi
+
+  def __getitem__(self, key):
+    """
+    get a key like a dictionary
+    """
+    if key in self.mapkeys:
+      return getattr(self, key)
+    if self.extra and key in self.extra:
+      return self.extra[key]
+    raise KeyError(key)
+
+  def __setitem__(self, key, value):
+    """
+    set a key like a dictionary
+    """
+    if key in ('original', 'data', 'dtype', 'trace', 'omit', 'eventname'):
+      setattr(self, key, value)
+    elif key == 'noansi':
+      self._noansi = value
+    elif key in ('convertansi', 'colorline'):
+      self._convertansi = value
+    else:
+      if self.extra is None:
+        self.extra = {}
+      self.extra[key] = value
+
+  def __contains__(self, key):
+    """
+    check for a key like a dictionary
+    """
+    return key in self.mapkeys or bool(self.extra and key in self.extra)
+
+  def get(self, key, default=None):
+    """
+    get a key with a default like a dictionary
+    """
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def keys(self):
+    """
+    return the keys like a dictionary
+    """
+    keys = list(self.mapkeys)
+    if self.extra:
+      keys.extend(self.extra.keys())
+    return keys
+
+  def copy(self):
+    """
+    return a shallow copy, events.eraise copies its arguments
+    """
+    newline = Line.__new__(Line)
+    for attr in self.__slots__:
+      setattr(newline, attr, getattr(self, attr))
+    if self.extra:
+      newline.extra = dict(self.extra)
+    return newline
+
+  def __repr__(self):
+    """
+    return a representation of the line
+    """
+    return 'Line(%r)' % self.original
@@ -63,8 +63,8 @@ class PluginMgr(BasePlugin):
     else:
       self.basepath = __file__[:index]
 
-    self.savefile = os.path.join(self.api.BASEPATH, 'data',
-                                 'plugins', 'loadedplugins.txt')
+    self.savefile = os.path.join(self.api.DATAPATH, 'plugins',
+                                 'loadedplugins.txt')
     self.loadedplugins = PersistentDict(self.savefile, 'c')
 
     self.api('api.add')('isloaded', self._api_isloaded)
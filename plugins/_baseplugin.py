@@ -47,14 +47,13 @@ class BasePlugin(object): # pylint: disable=too-many-instance-attributes
     self.api = API()
     self.firstactiveprio = None
     self.loadedtime = time.time()
-    self.savedir = os.path.join(self.api.BASEPATH, 'data',
-                                'plugins', self.sname)
+    self.savedir = os.path.join(self.api.DATAPATH, 'plugins', self.sname)
     try:
       os.makedirs(self.savedir)
     except OSError:
       pass
-    self.savefile = os.path.join(self.api.BASEPATH, 'data',
-                                 'plugins', self.sname, 'settingvalues.txt')
+    self.savefile = os.path.join(self.api.DATAPATH, 'plugins', self.sname,
+                                 'settingvalues.txt')
     self.modpath = modpath
     self.basepath = basepath
     self.fullimploc = fullimploc
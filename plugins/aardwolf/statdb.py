@@ -909,7 +909,7 @@ class Plugin(AardwolfBasePlugin): # pylint: disable=too-many-public-methods
     import glob
     import shutil
 
-    oldpath = os.path.join(self.api.BASEPATH, 'data', 'db')
+    oldpath = os.path.join(self.api.DATAPATH, 'db')
     oldpatharchive = os.path.join(oldpath, 'archive')
     newpath = self.savedir
     newpatharchive = os.path.join(newpath, 'archive')
@@ -166,10 +166,8 @@ class Plugin(BasePlugin):
           datan = cre.sub(self._aliases[mem]['alias'], data)
         if datan != data:
           if 'trace' in args:
-            args['trace']['changes'].append({'flag':'Modify',
-                                             'data':'changed "%s" to "%s"' % \
-                                                (data, datan),
-                                             'plugin':self.sname})
+            args['trace'].add('Modify', self.sname, 'changed "%s" to "%s"',
+                              data, datan)
           if not 'hits' in self._aliases[mem]:
             self._aliases[mem]['hits'] = 0
           if not mem in self.sessionhits:
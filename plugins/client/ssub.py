@@ -78,30 +78,38 @@ class Plugin(BasePlugin):
                              parser=parser)
 
     self.api('commands.default')('list')
-    self.api('events.register')('from_mud_event', self.findsub)
+    self.updateregistration()
 
     self.api('events.register')('plugin_%s_savestate' % self.sname, self._savestate)
 
+  def updateregistration(self):
+    """
+    only look at mud data when there are substitutes, so the mud can
+    pass data straight through otherwise
+    """
+    registered = self.api('events.isregistered')('from_mud_event',
+                                                 self.findsub)
+    if self._substitutes and not registered:
+      self.api('events.register')('from_mud_event', self.findsub)
+    elif registered and not self._substitutes:
+      self.api('events.unregister')('from_mud_event', self.findsub)
+
   def findsub(self, args):
     """
     this function finds subs in mud data
     """
-    data = args['original']
-    dtype = args['dtype']
-    if dtype != 'fromproxy':
+    data = args.original
+    if args.dtype != 'fromproxy':
       for mem in self._substitutes.keys():
         if mem in data:
           ndata = data.replace(mem,
                                self.api('colors.convertcolors')(
                                    self._substitutes[mem]['sub']))
           if ndata != data:
-            args['trace']['changes'].append({'flag':'Modify',
-                                             'data':'changed "%s" to "%s"' % \
-                                                 (data, ndata),
-                                             'plugin':self.sname,
-                                             'eventname':args['eventname']})
+            args.trace.add('Modify', self.sname, 'changed "%s" to "%s"',
+                           data, ndata, eventname=args.eventname)
             data = ndata
-      args['original'] = data
+      args.original = data
       return args
 
   def cmd_add(self, args):
@@ -161,6 +169,7 @@ class Plugin(BasePlugin):
     """
     self._substitutes[item] = {'sub':sub}
     self._substitutes.sync()
+    self.updateregistration()
 
   def removesub(self, item):
     """
@@ -169,6 +178,7 @@ class Plugin(BasePlugin):
     if item in self._substitutes:
       del self._substitutes[item]
       self._substitutes.sync()
+      self.updateregistration()
 
   def listsubs(self, match):
     """
@@ -188,6 +198,7 @@ class Plugin(BasePlugin):
     """
     self._substitutes.clear()
     self._substitutes.sync()
+    self.updateregistration()
 
   def reset(self):
     """
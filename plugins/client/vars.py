@@ -136,9 +136,8 @@ class Plugin(BasePlugin):
 
     if datan != data:
       if 'trace' in args:
-        args['trace']['changes'].append({'flag':'Modify',
-                                         'data':'changed "%s" to "%s"' % (data, datan),
-                                         'plugin':self.sname})
+        args['trace'].add('Modify', self.sname, 'changed "%s" to "%s"',
+                          data, datan)
 
       self.api('send.msg')('replacing "%s" with "%s"' % (data.strip(),
                                                          datan.strip()))
@@ -245,9 +245,7 @@ class Plugin(BasePlugin):
                                   cmd['sname'], cmd['commandname'], fullargs)
 
     if 'trace' in data:
-      data['trace']['changes'].append({'flag':'Start',
-                                       'data':"'%s'" % commandran,
-                                       'plugin':self.sname})
+      data['trace'].add('Start', self.sname, "'%s'", commandran)
 
     try:
       args, dummy = cmd['parser'].parse_known_args(targs)
@@ -260,10 +258,9 @@ class Plugin(BasePlugin):
                             cmd['sname'],
                             cmd['commandname'])))
       if 'trace' in data:
-        data['trace']['changes'].append(
-            {'flag': 'Error',
-             'data':'%s - error parsing args: %s' % (commandran, exc.errormsg), # pylint: disable=no-member
-             'plugin':self.sname})
+        data['trace'].add('Error', self.sname,
+                          '%s - error parsing args: %s',
+                          commandran, exc.errormsg) # pylint: disable=no-member
       return retval
 
     args = vars(args)
@@ -304,9 +301,7 @@ class Plugin(BasePlugin):
                                   preamble=cmd['preamble'])
 
     if 'trace' in data:
-      data['trace']['changes'].append({'flag':'Finish',
-                                       'data':"'%s'" % commandran,
-                                       'plugin':self.sname})
+      data['trace'].add('Finish', self.sname, "'%s'", commandran)
 
     return retval
 
@@ -451,9 +446,8 @@ class Plugin(BasePlugin):
                                                 'Outcome: %s' % commanddata['success'])
 
       if 'trace' in data:
-        data['trace']['changes'].append({'flag': commanddata['flag'],
-                                         'data':commanddata['cmddata'],
-                                         'plugin':self.sname})
+        data['trace'].add(commanddata['flag'], self.sname,
+                          commanddata['cmddata'])
       return {'fromdata':''}
     else: # no command, so add it to history and check antispam
       addedtohistory = self.addtohistory(data)
@@ -466,22 +460,18 @@ class Plugin(BasePlugin):
                                       + '|' + commanddata['orig']
           if 'trace' in data:
             data['addedtohistory'] = addedtohistory
-            data['trace']['changes'].append(
-                {'flag':'Antispam',
-                 'data':'cmd was sent %s times, sending %s for antispam' % \
-                     (self.api('setting.gets')('spamcount'),
-                      self.api('setting.gets')('antispamcommand')),
-                 'plugin':self.sname})
+            data['trace'].add('Antispam', self.sname,
+                              'cmd was sent %s times, sending %s for antispam',
+                              self.api('setting.gets')('spamcount'),
+                              self.api('setting.gets')('antispamcommand'))
           self.api('send.msg')('adding look for 20 commands')
           self.api('setting.change')('cmdcount', 0)
           return data
         if commanddata['orig'] in self.nomultiplecmds:
           if 'trace' in data:
-            data['trace']['changes'].append(
-                {'flag':'Nomultiple',
-                 'data':'This command has been flagged" \
-                   " not to be sent multiple times in a row',
-                 'plugin':self.sname})
+            data['trace'].add('Nomultiple', self.sname,
+                              'This command has been flagged" \
+                                " not to be sent multiple times in a row')
 
           data['fromdata'] = ''
           return data
@@ -492,10 +482,9 @@ class Plugin(BasePlugin):
 
       if data['fromdata'] != commanddata['orig']:
         if 'trace' in data:
-          data['trace']['changes'].append(
-              {'flag':'Unknown',
-               'data':"'%s' - Don't know why we got here" % data['fromdata'],
-               'plugin':self.sname})
+          data['trace'].add('Unknown', self.sname,
+                            "'%s' - Don't know why we got here",
+                            data['fromdata'])
 
       return data
 
@@ -11,6 +11,23 @@ This plugin handles events.
 
 ### Raising an event
  * ```self.api('events.eraise')(eventname, argdictionary)```
+
+### Raising an event for a batch of lines
+ * ```self.api('events.eraisebatch')(eventname, lineeventname, lines)```
+ * functions registered to eventname get {'lines':lines} once, then
+    each line (a dictionary) goes through all the functions registered to
+    lineeventname before the next line, like eraise for each line
+
+### Watching the registrations of an event
+ * ```self.api('events.register')('events_%s_changed' % eventname, function)```
+ * raised after a function registers with or unregisters from eventname,
+    with {'name':eventname}
+
+### Passive functions
+ * ```self.api('events.register')(eventname, function, passive=True)```
+ * a passive function only looks at what other functions did, an event
+    that only has passive functions registered can be skipped
+    (see EventContainer.hasactive)
 """
 from __future__ import print_function
 import libs.argp as argp
@@ -29,11 +46,12 @@ class EFunc(object): # pylint: disable=too-few-public-methods
   """
   a basic event class
   """
-  def __init__(self, func, funcplugin):
+  def __init__(self, func, funcplugin, passive=False):
     """
     init the class
     """
     self.funcplugin = funcplugin
+    self.passive = passive
     self.timesexecuted = 0
     self.func = func
     self.name = func.__name__
@@ -100,7 +118,18 @@ class EventContainer(object):
 
     return True
 
-  def register(self, func, funcplugin, prio=50):
+  def hasactive(self):
+    """
+    check if an event has functions registered that are not passive
+    """
+    for prio in self.priod:
+      for eventfunc in self.priod[prio]:
+        if not eventfunc.passive:
+          return True
+
+    return False
+
+  def register(self, func, funcplugin, prio=50, passive=False):
     """
     register a function to this event container
     """
@@ -110,12 +139,13 @@ class EventContainer(object):
     if prio not in self.priod:
       self.priod[prio] = []
 
-    eventfunc = EFunc(func, funcplugin)
+    eventfunc = EFunc(func, funcplugin, passive)
 
     if eventfunc not in self.priod[prio]:
       self.priod[prio].append(eventfunc)
       self.api('send.msg')('%s - register function %s with prio %s' \
               % (self.name, eventfunc, prio), secondary=eventfunc.funcplugin)
+      self.plugin.registrationschanged(self.name)
       return True
 
     return False
@@ -130,6 +160,7 @@ class EventContainer(object):
         self.api('send.msg')('%s - unregister function %s with prio %s' \
               % (self.name, eventfunc, prio), secondary=eventfunc.funcplugin)
         self.priod[prio].remove(eventfunc)
+        self.plugin.registrationschanged(self.name)
         return True
 
     self.api('send.error')('Could not find function %s in event %s' % \
@@ -185,9 +216,9 @@ class EventContainer(object):
     self.numraised = self.numraised + 1
 
     if self.name != 'global_timer':
-      self.api('send.msg')('event %s raised by %s with args %s' % \
-                             (self.name, calledfrom, nargs),
-                           secondary=calledfrom)
+      self.api('send.msgf')('event %s raised by %s with args %s',
+                            self.name, calledfrom, nargs,
+                            secondary=calledfrom)
     keys = self.priod.keys()
     if keys:
       keys.sort()
@@ -203,6 +234,54 @@ class EventContainer(object):
 
     return nargs
 
+  def eraisebatch(self, nargs, linecontainer, calledfrom, linedone=None):
+    """
+    raise this event with a list of lines in nargs['lines']
+
+    the functions registered to this event are called with the whole
+    batch first, then each line is passed through the functions
+    registered to linecontainer in priority order before the next line,
+    as if the line event was raised for each line, and linedone is
+    called with the line when its functions are done
+    """
+    self.numraised = self.numraised + 1
+
+    self.api('send.msgf')('event %s raised by %s with %s lines',
+                          self.name, calledfrom, len(nargs['lines']),
+                          secondary=calledfrom)
+
+    for prio in sorted(self.priod.keys()):
+      for eventfunc in self.priod[prio][:]:
+        try:
+          tnargs = eventfunc.execute(nargs)
+          if tnargs:
+            nargs = tnargs
+        except Exception:  # pylint: disable=broad-except
+          self.api('send.traceback')(
+              "error when calling function for event %s" % self.name)
+
+    lines = nargs['lines']
+    if linecontainer:
+      linecontainer.numraised = linecontainer.numraised + len(lines)
+
+    for index, line in enumerate(lines):
+      if linecontainer:
+        for prio in sorted(linecontainer.priod.keys()):
+          for eventfunc in linecontainer.priod[prio][:]:
+            try:
+              tline = eventfunc.execute(line)
+              if tline:
+                line = tline
+            except Exception:  # pylint: disable=broad-except
+              self.api('send.traceback')(
+                  "error when calling function for event %s" % \
+                    linecontainer.name)
+        lines[index] = line
+      if linedone:
+        linedone(line)
+
+    return nargs
+
 class Plugin(BasePlugin):
   """
   a class to manage events, events include
@@ -223,6 +302,7 @@ class Plugin(BasePlugin):
     self.api('api.add')('register', self.api_register)
     self.api('api.add')('unregister', self.api_unregister)
     self.api('api.add')('eraise', self.api_eraise)
+    self.api('api.add')('eraisebatch', self.api_eraisebatch)
     self.api('api.add')('isregistered', self.api_isregistered)
     self.api('api.add')('removeplugin', self.api_removeplugin)
     self.api('api.add')('gete', self.api_getevent)
@@ -277,6 +357,15 @@ class Plugin(BasePlugin):
                          secondary=args['name'])
     self.api('%s.removeplugin' % self.sname)(args['name'])
 
+  def registrationschanged(self, eventname):
+    """
+    raise events_<eventname>_changed if something watches eventname
+    """
+    changedname = 'events_%s_changed' % eventname
+    if changedname in self.events and not self.events[changedname].isempty():
+      self.api('events.eraise')(changedname, {'name':eventname},
+                                calledfrom=self.sname)
+
   # return the event, will have registered functions
   def api_getevent(self, eventname):
     """  return an event
@@ -309,6 +398,8 @@ class Plugin(BasePlugin):
     @Yfunc@w        = The function to register
     keyword arguments:
       prio          = the priority of the function (default: 50)
+      passive       = True if the function only looks at what other
+                        functions did (default: False)
 
     this function returns no values"""
 
@@ -326,7 +417,8 @@ class Plugin(BasePlugin):
     if eventname not in self.events:
       self.events[eventname] = EventContainer(self, eventname)
 
-    self.events[eventname].register(func, funcplugin, prio)
+    self.events[eventname].register(func, funcplugin, prio,
+                                    kwargs.get('passive', False))
 
   # unregister a function from an event
   def api_unregister(self, eventname, func, **kwargs):
@@ -381,6 +473,39 @@ class Plugin(BasePlugin):
 
     return nargs
 
+  # raise an event for a batch of lines
+  def api_eraisebatch(self, eventname, lineeventname, lines, calledfrom=None,
+                      linedone=None):
+    """  raise an event for a batch of lines
+    @Yeventname@w     = The event to raise with the whole batch
+    @Ylineeventname@w = The event that functions register with to get
+                          one line at a time
+    @Ylines@w         = A list of dictionaries, one for each line
+    @Ylinedone@w      = (optional) called with each line after the
+                          functions registered to lineeventname
+
+    functions registered to eventname get a dictionary with a lines key
+    first, then each line goes through all the functions registered to
+    lineeventname before the next line does
+
+    this function returns the dictionary with the lines key"""
+    if not calledfrom:
+      calledfrom = self.api('api.callerplugin')(skipplugin=['events'])
+
+    for line in lines:
+      line['eventname'] = lineeventname
+
+    nargs = {'lines':lines, 'eventname':eventname}
+    if eventname not in self.events:
+      self.events[eventname] = EventContainer(self, eventname)
+
+    self.numglobalraised += 1
+    nargs = self.events[eventname].eraisebatch(nargs,
+                                               self.events.get(lineeventname),
+                                               calledfrom, linedone)
+
+    return nargs
+
   # get the details of an event
   def api_detail(self, eventname):
     """  get the details of an event
@@ -1,5 +1,9 @@
 """
 This module will do both debugging and logging
+
+log.wanted returns the datatypes that go to the clients, the console or a
+file, send.msg drops messages that have none of them before formatting
+or passing them here.
 """
 from __future__ import print_function
 import sys
@@ -34,9 +38,8 @@ class Plugin(BasePlugin):
 
     #print('log api.api', self.api.api)
     #print('log basepath', self.api.BASEPATH)
-    self.savedir = os.path.join(self.api.BASEPATH, 'data',
-                                'plugins', self.sname)
-    self.logdir = os.path.join(self.api.BASEPATH, 'data', 'logs')
+    self.savedir = os.path.join(self.api.DATAPATH, 'plugins', self.sname)
+    self.logdir = os.path.join(self.api.DATAPATH, 'logs')
     #print('logdir', self.logdir)
     try:
       os.makedirs(self.savedir)
@@ -63,7 +66,14 @@ class Plugin(BasePlugin):
 
     self.colors['error'] = '@x136'
 
+    self.stripansi = self.api.handle('colors.stripansi')
+    self.convertcolors = self.api.handle('colors.convertcolors')
+
+    # the datatypes that are sent somewhere, None if all messages are
+    self.wanted = None
+
     self.api('api.add')('msg', self.api_msg)
+    self.api('api.add')('wanted', self.api_wanted)
     self.api('api.add')('adddtype', self.api_adddtype)
     self.api('api.add')('console', self.api_toggletoconsole)
     self.api('api.add')('file', self.api_toggletofile)
@@ -84,6 +94,8 @@ class Plugin(BasePlugin):
     self.api('log.console')('startup')
     self.api('log.console')('shutdown')
 
+    self.updatewanted()
+
   def api_writefile(self, dtype, data, stripcolor=False):
     """
     write directly to a file
@@ -91,8 +103,8 @@ class Plugin(BasePlugin):
     if dtype not in self.sendtofile:
       self.api('%s.file' % self.sname)(dtype)
 
-    if stripcolor and self.api('api.has')('colors.stripansi'):
-      data = self.api('colors.stripansi')(data)
+    if stripcolor and self.stripansi.has():
+      data = self.stripansi(data)
 
     tfile = os.path.join(self.logdir, dtype,
                           time.strftime(self.sendtofile[dtype]['file'],
@@ -117,14 +129,45 @@ class Plugin(BasePlugin):
             (time.strftime(self.api.timestring, time.localtime()))
       data = tstring + data
 
-    if self.api('api.has')('colors.stripansi'):
-      self.currentlogs[dtype]['fhandle'].write(
-          self.api('colors.stripansi')(data) + '\n')
+    if self.stripansi.has():
+      self.currentlogs[dtype]['fhandle'].write(self.stripansi(data) + '\n')
     else:
       self.currentlogs[dtype]['fhandle'].write(data + '\n')
     self.currentlogs[dtype]['fhandle'].flush()
     return True
 
+  # return the datatypes that are logged somewhere
+  def api_wanted(self):
+    """  return the datatypes that go to the clients, the console or a file
+
+    this function returns a set of datatypes, None if every message is
+    logged"""
+    return self.wanted
+
+  def updatewanted(self):
+    """
+    update the datatypes that are logged somewhere, every message goes to
+    the default log file if there is one
+    """
+    if 'default' in self.sendtofile and self.sendtofile['default']['file']:
+      self.wanted = None
+      return
+
+    wanted = set()
+    for dtype in self.sendtoclient:
+      if self.sendtoclient[dtype]:
+        wanted.add(dtype)
+    for dtype in self.sendtoconsole:
+      if self.sendtoconsole[dtype]:
+        wanted.add(dtype)
+    for dtype in self.sendtofile:
+      if self.sendtofile[dtype] and self.sendtofile[dtype]['file']:
+        wanted.add(dtype)
+
+    # messages are never sent to default, it is only a log file
+    wanted.discard('default')
+    self.wanted = wanted
+
   # add a datatype to the log
   def api_adddtype(self, datatype):
     """  add a datatype
@@ -159,9 +202,8 @@ class Plugin(BasePlugin):
 
         self.logtofile(msg, dtag)
 
-        if self.api('api.has')('colors.convertcolors') and \
-            dtag in self.colors:
-          timestampmsg = self.api('colors.convertcolors')(
+        if self.convertcolors.has() and dtag in self.colors:
+          timestampmsg = self.convertcolors(
               self.colors[dtag] + timestampmsg)
 
         if dtag in self.sendtoclient and self.sendtoclient[dtag] and not senttoclient:
@@ -210,6 +252,7 @@ class Plugin(BasePlugin):
     this function returns no values"""
     if datatype in self.sendtoclient and datatype != 'frommud':
       self.sendtoclient[datatype] = flag
+      self.updatewanted()
 
     self.api('send.msg')('setting %s to log to client' % \
                       datatype)
@@ -234,6 +277,7 @@ class Plugin(BasePlugin):
         elif i != 'frommud':
           tmsg.append('Type %s does not exist' % i)
       self.sendtoclient.sync()
+      self.updatewanted()
       return True, tmsg
 
     tmsg.append('Current types going to client')
@@ -251,6 +295,7 @@ class Plugin(BasePlugin):
     this function returns no values"""
     if datatype in self.sendtoconsole and datatype != 'frommud':
       self.sendtoconsole[datatype] = flag
+      self.updatewanted()
 
     self.api('send.msg')('setting %s to log to console' % \
                       datatype, self.sname)
@@ -275,6 +320,7 @@ class Plugin(BasePlugin):
         elif i != 'frommud':
           tmsg.append('Type %s does not exist' % i)
       self.sendtoconsole.sync()
+      self.updatewanted()
       return True, tmsg
 
     tmsg.append('Current types going to console')
@@ -302,6 +348,8 @@ class Plugin(BasePlugin):
                       (datatype, self.sendtofile[datatype]['file']),
                            self.sname)
     self.sendtofile.sync()
+    self.updatewanted()
+    self.updatemudlogging()
 
   # toggle a datatype to log to a file
   def cmd_file(self, args):
@@ -327,6 +375,8 @@ class Plugin(BasePlugin):
         tmsg.append('setting %s to log to %s' % \
                         (dtype, self.sendtofile[dtype]['file']))
         self.sendtofile.sync()
+      self.updatewanted()
+      self.updatemudlogging()
       return True, tmsg
     else:
       tmsg.append('Current types going to file')
@@ -369,16 +419,30 @@ class Plugin(BasePlugin):
         tmsg.append(i)
     return True, tmsg
 
+  def updatemudlogging(self):
+    """
+    only look at mud data when it is logged to a file, so the mud can
+    pass data straight through otherwise
+    """
+    needed = 'frommud' in self.sendtofile
+    registered = self.api('events.isregistered')('from_mud_event', self.logmud)
+    if needed and not registered:
+      self.api('events.register')('from_mud_event', self.logmud)
+    elif registered and not needed:
+      self.api('events.unregister')('from_mud_event', self.logmud)
+
   def logmud(self, args):
     """
     log all data from the mud
     """
     if 'frommud' in self.sendtofile and self.sendtofile['frommud']['file']:
       if args['eventname'] == 'from_mud_event':
-        data = args['noansi']
+        # the noansi view of the line is only computed when logging
+        self.logtofile(args.noansi, 'frommud', stripcolor=False)
       elif args['eventname'] == 'to_mud_event':
-        data = 'tomud: ' + args['data'].strip()
-      self.logtofile(data, 'frommud', stripcolor=False)
+        # send.execute sends a batch of commands, one line each
+        for line in args['data'].strip().split('\n'):
+          self.logtofile('tomud: ' + line.strip(), 'frommud', stripcolor=False)
     return args
 
   def load(self):
@@ -390,7 +454,7 @@ class Plugin(BasePlugin):
     #print('log api before adding', self.api.api)
 
     #print('log api after adding', self.api.api)
-    self.api('events.register')('from_mud_event', self.logmud)
+    self.updatemudlogging()
     self.api('events.register')('to_mud_event', self.logmud)
     self.api('events.register')('plugin_%s_savestate' % self.sname, self._savestate)
 
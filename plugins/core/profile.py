@@ -1,5 +1,13 @@
 """
 This plugin shows and clears errors seen during plugin execution
+
+The function stack of a command sent to the mud is only captured when
+cmdfuncstack is set or for one in cmdstacksample commands, and it is only
+formatted when a trace is shown with callstack.
+
+The changes in command and mud data traces are recorded for every trace
+while this plugin is loaded, see libs.records. A change keeps its format
+and arguments, the description is only built when a trace is shown.
 """
 from plugins._baseplugin import BasePlugin
 import libs.argp as argp
@@ -26,6 +34,10 @@ class Plugin(BasePlugin):
 
     self.commandtraces = None
     self.changedmuddata = None
+    self.stackcount = 0
+
+    self.api('api.add')('samplestack', self.api_samplestack)
+    self.api('api.add')('tracing', self.api_tracing)
 
   def load(self):
     """
@@ -40,7 +52,11 @@ class Plugin(BasePlugin):
     self.api('setting.add')('stacklen', 20, int,
                             '# of traces kept')
     self.api('setting.add')('cmdfuncstack', False, bool,
-                            'print the function stack in an echo')
+                            'capture the function stack of every command ' \
+                            'and print it in an echo')
+    self.api('setting.add')('cmdstacksample', 100, int,
+                            'capture the function stack for 1 in this many ' \
+                            'commands, 0 for none')
 
     parser = argp.ArgumentParser(
         add_help=False,
@@ -81,9 +97,38 @@ class Plugin(BasePlugin):
     self.changedmuddata = SimpleQueue(self.api('setting.gets')('stacklen'))
 
     self.api('events.register')('io_execute_trace_finished', self.savecommand, prio=99)
-    self.api('events.register')('from_mud_event', self.savechangedmuddata, prio=99)
+    # only lines changed by other functions are saved
+    self.api('events.register')('from_mud_event', self.savechangedmuddata, prio=99,
+                                passive=True)
     self.api('events.register')('var_%s_functions' % self.sname, self.onfunctionschange)
 
+  # check if the function stack should be captured for a command
+  def api_samplestack(self):
+    """  check if the function stack should be captured for a command
+
+    this function returns True if the stack should be captured"""
+    if self.api('setting.gets')('cmdfuncstack'):
+      return True
+
+    sample = self.api('setting.gets')('cmdstacksample')
+    if sample <= 0:
+      return False
+
+    self.stackcount = self.stackcount + 1
+    if self.stackcount >= sample:
+      self.stackcount = 0
+      return True
+
+    return False
+
+  # check if traces should record their changes
+  def api_tracing(self):
+    """  check if traces should record their changes
+
+    this function returns True, traces record their changes while this
+    plugin is loaded"""
+    return True
+
   def onfunctionschange(self, _=None):
     """
     toggle the function profiling
@@ -219,8 +264,8 @@ class Plugin(BasePlugin):
       msg.append("%-2s - %-15s :   %s - %s" % (count, i['plugin'].capitalize(), i['flag'],
                                                i['data']))
 
-      if callstack and 'callstack' in i:
-        for line in i['callstack']:
+      if callstack and 'callstack' in i and i['callstack']:
+        for line in i['callstack'].format():
           msg.append("%-20s :   %s" % ("", line))
 
     msg.append('-----------------------------------------------------')
@@ -237,7 +282,8 @@ class Plugin(BasePlugin):
     echocommands = self.api('setting.gets')('commands')
 
     if echocommands:
-      self.api('send.client')(self.formatcommandstack(args))
+      self.api('send.client')(self.formatcommandstack(
+          args, self.api('setting.gets')('cmdfuncstack')))
 
   def savechangedmuddata(self, args):
     """
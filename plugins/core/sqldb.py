@@ -39,6 +39,7 @@ for an example of using sqldb
 """
 import sqlite3
 import os
+import sys
 import shutil
 import time
 import zipfile
@@ -86,10 +87,9 @@ class Sqldb(object):
     self.api('log.adddtype')('sqlite')
     #self.api('log.console')('sqlite')
     self.backupform = '%s_%%s.sqlite' % self.dbname
-    self.dbdir = os.path.join(self.api.BASEPATH, 'data', 'db')
+    self.dbdir = os.path.join(self.api.DATAPATH, 'db')
     if 'dbdir' in kwargs:
-      self.dbdir = kwargs['dbdir'] or os.path.join(self.api.BASEPATH,
-                                                   'data', 'db')
+      self.dbdir = kwargs['dbdir'] or os.path.join(self.api.DATAPATH, 'db')
     try:
       os.makedirs(self.dbdir)
     except OSError:
@@ -138,8 +138,8 @@ class Sqldb(object):
     """
     close the database
     """
-    import inspect
-    self.api('send.msg')('close: called by - %s' % inspect.stack()[1][3])
+    funcname = sys._getframe(1).f_code.co_name # pylint: disable=protected-access
+    self.api('send.msg')('close: called by - %s' % funcname)
     try:
       self.dbconn.close()
     except Exception: # pylint: disable=broad-except
@@ -150,10 +150,11 @@ class Sqldb(object):
     """
     open the database
     """
-    import inspect
-    funcname = inspect.stack()[1][3]
-    if funcname == '__getattribute__':
-      funcname = inspect.stack()[2][3]
+    frame = sys._getframe(1) # pylint: disable=protected-access
+    if frame.f_code.co_name == '__getattribute__':
+      frame = frame.f_back
+    funcname = frame.f_code.co_name
+    del frame
     self.api('send.msg')('open: called by - %s' % funcname)
     self.dbconn = sqlite3.connect(
         self.dbfile,
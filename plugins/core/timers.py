@@ -108,6 +108,7 @@ class Plugin(BasePlugin):
     self.api('api.add')('remove', self.api_remove)
     self.api('api.add')('toggle', self.api_toggle)
     self.api('api.add')('removeplugin', self.api_removeplugin)
+    self.api('api.add')('nextcall', self.api_nextcall)
 
   def load(self):
     """
@@ -331,8 +332,10 @@ class Plugin(BasePlugin):
         self.api('send.msg')('removing %s' % tevent,
                              secondary=tevent.plugin)
         ttime = tevent.nextcall
-        if tevent in self.timerevents[ttime]:
+        if ttime in self.timerevents and tevent in self.timerevents[ttime]:
           self.timerevents[ttime].remove(tevent)
+          if not self.timerevents[ttime]:
+            del self.timerevents[ttime]
         del self.timerlookup[name]
     except KeyError:
       self.api('send.msg')('timer %s does not exist' % name)
@@ -347,6 +350,16 @@ class Plugin(BasePlugin):
     if name in self.timerlookup:
       self.timerlookup[name].enabled = flag
 
+  # get the time that the next timer is due
+  def api_nextcall(self):
+    """  get the time of the next timer
+    this function returns the time (seconds since the epoch) that the next
+    timer is due, None if there are no timers"""
+    if self.timerevents:
+      return min(self.timerevents)
+
+    return None
+
   def _addtimer(self, timer):
     """
     internally add a timer
@@ -365,10 +378,12 @@ class Plugin(BasePlugin):
     check all timers
     """
     ntime = int(time.time())
-    if ntime - self.lasttime > 1:
-      self.api('send.msg')('timer had to check multiple seconds')
-    for i in range(self.lasttime, ntime + 1):
-      if i in self.timerevents and self.timerevents[i]:
+    # the event loop only raises global_timer when a timer is due, so go
+    # through the times that have passed instead of every second
+    for i in sorted([ttime for ttime in self.timerevents if ttime <= ntime]):
+      if i in self.timerevents and not self.timerevents[i]:
+        del self.timerevents[i]
+      elif i in self.timerevents:
         for timer in self.timerevents[i][:]:
           if timer.enabled:
             try:
@@ -395,7 +410,7 @@ class Plugin(BasePlugin):
             self._addtimer(timer)
           else:
             self.api('timers.remove')(timer.name)
-          if not self.timerevents[i]:
+          if i in self.timerevents and not self.timerevents[i]:
             del self.timerevents[i]
 
     self.lasttime = ntime
@@ -23,6 +23,9 @@ PRIORITY = 25
 # This keeps the plugin from being autoloaded if set to False
 AUTOLOAD = True
 
+# events raised by checktrigger for lines that no trigger has to match
+LINEEVENTS = ['trigger_beall', 'trigger_all', 'trigger_emptyline']
+
 class Plugin(BasePlugin):
   """
   a plugin to handle internal triggers
@@ -44,6 +47,9 @@ class Plugin(BasePlugin):
     self.regex['color'] = ""
     self.regex['noncolor'] = ""
 
+    # the events in LINEEVENTS that have functions registered
+    self.listened = set()
+
     self.api('api.add')('add', self.api_addtrigger)
     self.api('api.add')('remove', self.api_remove)
     self.api('api.add')('toggle', self.api_toggle)
@@ -61,7 +67,7 @@ class Plugin(BasePlugin):
 
     self.api('setting.add')('enabled', 'True', bool,
                             'enable triggers')
-    self.api('events.register')('var_%s_echo' % self.sname, self.enablechange)
+    self.api('events.register')('var_%s_enabled' % self.sname, self.enablechange)
 
     parser = argp.ArgumentParser(add_help=False,
                                  description='get details of a trigger')
@@ -84,19 +90,47 @@ class Plugin(BasePlugin):
                              parser=parser)
 
     self.api('events.register')('plugin_unloaded', self.pluginunloaded)
+    for eventname in LINEEVENTS:
+      self.api('events.register')('events_%s_changed' % eventname,
+                                  self.enablechange)
 
-    self.api('events.register')('from_mud_event',
-                                self.checktrigger, prio=1)
+    self.updateregistration()
+
+  def enablechange(self, args): # pylint: disable=unused-argument
+    """
+    setup the plugin on setting change or when functions register with
+    or unregister from the line events
+    """
+    self.updateregistration()
 
-  def enablechange(self, args):
+  def linelisteners(self):
+    """
+    return the events in LINEEVENTS that have functions registered
     """
-    setup the plugin on setting change
+    listened = set()
+    for eventname in LINEEVENTS:
+      event = self.api('events.gete')(eventname)
+      if event is not None and event.hasactive():
+        listened.add(eventname)
+    return listened
+
+  def updateregistration(self):
     """
-    change = args['newvalue']
-    if change:
+    only look at mud data when triggers are enabled and there is an
+    enabled trigger or a function registered to trigger_beall,
+    trigger_all or trigger_emptyline, so the mud can pass data straight
+    through otherwise
+    """
+    self.listened = self.linelisteners()
+    needed = self.api('setting.gets')('enabled') and \
+        (bool([trig for trig in self.uniquelookup.values() if trig['enabled']])
+         or bool(self.listened))
+    registered = self.api('events.isregistered')('from_mud_event',
+                                                 self.checktrigger)
+    if needed and not registered:
       self.api('events.register')('from_mud_event',
                                   self.checktrigger, prio=1)
-    else:
+    elif registered and not needed:
       self.api('events.unregister')('from_mud_event',
                                     self.checktrigger)
 
@@ -130,10 +164,15 @@ class Plugin(BasePlugin):
     else:
       self.regex['color'] = ""
 
-    try:
-      self.regex['noncolor'] = re.compile("|".join(noncolorres))
-    except re.error:
-      self.api('send.traceback')('Could not compile regex')
+    if noncolorres:
+      try:
+        self.regex['noncolor'] = re.compile("|".join(noncolorres))
+      except re.error:
+        self.api('send.traceback')('Could not compile regex')
+    else:
+      self.regex['noncolor'] = ""
+
+    self.updateregistration()
 
   @staticmethod
   def getuniquename(name):
@@ -380,19 +419,26 @@ class Plugin(BasePlugin):
     check a line of text from the mud to see if it matches any triggers
     called whenever the from_mud_event is raised
     """
-    data = args['noansi']
-    colordata = args['convertansi']
-
-    self.raisetrigger('beall',
-                      {'line':data, 'triggername':'all'},
-                      args)
+    # the noansi and colorline views of a line are only computed when
+    # something uses them
+    data = None
+    colordata = None
+    if self.listened or self.regex['noncolor']:
+      data = args.noansi
+
+    if 'trigger_beall' in self.listened:
+      self.raisetrigger('beall',
+                        {'line':data, 'triggername':'all'},
+                        args)
 
     if data == '': # pylint: disable=too-many-nested-blocks
-      self.raisetrigger('emptyline',
-                        {'line':'', 'triggername':'emptyline'},
-                        args)
+      if 'trigger_emptyline' in self.listened:
+        self.raisetrigger('emptyline',
+                          {'line':'', 'triggername':'emptyline'},
+                          args)
     else:
       if self.regex['color']:
+        colordata = args.colorline
         colormatch = self.regex['color'].match(colordata)
       else:
         colormatch = None
@@ -401,6 +447,10 @@ class Plugin(BasePlugin):
       else:
         noncolormatch = None
       if colormatch or noncolormatch:
+        if data is None:
+          data = args.noansi
+        if colordata is None:
+          colordata = args.colorline
         matches = []
         triggers = sorted(self.uniquelookup,
                           key=lambda item: self.uniquelookup[item]['priority'])
@@ -411,13 +461,13 @@ class Plugin(BasePlugin):
             if colormatch:
               groups = colormatch.groupdict()
               if trig in groups and groups[trig]:
-                self.api('send.msg')('color matched line %s to trigger %s' % (colordata,
-                                                                              trig))
+                self.api('send.msgf')('color matched line %s to trigger %s',
+                                      colordata, trig)
                 match = self.uniquelookup[trig]['compiled'].match(colordata)
             elif noncolormatch:
               groups = noncolormatch.groupdict()
               if trig in groups and groups[trig]:
-                self.api('send.msg')('matched line %s to trigger %s' % (data, trig))
+                self.api('send.msgf')('matched line %s to trigger %s', data, trig)
                 match = self.uniquelookup[trig]['compiled'].match(data)
             if match:
               targs = match.groupdict()
@@ -438,7 +488,8 @@ class Plugin(BasePlugin):
         if len(matches) > 1:
           self.api('send.error')('line %s matched multiple triggers %s' % (data, matches))
 
-    self.raisetrigger('all', {'line':data, 'triggername':'all'}, args)
+    if 'trigger_all' in self.listened:
+      self.raisetrigger('all', {'line':data, 'triggername':'all'}, args)
     return args
 
   def raisetrigger(self, triggername, args, origargs):
@@ -453,14 +504,13 @@ class Plugin(BasePlugin):
       origargs['omit'] = True
 
     tdat = self.api('events.eraise')(eventname, args)
-    self.api('send.msg')('trigger raiseevent returned: %s' % tdat)
+    self.api('send.msgf')('trigger raiseevent returned: %s', tdat)
     if tdat and 'newline' in tdat:
       self.api('send.msg')('changing line from trigger')
       ndata = self.api('colors.convertcolors')(tdat['newline'])
-      origargs['trace']['changes'].append({'flag':'Modify',
-                                           'data':'trigger "%s" changed "%s" to "%s"' % \
-                                              (triggername, origargs['original'], ndata),
-                                           'plugin':self.sname})
+      origargs['trace'].add('Modify', self.sname,
+                            'trigger "%s" changed "%s" to "%s"',
+                            triggername, origargs['original'], ndata)
       origargs['original'] = ndata
 
     if (tdat and 'omit' in tdat and tdat['omit']) or \
@@ -468,11 +518,9 @@ class Plugin(BasePlugin):
       plugin = self.sname
       if triggername in self.triggers:
         plugin = self.triggers[triggername]['plugin']
-      origargs['trace']['changes'].append(
-          {'flag':'Omit',
-           'data':'by trigger "%s" added by plugin "%s"' % \
-              (triggername, plugin),
-           'plugin':self.sname,})
+      origargs['trace'].add('Omit', self.sname,
+                            'by trigger "%s" added by plugin "%s"',
+                            triggername, plugin)
       origargs['original'] = ""
       origargs['omit'] = True
 
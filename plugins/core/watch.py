@@ -213,10 +213,9 @@ class Plugin(BasePlugin):
         tdata = self.api('events.eraise')('watch_' + i, targs)
         if 'changed' in tdata:
           if 'trace' in data:
-            data['trace']['changes'].append({'cmd':tdat,
-                                             'flag':'modify',
-                                             'newcmd':tdata['changed'],
-                                             'plugin':self.sname})
+            data['trace'].add('modify', self.sname, 'changed "%s" to "%s"',
+                              tdat, tdata['changed'], cmd=tdat,
+                              newcmd=tdata['changed'])
           data['nfromdata'] = tdata['changed']
 
     if 'nfromdata' in data:
@@ -0,0 +1,69 @@
+"""
+this module handles telnet option 25, End of Record
+
+when the mud sends IAC WILL EOR, the proxy answers with IAC DO EOR and
+the mud then sends IAC EOR after each prompt, see libs/net/mud.py
+"""
+from libs.net._basetelnetoption import BaseTelnetOption
+from libs.net.telnetlib import WILL, WONT, DO, DONT, IAC, EOR
+from plugins._baseplugin import BasePlugin
+
+NAME = 'End of Record Telnet Option'
+SNAME = 'EOR'
+PURPOSE = 'Handle telnet option 25, end of record'
+AUTHOR = 'Bast'
+VERSION = 1
+PRIORITY = 35
+
+AUTOLOAD = True
+
+# Plugin
+class Plugin(BasePlugin):
+  """
+  the plugin to handle the End of Record telnet option
+  """
+  def __init__(self, *args, **kwargs):
+    """
+    Iniitilaize the class
+    """
+    BasePlugin.__init__(self, *args, **kwargs)
+
+    self.canreload = False
+
+  def load(self):
+    BasePlugin.load(self)
+
+    self.api('options.addserveroption')(self.sname, SERVER)
+
+class SERVER(BaseTelnetOption):
+  """
+  the end of record class for the server
+  """
+  def __init__(self, telnetobj):
+    """
+    initialize the instance
+    """
+    BaseTelnetOption.__init__(self, telnetobj, EOR, SNAME)
+    #self.telnetobj.debug_types.append('EOR')
+
+  def handleopt(self, command, sbdata):
+    """
+    handle the opt
+    """
+    self.telnetobj.msg('%s - in handleopt' % self.telnetobj.ccode(command),
+                       mtype='EOR')
+    if command == WILL:
+      self.telnetobj.msg('sending IAC DO EOR', mtype='EOR')
+      self.telnetobj.options[ord(EOR)] = True
+      self.telnetobj.send("".join([IAC, DO, EOR]))
+    elif command == WONT:
+      self.telnetobj.options[ord(EOR)] = False
+
+  def reset(self, onclose=False):
+    """
+    reset the opt
+    """
+    self.telnetobj.msg('resetting', mtype='EOR')
+    if not onclose:
+      self.telnetobj.addtooutbuffer("".join([IAC, DONT, EOR]), True)
+    BaseTelnetOption.reset(self)
@@ -66,6 +66,8 @@ class Plugin(BasePlugin):
     self.api('events.register')('GMCP_from_client', self.gmcpfromclient)
     self.api('events.register')('GMCP:server-enabled', self.gmcprequest)
     self.api('events.register')('muddisconnect', self.gmcpdisconnect)
+    self.api('events.register')('proxy_hotrestart', self.savehotrestart)
+    self.api('events.register')('proxy_restored', self.restorehotrestart)
 
     self.api('options.addserveroption')(self.sname, SERVER)
     self.api('options.addclientoption')(self.sname, CLIENT)
@@ -134,6 +136,21 @@ class Plugin(BasePlugin):
                 (IAC, SB, GMCP, message.replace(IAC, IAC+IAC), IAC, SE),
                          raw=True, dtype=GMCP)
 
+  def savehotrestart(self, args):
+    """
+    keep the cache and the module states across a hot restart
+    """
+    args['state'][self.sname] = {'gmcpcache':self.gmcpcache,
+                                 'modstates':self.modstates}
+
+  def restorehotrestart(self, args):
+    """
+    restore the cache and the module states after a hot restart
+    """
+    if self.sname in args['state']:
+      self.gmcpcache = args['state'][self.sname]['gmcpcache']
+      self.modstates = args['state'][self.sname]['modstates']
+
   def gmcpdisconnect(self, _=None):
     """
     disconnect
@@ -367,6 +384,8 @@ class CLIENT(BaseTelnetOption):
     """
     BaseTelnetOption.__init__(self, telnetobj, GMCP, SNAME)
     #self.telnetobj.debug_types.append('GMCP')
+    if self.telnetobj.restoring:
+      return
     self.telnetobj.msg('sending IAC WILL GMCP', mtype='GMCP')
     self.telnetobj.addtooutbuffer("".join([IAC, WILL, GMCP]), True)
 
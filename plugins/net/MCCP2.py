@@ -1,9 +1,36 @@
 """
 This module handles telnet option 86, MCCP v2
+
+Output to clients is compressed per pass of the reactor, not per line.
+
+Clients that have been sent the same bytes since their compressed
+streams started share one zlib stream (SharedStream), so data sent to
+all clients is compressed once and the output is reused. A client that
+is sent something the others are not (command output, a message for
+one client) is split off into its own stream at that point.
+
+Clients with their own stream, such as clients that connect later, are
+moved back to the broadcast stream at most once every regroup seconds:
+the broadcast stream is ended and a new one is started at a flush
+boundary, and the clients are told to restart decompression with
+IAC SB MCCP2 IAC SE.
+
+The compression level is picked by the plugin every ADAPTINTERVAL
+seconds: it is lowered when compressing uses more than cpubudget
+percent of the cpu and raised (up to the level setting) when there is
+room and the higher level compresses better. A new level is used from
+the next restart of the broadcast stream. Clients on the local machine
+or a private network can be left uncompressed with the nolocal setting.
+
+A zlib stream can't be handed to a new process, so for a hot restart
+the mud is asked to end its compressed stream (IAC DONT MCCP2) before
+the handoff and to start a new one after it, and the clients' streams
+are ended before the handoff and restarted after it.
 """
+import time
 import zlib
 from libs.net._basetelnetoption import BaseTelnetOption
-from libs.net.telnetlib import WILL, DO, IAC, SE, SB, DONT, CODES
+from libs.net.telnetlib import WILL, WONT, DO, IAC, SE, SB, DONT, CODES
 from plugins._baseplugin import BasePlugin
 
 NAME = 'MCCP2'
@@ -19,6 +46,146 @@ MCCP2 = chr(86)  # Mud Compression Protocol, v2
 
 CODES[86] = '<MCCP2>'
 
+STARTSTREAM = "".join([IAC, SB, MCCP2, IAC, SE])
+
+# the seconds between level decisions
+ADAPTINTERVAL = 10
+
+# the levels the controller moves between
+LEVELS = [1, 3, 6, 9]
+
+def islocal(host):
+  """
+  check if an address is on the local machine or a private network
+  """
+  if not host:
+    return False
+  if host in ['localhost', '::1'] or host.startswith('127.') or \
+      host.startswith('10.') or host.startswith('192.168.') or \
+      host.lower().startswith('fe80:') or host.lower()[:2] in ['fc', 'fd']:
+    return True
+  if host.startswith('172.'):
+    parts = host.split('.')
+    return len(parts) > 1 and parts[1].isdigit() and 16 <= int(parts[1]) <= 31
+  return False
+
+class SharedStream(object):
+  """
+  a zlib stream shared by clients that were sent the same data
+
+  every member is either at the head of the stream (seq) or one
+  compress behind it, the state before the last compress is kept in
+  prevcomp so a member that is behind can be split off
+  """
+  def __init__(self, plugin, comp=None, level=None):
+    """
+    initialize the instance
+    """
+    self.plugin = plugin
+    self.level = level or plugin.level
+    self.comp = comp or zlib.compressobj(self.level)
+    self.prevcomp = None
+    self.seq = 0
+    self.lastdata = None
+    self.lastout = None
+    self.members = {}
+    # the seq of the last restart, the bytes that ended the old stream
+    # and the bytes that start the new one
+    self.restartseq = None
+    self.restartend = ''
+    self.restartstart = ''
+    self.lastpass = None
+    self.bytesin = 0
+    self.bytesout = 0
+    self.comptime = 0
+
+  def add(self, member):
+    """
+    add a member at the head of the stream
+    """
+    self.members[member] = self.seq
+    member.stream = self
+
+  def detach(self, member):
+    """
+    remove a member and return a compressor at its position
+    """
+    pos = self.members.pop(member)
+    if pos == self.seq:
+      if self.members:
+        return self.comp.copy()
+      return self.comp
+    return self.prevcomp.copy()
+
+  def split(self, member):
+    """
+    move a member to a stream of its own
+    """
+    self.plugin.splits = self.plugin.splits + 1
+    SharedStream(self.plugin, self.detach(member), self.level).add(member)
+
+  def advance(self, data, restart=False, member=None):
+    """
+    compress data at the head of the stream, members that are behind
+    did not get the last data and are split off first
+    """
+    for other in [i for i in self.members if self.members[i] != self.seq]:
+      self.split(other)
+
+    if [i for i in self.members if i is not member]:
+      self.prevcomp = self.comp.copy()
+    else:
+      self.prevcomp = None
+    self.lastpass = self.plugin.passes()
+    if restart:
+      self.plugin.restarts = self.plugin.restarts + 1
+      self.plugin.lastregroup = time.time()
+      self.restartend = self.comp.flush()
+      self.level = self.plugin.level
+      self.comp = zlib.compressobj(self.level)
+      self.restartstart = "".join([STARTSTREAM, self.compress(data)])
+      self.restartseq = self.seq + 1
+      self.lastout = "".join([self.restartend, self.restartstart])
+    else:
+      self.lastout = self.compress(data)
+    self.lastdata = data
+    self.seq = self.seq + 1
+
+  def compress(self, data):
+    """
+    compress data and flush it
+    """
+    start = time.time()
+    output = "".join([self.comp.compress(data),
+                      self.comp.flush(zlib.Z_SYNC_FLUSH)])
+    elapsed = time.time() - start
+    self.bytesin = self.bytesin + len(data)
+    self.bytesout = self.bytesout + len(output)
+    self.comptime = self.comptime + elapsed
+    self.plugin.measure(self.level, len(data), len(output), elapsed)
+    return output
+
+  def get(self, member, data, restart=False):
+    """
+    return the compressed data for a member, None if the member
+    was not sent the same data as the stream
+    """
+    pos = self.members[member]
+    if pos == self.seq:
+      self.advance(data, restart, member)
+    elif pos != self.seq - 1 or data != self.lastdata:
+      return None
+    else:
+      self.plugin.shared = self.plugin.shared + 1
+    self.members[member] = self.seq
+    return self.lastout
+
+  def end(self, member):
+    """
+    remove a member and return the bytes that end its stream
+    """
+    return self.detach(member).flush()
+
 # Plugin
 class Plugin(BasePlugin):
   """
@@ -32,12 +199,186 @@ class Plugin(BasePlugin):
 
     self.canreload = False
 
+    self.broadcast = None
+    self.clients = set()
+    self.level = 9
+    self.lastregroup = 0
+    # per level: [bytes in, bytes out, seconds] since the last decision
+    # and the ratio and seconds per byte measured for each level
+    self.window = {}
+    self.measured = {}
+    self.windowstart = time.time()
+    self.cpuuse = 0.0
+    self.decision = 'none yet'
+    self.compressions = 0
+    self.shared = 0
+    self.splits = 0
+    self.restarts = 0
+
   def load(self):
     BasePlugin.load(self)
 
+    self.api('setting.add')('level', 9, int,
+                            'the highest zlib compression level for clients, 1-9')
+    self.api('setting.add')('adaptive', True, bool,
+                            'pick the level from cpu use and compression ratio')
+    self.api('setting.add')('cpubudget', 1.0, float,
+                            'the percent of cpu time compression can use')
+    self.api('setting.add')('nolocal', False, bool,
+                            'do not compress for clients on a local network')
+    self.api('setting.add')('regroup', 10, int,
+                            'seconds between moving clients back to the shared stream')
+
+    self.level = self.maxlevel()
+    self.api('timers.add')('mccp_adapt', self.adapt, ADAPTINTERVAL)
+
     self.api('options.addserveroption')(self.sname, SERVER)
     self.api('options.addclientoption')(self.sname, CLIENT)
 
+  def regroupdue(self):
+    """
+    check if clients should be moved back to the broadcast stream
+    """
+    if time.time() - self.lastregroup < self.api('setting.gets')('regroup'):
+      return False
+    if self.broadcast and self.broadcast.level != self.level:
+      return True
+    for client in self.clients:
+      if client.stream is not self.broadcast:
+        return True
+    return False
+
+  def maxlevel(self):
+    """
+    the level setting, kept between 1 and 9
+    """
+    return min(max(self.api('setting.gets')('level'), 1), 9)
+
+  def measure(self, level, bytesin, bytesout, elapsed):
+    """
+    record a compress
+    """
+    self.compressions = self.compressions + 1
+    if level not in self.window:
+      self.window[level] = [0, 0, 0]
+    window = self.window[level]
+    window[0] = window[0] + bytesin
+    window[1] = window[1] + bytesout
+    window[2] = window[2] + elapsed
+
+  def adapt(self):
+    """
+    pick the compression level for new streams from what was measured
+    since the last time
+    """
+    now = time.time()
+    elapsed = now - self.windowstart
+    self.windowstart = now
+    window = self.window
+    self.window = {}
+
+    comptime = sum([i[2] for i in window.values()])
+    self.cpuuse = comptime * 100 / elapsed if elapsed else 0.0
+    for level in window:
+      bytesin, bytesout, seconds = window[level]
+      if bytesin and bytesout:
+        self.measured[level] = (float(bytesin) / bytesout, seconds / bytesin)
+
+    maxlevel = self.maxlevel()
+    if not self.api('setting.gets')('adaptive'):
+      self.setlevel(maxlevel, 'adaptive is off')
+      return True
+
+    if not comptime:
+      return True
+
+    budget = self.api('setting.gets')('cpubudget')
+    lower = [i for i in LEVELS if i < self.level]
+    higher = [i for i in LEVELS if self.level < i <= maxlevel]
+    if self.level > maxlevel:
+      self.setlevel(maxlevel, 'level setting is %s' % maxlevel)
+    elif self.cpuuse > budget and lower:
+      self.setlevel(lower[-1], 'cpu %.2f%% is over the budget of %.2f%%' % \
+                                  (self.cpuuse, budget))
+    elif self.cpuuse < budget / 4 and higher:
+      newlevel = higher[0]
+      if newlevel in self.measured:
+        # the higher level was tried, go back to it only if it
+        # compressed better and would have stayed in the budget
+        bytesin = sum([i[0] for i in window.values()])
+        ratio, perbyte = self.measured[newlevel]
+        if self.level in self.measured and \
+            ratio < self.measured[self.level][0] * 1.02:
+          return True
+        if perbyte * bytesin * 100 / elapsed > budget:
+          return True
+      self.setlevel(newlevel, 'cpu %.2f%% leaves room in the budget of %.2f%%' % \
+                                 (self.cpuuse, budget))
+    return True
+
+  def setlevel(self, level, reason):
+    """
+    set the level for new streams
+    """
+    if level == self.level:
+      return
+    self.decision = 'level %s -> %s: %s' % (self.level, level, reason)
+    self.api('send.msg')(self.decision)
+    self.level = level
+
+  def passes(self):
+    """
+    the number of passes the reactor has made, a pass is a flush boundary
+    """
+    reactor = self.api('managers.getm')('reactor')
+    return reactor.passes if reactor else 0
+
+  def getstats(self):
+    """
+    return stats for this plugin
+    """
+    stats = BasePlugin.getstats(self)
+
+    stats['Client Compression'] = {}
+    stats['Client Compression']['showorder'] = ['Compressions', 'Shared',
+                                                'Splits', 'Restarts',
+                                                'Broadcast Clients']
+    stats['Client Compression']['Compressions'] = self.compressions
+    stats['Client Compression']['Shared'] = self.shared
+    stats['Client Compression']['Splits'] = self.splits
+    stats['Client Compression']['Restarts'] = self.restarts
+    stats['Client Compression']['Broadcast Clients'] = \
+        len(self.broadcast.members) if self.broadcast else 0
+
+    stats['Compression Level'] = {}
+    stats['Compression Level']['showorder'] = ['Level', 'CPU Use',
+                                               'CPU Budget', 'Last Decision']
+    stats['Compression Level']['Level'] = self.level
+    stats['Compression Level']['CPU Use'] = '%.2f%%' % self.cpuuse
+    stats['Compression Level']['CPU Budget'] = '%.2f%%' % \
+                                    self.api('setting.gets')('cpubudget')
+    stats['Compression Level']['Last Decision'] = self.decision
+    for level in sorted(self.measured):
+      name = 'Level %s' % level
+      stats['Compression Level']['showorder'].append(name)
+      stats['Compression Level'][name] = 'ratio %.2f, %.1f us/KB' % \
+          (self.measured[level][0], self.measured[level][1] * 1024 * 1000000)
+
+    stats['Clients'] = {}
+    stats['Clients']['showorder'] = []
+    for client in self.clients:
+      stream = client.stream
+      name = '%s:%s' % (client.telnetobj.host, client.telnetobj.port)
+      stats['Clients']['showorder'].append(name)
+      stats['Clients'][name] = 'level %s, ratio %.2f, %.1f us/KB%s' % \
+          (stream.level,
+           float(stream.bytesin) / stream.bytesout if stream.bytesout else 0,
+           stream.comptime * 1024 * 1000000 / stream.bytesin \
+                  if stream.bytesin else 0,
+           ', shared' if stream is self.broadcast and \
+                  len(stream.members) > 1 else '')
+    return stats
+
 class SERVER(BaseTelnetOption):
   """
   the mccp option class to connect to a server
@@ -48,8 +389,10 @@ class SERVER(BaseTelnetOption):
     """
     BaseTelnetOption.__init__(self, telnetobj, MCCP2, SNAME)
     #self.telnetobj.debug_types.append('MCCP2')
-    self.orig_readdatafromsocket = None
+    self.orig_convert_indata = None
     self.zlib_decomp = None
+    # set when the mud was asked to end the stream for a hot restart
+    self.paused = False
 
   def handleopt(self, command, sbdata):
     """
@@ -68,6 +411,8 @@ class SERVER(BaseTelnetOption):
                          mtype='MCCP2')
       self.telnetobj.options[ord(MCCP2)] = True
       self.negotiate()
+      # everything after this is compressed
+      return True
 
   def negotiate(self):
     """
@@ -75,33 +420,88 @@ class SERVER(BaseTelnetOption):
     """
     self.telnetobj.msg('negotiating', mtype='MCCP2')
     self.zlib_decomp = zlib.decompressobj(15)
-    # decompress the raw queue
-    if self.telnetobj.rawq:
-      self.telnetobj.msg('converting rawq in handleopt',
-                         mtype='MCCP2')
-      try:
-        rawq = self.zlib_decomp.decompress(self.telnetobj.rawq)
-        self.telnetobj.rawq = rawq
-        self.telnetobj.process_rawq()
-      except Exception: # pylint: disable=broad-except
-        self.telnetobj.handle_error()
-
-    # replace the readdatafromsocket function with one that decompresses the stream
-    orig_readdatafromsocket = self.telnetobj.readdatafromsocket
-    self.orig_readdatafromsocket = orig_readdatafromsocket
-    def mccp_readdatafromsocket():
+
+    # replace the convert_indata function with one that decompresses the stream
+    orig_convert_indata = self.telnetobj.convert_indata
+    self.orig_convert_indata = orig_convert_indata
+    def mccp_convert_indata(data):
       """
       decompress the data
       """
       # give the original func a chance to munge the data
-      data = orig_readdatafromsocket()
+      data = orig_convert_indata(data)
 
       self.telnetobj.msg('decompressing', mtype='MCCP2')
 
       # now do our work when returning the data
-      return self.zlib_decomp.decompress(data)
+      decomp = self.zlib_decomp
+      data = decomp.decompress(data)
+      if decomp.unused_data or (self.paused and self.streamended()):
+        # the mud ended the stream, the rest is not compressed
+        data = "".join([data, decomp.unused_data])
+        self.endstream()
+      return data
+
+    setattr(self.telnetobj, 'convert_indata', mccp_convert_indata)
+
+  def streamended(self):
+    """
+    check if the compressed stream from the mud has ended, a stream
+    that has ended puts anything after it in unused_data
+    """
+    test = self.zlib_decomp.copy()
+    try:
+      test.decompress(IAC)
+    except zlib.error:
+      return False
+    return bool(test.unused_data)
+
+  def endstream(self):
+    """
+    the mud ended the compressed stream
+    """
+    self.telnetobj.msg('stream ended by the server', mtype='MCCP2')
+    if self.orig_convert_indata:
+      setattr(self.telnetobj, 'convert_indata', self.orig_convert_indata)
+      self.orig_convert_indata = None
+    self.zlib_decomp = None
+    self.telnetobj.options[ord(MCCP2)] = False
+
+  def handoffready(self):
+    """
+    the stream can't be handed to a new process, ask the mud to
+    end it
+    """
+    if not self.zlib_decomp:
+      return True
+    if not self.paused:
+      self.telnetobj.msg('sending IAC DONT MCCP2 for a hot restart',
+                         mtype='MCCP2')
+      self.paused = True
+      self.telnetobj.addtooutbuffer("".join([IAC, DONT, MCCP2]), True)
+    return False
+
+  def cancelhandoff(self):
+    """
+    ask the mud to compress again
+    """
+    if self.paused and not self.zlib_decomp:
+      self.telnetobj.addtooutbuffer("".join([IAC, DO, MCCP2]), True)
+    self.paused = False
+
+  def getstate(self):
+    """
+    the mud was asked to stop compressing before the hot restart
+    """
+    return self.paused or None
 
-    setattr(self.telnetobj, 'readdatafromsocket', mccp_readdatafromsocket)
+  def setstate(self, state):
+    """
+    ask the mud to start compressing again
+    """
+    self.telnetobj.msg('sending IAC DO MCCP2 after a hot restart',
+                       mtype='MCCP2')
+    self.telnetobj.addtooutbuffer("".join([IAC, DO, MCCP2]), True)
 
   def reset(self, onclose=False):
     """
@@ -109,9 +509,11 @@ class SERVER(BaseTelnetOption):
     """
     self.telnetobj.msg('resetting', mtype='MCCP2')
     self.telnetobj.addtooutbuffer("".join([IAC, DONT, MCCP2]), True)
-    self.telnetobj.rawq = self.zlib_decomp.decompress(self.telnetobj.rawq)
-    setattr(self.telnetobj, 'readdatafromsocket',
-            self.orig_readdatafromsocket)
+    if self.orig_convert_indata:
+      setattr(self.telnetobj, 'convert_indata', self.orig_convert_indata)
+      self.orig_convert_indata = None
+    self.zlib_decomp = None
+    self.paused = False
     BaseTelnetOption.reset(self)
 
 class CLIENT(BaseTelnetOption):
@@ -124,7 +526,14 @@ class CLIENT(BaseTelnetOption):
     """
     BaseTelnetOption.__init__(self, telnetobj, MCCP2, SNAME)
     self.orig_convert_outdata = None
-    self.zlib_comp = None
+    self.stream = None
+    self.local = self.plugin.api('setting.gets')('nolocal') and \
+                    islocal(self.telnetobj.host)
+    if self.local:
+      self.telnetobj.msg('local client, not offering MCCP2', mtype='MCCP2')
+      return
+    if self.telnetobj.restoring:
+      return
     self.telnetobj.msg('sending IAC WILL MCCP2', mtype='MCCP2')
     self.telnetobj.send("".join([IAC, WILL, MCCP2]))
 
@@ -134,8 +543,10 @@ class CLIENT(BaseTelnetOption):
     """
     self.telnetobj.msg('%s - in handleopt' % (ord(command)),
                        mtype='MCCP2')
-
     if command == DO:
+      if self.local:
+        self.telnetobj.send("".join([IAC, WONT, MCCP2]))
+        return
       self.telnetobj.options[ord(MCCP2)] = True
       self.negotiate()
 
@@ -145,11 +556,21 @@ class CLIENT(BaseTelnetOption):
     """
     self.telnetobj.msg("starting mccp", level=2, mtype='MCCP2')
     self.telnetobj.msg('sending IAC SB MCCP2 IAC SE', mtype='MCCP2')
-    self.telnetobj.send("".join([IAC, SB, MCCP2, IAC, SE]))
+    self.telnetobj.send(STARTSTREAM)
+    self.startstream()
+    self.telnetobj.outbuffer.append(
+        self.convert(self.telnetobj.outbuffer.drain()))
 
-    self.zlib_comp = zlib.compressobj(9)
-    self.telnetobj.outbuffer = \
-                      self.zlib_comp.compress(self.telnetobj.outbuffer)
+  def startstream(self):
+    """
+    start compressing the output
+    """
+    # start on a stream of our own, it becomes the broadcast stream
+    # if there isn't one
+    SharedStream(self.plugin).add(self)
+    self.plugin.clients.add(self)
+    if not self.plugin.broadcast or not self.plugin.broadcast.members:
+      self.plugin.broadcast = self.stream
 
     orig_convert_outdata = self.telnetobj.convert_outdata
     self.orig_convert_outdata = orig_convert_outdata
@@ -160,11 +581,69 @@ class CLIENT(BaseTelnetOption):
       """
       data = orig_convert_outdata(data)
       self.telnetobj.msg('compressing', mtype='MCCP2')
-      return "".join([self.zlib_comp.compress(data),
-                      self.zlib_comp.flush(zlib.Z_SYNC_FLUSH)])
+      return self.convert(data)
 
     setattr(self.telnetobj, 'convert_outdata', mccp_convert_outdata)
 
+  def convert(self, data):
+    """
+    compress data, sharing the output with other clients when possible
+    """
+    if not data:
+      return data
+
+    broadcast = self.plugin.broadcast
+    if self.stream is not broadcast:
+      if not broadcast.members:
+        # nobody is left on the broadcast stream, this one takes over
+        self.plugin.broadcast = self.stream
+      elif broadcast.restartseq == broadcast.seq and \
+          data == broadcast.lastdata:
+        # the broadcast stream restarted with this data, switch to it
+        return self.join(broadcast.restartstart)
+      elif broadcast.lastpass != self.plugin.passes() and \
+          self.plugin.regroupdue():
+        # nobody on the broadcast stream has been sent anything in
+        # this pass, restart it with this data and switch to it
+        broadcast.advance(data, restart=True)
+        return self.join(broadcast.restartstart)
+
+    restart = self.stream is broadcast and self.plugin.regroupdue()
+    output = self.stream.get(self, data, restart)
+    if output is None:
+      self.stream.split(self)
+      output = self.stream.get(self, data)
+    return output
+
+  def join(self, start):
+    """
+    end our stream and join the broadcast stream at its head
+    """
+    end = self.stream.end(self)
+    self.plugin.broadcast.add(self)
+    return "".join([end, start])
+
+  def getstate(self):
+    """
+    end the compressed stream for a hot restart
+    """
+    if not self.stream:
+      return None
+    self.telnetobj.flush()
+    self.telnetobj.outbuffer.append(self.stream.end(self))
+    self.stream = None
+    self.plugin.clients.discard(self)
+    return True
+
+  def setstate(self, state):
+    """
+    start a new compressed stream after what was sent before the
+    hot restart
+    """
+    self.telnetobj.msg('restarting mccp', mtype='MCCP2')
+    self.telnetobj.outbuffer.append(STARTSTREAM)
+    self.startstream()
+
   def reset(self, onclose=False):
     """
     reset the option
@@ -172,7 +651,14 @@ class CLIENT(BaseTelnetOption):
     self.telnetobj.msg('resetting', mtype='MCCP2')
     if not onclose:
       self.telnetobj.addtooutbuffer("".join([IAC, DONT, MCCP2]), True)
-    setattr(self.telnetobj, 'convert_outdata', self.orig_convert_outdata)
-    self.telnetobj.outbuffer = \
-                        self.zlib_comp.uncompress(self.telnetobj.outbuffer)
+    if self.stream:
+      # compress anything that has not been flushed yet
+      self.telnetobj.flush()
+      # end the compressed stream, the data already in the buffer
+      # has been compressed
+      self.telnetobj.outbuffer.append(self.stream.end(self))
+      self.stream = None
+      self.plugin.clients.discard(self)
+    if self.orig_convert_outdata:
+      setattr(self.telnetobj, 'convert_outdata', self.orig_convert_outdata)
     BaseTelnetOption.reset(self)
@@ -73,6 +73,8 @@ class CLIENT(BaseTelnetOption):
     """
     BaseTelnetOption.__init__(self, telnetobj, TTYPE, SNAME)
     #self.telnetobj.debug_types.append('TTYPE')
+    if self.telnetobj.restoring:
+      return
     self.telnetobj.msg('sending IAC WILL TTYPE', mtype='TTYPE')
     self.telnetobj.addtooutbuffer("".join([IAC, DO, TTYPE]), True)
 
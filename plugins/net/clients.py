@@ -35,6 +35,7 @@ class Plugin(BasePlugin):
     self.api('api.add')('addbanned', self.api_addbanned)
     self.api('api.add')('checkbanned', self.api_checkbanned)
     self.api('api.add')('numconnected', self.api_numconnected)
+    self.api('api.add')('addrestored', self.api_addrestored)
 
   def load(self):
     """
@@ -42,6 +43,13 @@ class Plugin(BasePlugin):
     """
     BasePlugin.load(self)
 
+    self.api('setting.add')('highwater', 512, int,
+                            'KB buffered for a client before it is behind')
+    self.api('setting.add')('lowwater', 128, int,
+                            'KB buffered for a client when it has caught up')
+    self.api('setting.add')('slowpolicy', 'skip', str,
+                            'what to do with a client that is behind: drop, skip or disconnect')
+
     self.api('commands.add')('show',
                              self.cmd_show,
                              shelp='list clients that are connected')
@@ -54,6 +62,27 @@ class Plugin(BasePlugin):
 
     self.api('events.register')('client_disconnected', self.removeclient)
 
+    for setting in ['highwater', 'lowwater', 'slowpolicy']:
+      self.api('events.register')('var_%s_%s' % (self.sname, setting),
+                                  self.backpressurechange)
+
+  def setbackpressure(self, client):
+    """
+    set the watermarks and slow client policy for a client
+    """
+    client.setbackpressure(self.api('setting.gets')('highwater') * 1024,
+                           self.api('setting.gets')('lowwater') * 1024,
+                           self.api('setting.gets')('slowpolicy'))
+
+  def backpressurechange(self, args): # pylint: disable=unused-argument
+    """
+    set the watermarks and policy for all clients when a setting changes
+    """
+    if self.api.loading:
+      return
+    for client in self.clients + self.vclients:
+      self.setbackpressure(client)
+
   def api_numconnected(self):
     """
     return the # of clients connected
@@ -77,17 +106,30 @@ class Plugin(BasePlugin):
       return True
     return False
 
+  # add a client from a hot restart
+  def api_addrestored(self, client):
+    """
+    add a client that was connected before a hot restart
+    """
+    if client.viewonly:
+      self.vclients.append(client)
+    else:
+      self.clients.append(client)
+    self.setbackpressure(client)
+
   def addclient(self, args):
     """
     add a client from the connected event
     """
     self.clients.append(args['client'])
+    self.setbackpressure(args['client'])
 
   def addviewclient(self, args):
     """
     add a view client from the connected event
     """
     self.vclients.append(args['client'])
+    self.setbackpressure(args['client'])
 
   def removeclient(self, args):
     """
@@ -103,9 +145,10 @@ class Plugin(BasePlugin):
     """
     close all clients
     """
-    for client in self.clients:
+    # closing a client removes it from the list
+    for client in self.clients[:]:
       client.handle_close()
-    for client in self.vclients:
+    for client in self.vclients[:]:
       client.handle_close()
 
   def api_getall(self):
@@ -119,23 +162,27 @@ class Plugin(BasePlugin):
     """
     show all clients
     """
-    clientformat = '%-6s %-17s %-7s %-17s %-s'
+    clientformat = '%-6s %-17s %-7s %-17s %-10s %-8s %-s'
     tmsg = ['']
     tmsg.append(clientformat % ('Type', 'Host', 'Port',
-                                'Client', 'Connected'))
-    tmsg.append('@B' + 60 * '-')
+                                'Client', 'Buffered', 'Dropped', 'Connected'))
+    tmsg.append('@B' + 75 * '-')
     for i in self.clients:
       ttime = self.api('utils.timedeltatostring')(
           i.connectedtime,
           time.localtime())
 
       tmsg.append(clientformat % ('Active', i.host[:17], i.port,
-                                  i.ttype[:17], ttime))
+                                  i.ttype[:17],
+                                  len(i.outbuffer) + i.backlogsize,
+                                  i.droppedlines, ttime))
     for i in self.vclients:
       ttime = self.api('utils.timedeltatostring')(
           i.connectedtime,
           time.localtime())
       tmsg.append(clientformat % ('View', i.host[:17], i.port,
-                                  i.ttype[:17], ttime))
+                                  i.ttype[:17],
+                                  len(i.outbuffer) + i.backlogsize,
+                                  i.droppedlines, ttime))
 
     return True, tmsg
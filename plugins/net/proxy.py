@@ -1,9 +1,18 @@
 """
 This plugin will show information about connections to the proxy
+
+A hot restart (#bp.proxy.restart) starts a new process with exec that
+takes over the listener, the mud connection and the clients: their
+sockets are inherited and the rest of their state is saved to a file
+that the new process reads. Plugins add their own state through the
+proxy_hotrestart event and get it back from the proxy_restored event.
 """
+import pickle
 import time
 import os
 import sys
+import libs.argp as argp
+from libs.net.telnetlib import inheritable
 from plugins._baseplugin import BasePlugin
 
 #these 5 are required
@@ -17,6 +26,9 @@ PRIORITY = 35
 # This keeps the plugin from being autoloaded if set to False
 AUTOLOAD = True
 
+# the seconds to wait for the mud connection to be ready for a hot restart
+HANDOFFWAIT = 10
+
 
 class Plugin(BasePlugin):
   """
@@ -33,8 +45,11 @@ class Plugin(BasePlugin):
     self.proxypw = None
     self.proxyvpw = None
     self.mudpw = None
+    self.handoffdeadline = None
 
     self.api('api.add')('restart', self.api_restart)
+    self.api('api.add')('hotrestart', self.api_hotrestart)
+    self.api('api.add')('restore', self.api_restore)
     self.api('api.add')('shutdown', self.api_shutdown)
 
   def load(self):
@@ -47,6 +62,16 @@ class Plugin(BasePlugin):
                             'the hostname/ip of the mud')
     self.api('setting.add')('mudport', 0, int,
                             'the port of the mud')
+    self.api('setting.add')('reconnect', True, bool,
+                            'reconnect when the connection to the mud is lost')
+    self.api('setting.add')('connecttimeout', 30, int,
+                            'the seconds to wait when connecting to the mud')
+    self.api('setting.add')('promptdelay', 0, int,
+                            'ms to wait before sending a partial line as a prompt, 0 is off')
+    self.api('setting.add')('nodelay', True, bool,
+                            'send small writes right away (TCP_NODELAY)')
+    self.api('setting.add')('cork', False, bool,
+                            'cork sockets while sending large output (TCP_CORK)')
     self.api('setting.add')('listenport', 9999, int,
                             'the port for the proxy to listen on')
     self.api('setting.add')('username', '', str,
@@ -66,9 +91,16 @@ class Plugin(BasePlugin):
                              self.cmd_connect,
                              shelp='connect to the mud')
 
+    parser = argp.ArgumentParser(add_help=False,
+                                 description='restart the proxy')
+    parser.add_argument('-c',
+                        "--cold",
+                        help="close all connections and start over",
+                        action='store_true')
     self.api('commands.add')('restart',
                              self.cmd_restart,
                              shelp='restart the proxy',
+                             parser=parser,
                              format=False)
 
     self.api('commands.add')('shutdown',
@@ -77,6 +109,10 @@ class Plugin(BasePlugin):
 
     self.api('events.register')('client_connected', self.client_connected)
     self.api('events.register')('mudconnect', self.sendusernameandpw)
+    self.api('events.register')('mudconnect', self.mudconnect)
+    self.api('events.register')('var_%s_nodelay' % self.sname, self.tcpoptionchange)
+    self.api('events.register')('var_%s_cork' % self.sname, self.tcpoptionchange)
+    self.api('events.register')('var_%s_promptdelay' % self.sname, self.promptdelaychange)
     self.api('events.register')('var_%s_listenport' % self.sname, self.listenportchange)
 
     ssc = self.api('ssc.baseclass')()
@@ -100,6 +136,42 @@ class Plugin(BasePlugin):
       self.api('send.mud')('\n')
       self.api('send.mud')('\n')
 
+  def settcpoptions(self, telnetobj):
+    """
+    set the tcp options for a connection
+    """
+    telnetobj.setnodelay(self.api('setting.gets')('nodelay'))
+    telnetobj.cork = self.api('setting.gets')('cork')
+
+  def mudconnect(self, args): # pylint: disable=unused-argument
+    """
+    set the tcp and prompt options when the proxy connects to the mud
+    """
+    mud = self.api('managers.getm')('mud')
+    self.settcpoptions(mud)
+    mud.promptdelay = self.api('setting.gets')('promptdelay')
+
+  def promptdelaychange(self, args): # pylint: disable=unused-argument
+    """
+    update the mud when the prompt delay changes
+    """
+    mud = self.api('managers.getm')('mud')
+    if mud:
+      mud.promptdelay = self.api('setting.gets')('promptdelay')
+
+  def tcpoptionchange(self, args): # pylint: disable=unused-argument
+    """
+    set the tcp options on all connections when a setting changes
+    """
+    if self.api.loading:
+      return
+    mud = self.api('managers.getm')('mud')
+    if mud and mud.connected:
+      self.settcpoptions(mud)
+    clients = self.api('clients.getall')()
+    for client in clients['active'] + clients['view']:
+      self.settcpoptions(client)
+
   def cmd_info(self, _):
     """
     show info about the proxy
@@ -113,6 +185,8 @@ class Plugin(BasePlugin):
         time.localtime())
 
     tmsg.append('@B-------------------  Proxy ------------------@w')
+    if self.api.SESSION:
+      tmsg.append(template % ('Session', self.api.SESSION))
     tmsg.append(template % ('Started', started))
     tmsg.append(template % ('Uptime', uptime))
     tmsg.append('')
@@ -148,12 +222,40 @@ class Plugin(BasePlugin):
     tmsg.extend(nmsg)
     return True, tmsg
 
+  def getstats(self):
+    """
+    return stats for the proxy
+    """
+    stats = BasePlugin.getstats(self)
+
+    reactor = self.api('managers.getm')('reactor')
+    if reactor:
+      rstats = reactor.getstats()
+      stats['Event Loop'] = {}
+      stats['Event Loop']['showorder'] = ['Backend', 'Passes', 'Events',
+                                          'Timer Checks', 'Dispatchers',
+                                          'Executor Jobs', 'Executor Threads',
+                                          'Write Requests', 'Send Calls',
+                                          'Syscalls Saved']
+      stats['Event Loop'].update(rstats)
+
+    mud = self.api('managers.getm')('mud')
+    if mud:
+      stats['Mud Reads'] = {}
+      stats['Mud Reads']['showorder'] = ['Read Events', 'Reads', 'Bytes Read',
+                                         'Bytes/Read', 'Reads/Event',
+                                         'Read Size', 'Passthrough Bytes']
+      stats['Mud Reads'].update(mud.getreadstats())
+      stats['Mud Reads']['Passthrough Bytes'] = mud.passthroughbytes
+
+    return stats
+
   def cmd_disconnect(self, args=None): # pylint: disable=unused-argument
     """
     disconnect from the mud
     """
     mud = self.api('managers.getm')('mud')
-    mud.handle_close()
+    mud.disconnect()
 
     return True, ['Attempted to close the connection to the mud']
 
@@ -166,7 +268,9 @@ class Plugin(BasePlugin):
       return True, ['The proxy is currently connected to the mud']
 
     mud.connectmud(self.api('setting.gets')('mudhost'),
-                   self.api('setting.gets')('mudport'))
+                   self.api('setting.gets')('mudport'),
+                   timeout=self.api('setting.gets')('connecttimeout'),
+                   reconnect=self.api('setting.gets')('reconnect'))
 
     return True, ['Connecting to the mud']
 
@@ -186,16 +290,20 @@ class Plugin(BasePlugin):
     """
     raise KeyboardInterrupt
 
-  def cmd_restart(self, args): # pylint: disable=unused-argument
+  def cmd_restart(self, args):
     """
     restart the proxy
     """
-    self.api('proxy.restart')()
+    if args['cold']:
+      self.api('proxy.restart')()
+    else:
+      self.api('proxy.hotrestart')()
 
   def client_connected(self, args): # pylint: disable=unused-argument
     """
     check for mud settings
     """
+    self.settcpoptions(args['client'])
     mud = self.api('managers.getm')('mud')
     tmsg = []
     divider = '@R------------------------------------------------@w'
@@ -254,18 +362,139 @@ class Plugin(BasePlugin):
     args = []
     args.insert(0, 'bastproxy.py')
     args.insert(0, sys.executable)
+    args.extend(self.sessionargs())
 
     plistener = self.api('managers.getm')('listener')
-    plistener.close()
+    if not self.api.SESSION:
+      plistener.close()
     self.api('proxy.shutdown')()
 
     time.sleep(5)
 
     os.execv(executable, args)
 
+  # restart the proxy without dropping the connections
+  def api_hotrestart(self):
+    """
+    restart the proxy, the new process takes over the listener, the
+    mud connection and the clients
+    """
+    if self.handoffdeadline:
+      return
+    self.api('send.client')('Hot restarting bastproxy')
+    self.handoffdeadline = time.time() + HANDOFFWAIT
+    self.handoffcheck()
+
+  def handoffcheck(self):
+    """
+    wait for the options on the mud connection to be ready to be
+    handed over (the mud has ended a compressed stream)
+    """
+    mud = self.api('managers.getm')('mud')
+    handlers = mud.option_handlers.values() if mud and mud.connected else []
+    notready = [handler for handler in handlers if not handler.handoffready()]
+    if not notready:
+      self.handoffdeadline = None
+      self.hotrestart()
+    elif time.time() > self.handoffdeadline:
+      self.handoffdeadline = None
+      for handler in handlers:
+        handler.cancelhandoff()
+      self.api('send.client')(
+          'Hot restart cancelled, the mud connection was not ready')
+    else:
+      self.api('reactor.calllater')(.1, self.handoffcheck)
+
+  def hotrestart(self):
+    """
+    save the state of the connections and exec a new process that
+    takes them over
+    """
+    from libs.net.client import Client, CLOSING
+    from libs.net.mud import CONNECTED
+
+    self.api('plugins.savestate')()
+
+    reactor = self.api('managers.getm')('reactor')
+    plistener = self.api('managers.getm')('listener')
+    mud = self.api('managers.getm')('mud')
+
+    reactor.flushall()
+
+    state = {'listener':plistener.socket.fileno(),
+             'mud':None,
+             'clients':[],
+             'plugins':{}}
+    inheritable(state['listener'])
+    if mud and mud.connstate == CONNECTED:
+      state['mud'] = mud.getstate()
+    for obj in reactor.map.values():
+      if isinstance(obj, Client) and obj.connected:
+        if obj.state == CLOSING:
+          obj.closenow()
+        else:
+          state['clients'].append(obj.getstate())
+
+    self.api('events.eraise')('proxy_hotrestart', {'state':state['plugins']})
+
+    filename = os.path.join(self.api.DATAPATH, 'hotrestart.pickle')
+    with open(filename, 'wb') as fileobj:
+      pickle.dump(state, fileobj, 2)
+
+    self.api('send.msg')('Proxy: hot restart with %s clients' % \
+                            len(state['clients']), primary='net')
+    sys.stdout.flush()
+
+    os.execv(sys.executable, [sys.executable, sys.argv[0],
+                              '-e', reactor.backend, '-r', filename] + \
+                                  self.sessionargs())
+
+  def sessionargs(self):
+    """
+    the arguments for a new process of a session, it keeps the channel
+    to the supervisor
+    """
+    if not self.api.SESSION:
+      return []
+    plistener = self.api('managers.getm')('listener')
+    inheritable(plistener.socket.fileno())
+    return ['--session', self.api.SESSION,
+            '--channel', str(plistener.socket.fileno())]
+
+  # take over the connections after a hot restart
+  def api_restore(self, state):
+    """
+    take over the mud connection and the clients from the process
+    that did a hot restart
+    """
+    from libs.net.client import Client, CONNECTED
+    from libs.net.mud import Mud
+
+    plistener = self.api('managers.getm')('listener')
+    mud = Mud()
+    plistener.mud = mud
+    if state['mud']:
+      mud.setstate(state['mud'])
+      self.settcpoptions(mud)
+      mud.promptdelay = self.api('setting.gets')('promptdelay')
+      mud.scheduleprompt()
+
+    for cstate in state['clients']:
+      client = Client(None, cstate['host'], cstate['port'], state=cstate)
+      self.settcpoptions(client)
+      if client.state == CONNECTED:
+        self.api('clients.addrestored')(client)
+
+    self.api('events.eraise')('proxy_restored', {'state':state['plugins']})
+
+    self.api('send.msg')('Proxy: restored %s clients after a hot restart' % \
+                            len(state['clients']), primary='net')
+    self.api('send.client')('Hot restart finished')
+
   def listenportchange(self, args): # pylint: disable=unused-argument
     """
-    restart when the listen port changes
+    restart when the listen port changes, the supervisor has the port
+    when running sessions
     """
-    if not self.api.loading:
+    if not self.api.loading and not self.api.SESSION:
       self.api('proxy.restart')()
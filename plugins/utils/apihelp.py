@@ -1,7 +1,12 @@
 """
 This plugin will show api functions and details
+
+The stats command shows the number of calls and the times of api functions
+while api stats are on, the time of a function includes the api functions
+it calls.
 """
 import libs.argp as argp
+from libs.api import bucketstart
 from plugins._baseplugin import BasePlugin
 
 #these 5 are required
@@ -44,6 +49,22 @@ class Plugin(BasePlugin):
                         default='', nargs='?')
     self.api('commands.add')('detail', self.cmd_detail,
                              parser=parser)
+    parser = argp.ArgumentParser(add_help=False,
+                                 description='show stats for api functions')
+    parser.add_argument('api',
+                        help='the api to show the histogram for (optional)',
+                        default='', nargs='?')
+    parser.add_argument('-t', '--toggle',
+                        help='turn the stats on or off',
+                        action='store_true', default=False)
+    parser.add_argument('-r', '--reset',
+                        help='clear the stats',
+                        action='store_true', default=False)
+    parser.add_argument('-c', '--count',
+                        help='the number of functions to show',
+                        type=int, default=20)
+    self.api('commands.add')('stats', self.cmd_stats,
+                             parser=parser)
 
 
   def cmd_detail(self, args):
@@ -77,3 +98,71 @@ class Plugin(BasePlugin):
       tmsg.extend(apilist)
 
     return True, tmsg
+
+  def cmd_stats(self, args):
+    """
+    @G%(name)s@w - @B%(cmdname)s@w
+    show stats for api functions, the most total time first
+      @CUsage@w: stats @Y<api>@w
+      @Yapi@w = (optional) the api to show the histogram for
+    """
+    tmsg = []
+    if args['toggle']:
+      if self.api('api.timing')():
+        tmsg.append('api stats are on')
+      else:
+        tmsg.append('api stats are off')
+      return True, tmsg
+
+    stats = self.api('api.stats')(args['reset'])
+    if args['reset']:
+      tmsg.append('api stats have been cleared')
+      return True, tmsg
+
+    # a stat is added when a function is looked up, skip the ones that
+    # have not been called since
+    stats = [stat for stat in stats if stat.calls]
+
+    if not stats:
+      tmsg.append('There are no api stats, turn them on with -t')
+      return True, tmsg
+
+    if args['api']:
+      for stat in stats:
+        if stat.apiname == args['api']:
+          tmsg.extend(self.formathistogram(stat))
+          return True, tmsg
+      tmsg.append('There are no stats for %s' % args['api'])
+      return True, tmsg
+
+    tmsg.append('%-30s : %8s %10s %8s %8s %8s %8s' % \
+                  ('Function', 'Calls', 'Total ms', 'Avg us', 'p50 us',
+                   'p99 us', 'Max us'))
+    tmsg.append('@B' + '-' * 87 + '@w')
+    for stat in stats[:args['count']]:
+      tmsg.append('%-30s : %8s %10.2f %8.1f %8s %8s %8.0f' % \
+                    (stat.apiname, stat.calls, stat.total * 1000,
+                     stat.total * 1000000 / stat.calls,
+                     stat.percentile(50), stat.percentile(99),
+                     stat.max * 1000000))
+
+    return True, tmsg
+
+  def formathistogram(self, stat):
+    """
+    format the histogram of an api function
+    """
+    tmsg = []
+    tmsg.append('%-20s : %s' % ('Function', stat.apiname))
+    tmsg.append('%-20s : %s' % ('Calls', stat.calls))
+    if not stat.calls:
+      return tmsg
+    tmsg.append('%-20s : %.2f' % ('Total ms', stat.total * 1000))
+    tmsg.append('@B' + '-' * 40 + '@w')
+    tmsg.append('%-20s : %s' % ('Time (us)', 'Calls'))
+    for index in sorted(stat.histogram):
+      tmsg.append('%-20s : %s' % \
+                    ('%s - %s' % (bucketstart(index), bucketstart(index + 1) - 1),
+                     stat.histogram[index]))
+
+    return tmsg
@@ -2,8 +2,6 @@
 This plugin sends mail
 """
 import smtplib
-import os
-import signal
 from datetime import datetime
 
 import libs.argp as argp
@@ -19,6 +17,18 @@ VERSION = 1
 # This keeps the plugin from being autoloaded if set to False
 AUTOLOAD = False
 
+def sendmail(server, ssl, username, password, mailfrom, mailto, mhead):
+  """
+  send an email, this blocks so it is run in the reactor executor
+  """
+  server = smtplib.SMTP(server)
+  if ssl:
+    server.starttls()
+  server.login(username, password)
+  server.sendmail(mailfrom, mailto, mhead)
+  server.quit()
+
+
 class Plugin(BasePlugin):
   """
   a plugin to send email
@@ -133,34 +143,23 @@ X-Mailer: My-Mail
 
 %s""" % (senddate,
          self.api('setting.gets')('from'), mailto, subject, msg)
-    oldchild = signal.getsignal(signal.SIGCHLD)
-
-    try:
-      signal.signal(signal.SIGCHLD, signal.SIG_IGN)
-      pid = os.fork()
-      if pid == 0:
-        server = '%s:%s' % (self.api('setting.gets')('server'),
-                            self.api('setting.gets')('port'))
-        server = smtplib.SMTP(server)
-        if self.api('setting.gets')('ssl'):
-          server.starttls()
-        server.login(self.api('setting.gets')('username'), self.password)
-        server.sendmail(self.api('setting.gets')('from'), mailto, mhead)
-        server.quit()
-        os._exit(os.EX_OK) # pylint: disable=protected-access
-
-    except:
-      server = '%s:%s' % (self.api('setting.gets')('server'),
-                          self.api('setting.gets')('port'))
-      server = smtplib.SMTP(server)
-      if self.api('setting.gets')('ssl'):
-        server.starttls()
-      server.login(self.api('setting.gets')('username'), self.password)
-      server.sendmail(self.api('setting.gets')('from'), mailto, mhead)
-      server.quit()
-
-    if signal.getsignal(signal.SIGCHLD) != oldchild:
-      signal.signal(signal.SIGCHLD, oldchild)
+    args = ('%s:%s' % (self.api('setting.gets')('server'),
+                        self.api('setting.gets')('port')),
+            self.api('setting.gets')('ssl'),
+            self.api('setting.gets')('username'), self.password,
+            self.api('setting.gets')('from'), mailto, mhead)
+
+    if self.api('api.has')('reactor.runinexecutor'):
+      self.api('reactor.runinexecutor')(sendmail, args,
+                                        errback=self.senderror)
+    else:
+      sendmail(*args)
+
+  def senderror(self, excinfo):
+    """
+    show an error if the email could not be sent
+    """
+    self.api('send.error')('could not send email: %s' % excinfo[1])
 
   def checkpassword(self, _):
     """
@@ -0,0 +1,6 @@
+"""
+tests for bastproxy
+
+run them from the bastproxy directory with
+  python -m unittest discover -s tests -t .
+"""
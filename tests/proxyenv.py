@@ -0,0 +1,37 @@
+"""
+load the plugins once for the tests that need them
+
+the plugins are loaded into a temporary data directory that is removed
+when the tests exit
+"""
+import atexit
+import os
+import shutil
+import tempfile
+
+from libs.api import API as BASEAPI
+# import io so we can add the "send" functions to the api
+from libs import io      # pylint: disable=unused-import
+
+API = BASEAPI()
+
+PLUGINMGR = []
+
+def loadplugins():
+  """
+  load the plugins if they have not been loaded, returns the api
+  """
+  if not PLUGINMGR:
+    BASEAPI.BASEPATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                    os.pardir))
+    BASEAPI.DATAPATH = tempfile.mkdtemp(prefix='bptest')
+    atexit.register(shutil.rmtree, BASEAPI.DATAPATH, True)
+    BASEAPI.loading = True
+
+    from plugins import PluginMgr
+    pluginmgr = PluginMgr()
+    pluginmgr.load()
+    BASEAPI.loading = False
+    PLUGINMGR.append(pluginmgr)
+
+  return API
@@ -0,0 +1,77 @@
+"""
+test the output backpressure and closing of proxy clients
+"""
+import socket
+import unittest
+
+from libs.net.client import Client, CONNECTED, CLOSING
+from libs.net.reactor import Reactor
+from tests.proxyenv import loadplugins
+
+
+class TestClient(unittest.TestCase):
+  """
+  a logged in client connected to a socket the test reads from
+  """
+  reactor = None
+
+  def setUp(self):
+    """
+    create the client
+    """
+    self.api = loadplugins()
+    if not TestClient.reactor:
+      # a reactor that is not run, the tests end each pass with flushall
+      TestClient.reactor = Reactor(socketmap={})
+    proxysock, self.peer = socket.socketpair()
+    self.client = Client(proxysock, '127.0.0.1', 0)
+    self.client.state = CONNECTED
+    self.client.reactor = self.reactor
+    self.peer.setblocking(0)
+    self.reactor.flushall()
+    self.received()
+    self.client.setbackpressure(100, 50, 'drop')
+
+  def tearDown(self):
+    """
+    close the client
+    """
+    self.client.aborting = True
+    self.client.handle_close()
+    self.peer.close()
+
+  def received(self):
+    """
+    return what the peer has been sent
+    """
+    try:
+      return self.peer.recv(65536)
+    except socket.error:
+      return ''
+
+  def test_pending(self):
+    """
+    the output added in a pass counts toward the high watermark
+    """
+    for _ in range(3):
+      self.client.queue('x' * 60)
+    self.assertEqual(self.client.pendingsize, 120)
+    self.assertEqual(len(self.client.backlog), 1)
+
+    # the peer takes everything, so the backlog is sent in the next pass
+    self.reactor.flushall()
+    self.assertFalse(self.client.backlog)
+    self.reactor.flushall()
+    self.assertEqual(self.received(), 'x' * 180)
+
+  def test_closing(self):
+    """
+    a closing client is not read from
+    """
+    self.assertTrue(self.client.readable())
+    self.client.state = CLOSING
+    self.assertFalse(self.client.readable())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,122 @@
+"""
+test how send.execute splits commands
+"""
+import unittest
+
+from tests.proxyenv import loadplugins
+
+
+class TestExecute(unittest.TestCase):
+  """
+  the commands send.execute passes through io_execute_event and sends to
+  the mud
+  """
+  def setUp(self):
+    """
+    load the plugins and note the commands
+    """
+    self.api = loadplugins()
+    self.commands = []
+    self.tomud = []
+    self.api('events.register')('io_execute_event', self.oncommand,
+                                plugin='tests')
+    self.api('events.register')('to_mud_event', self.onmud, prio=1,
+                                plugin='tests')
+
+  def tearDown(self):
+    """
+    unregister the functions
+    """
+    self.api('events.unregister')('io_execute_event', self.oncommand)
+    self.api('events.unregister')('to_mud_event', self.onmud)
+
+  def oncommand(self, args):
+    """
+    note a command
+    """
+    self.commands.append((args['fromdata'], args['fromclient']))
+
+  def onmud(self, args):
+    """
+    note what is sent to the mud
+    """
+    self.tomud.append(args['data'])
+
+  def test_splitchar(self):
+    """
+    the parts of a command split on the separator are not from the client
+    """
+    self.api('send.execute')('look|say hi', fromclient=True)
+    self.assertEqual(self.commands, [('look|say hi', True),
+                                     ('look', False),
+                                     ('say hi', False)])
+    self.assertEqual(self.tomud, ['look\nsay hi\n'])
+
+  def test_splitcr(self):
+    """
+    the lines of a command keep where it came from
+    """
+    self.api('send.execute')('look\r\nsay hi', fromclient=True)
+    self.assertEqual(self.commands, [('look', True), ('say hi', True)])
+
+
+def msgfrom(self, tmsg, primary):
+  """
+  send a message with self as the plugin in the call stack
+  """
+  self.api('send.msg')(tmsg, primary=primary)
+
+
+class TestMsg(unittest.TestCase):
+  """
+  send.msg drops messages that nothing logs
+  """
+  def setUp(self):
+    """
+    load the plugins and note the messages that get to the log plugin
+    """
+    self.api = loadplugins()
+    self.io = self.api('managers.getm')('io')
+    self.log = self.api('plugins.getp')('log')
+    self.wanted = self.log.wanted
+    self.logmsgf = self.io.logmsg
+    self.messages = []
+    self.io.logmsg = self.logmsg
+
+  def tearDown(self):
+    """
+    put the log plugin back
+    """
+    self.log.wanted = self.wanted
+    self.io.logmsg = self.logmsgf
+
+  def logmsg(self, tmsg, tags=None):
+    """
+    note a message, the tags after the first are in no order
+    """
+    self.messages.append((tmsg, tags[0], set(tags[1:])))
+
+  def test_tags(self):
+    """
+    a message is kept when one of its tags is logged
+    """
+    self.log.wanted = set(['logged'])
+    self.api('send.msg')('one', primary='logged')
+    self.api('send.msg')('two', primary='notlogged')
+    self.assertEqual(self.messages, [('one', 'logged', set([None]))])
+
+  def test_stack(self):
+    """
+    a message is kept when a plugin in the call stack is logged
+    """
+    events = self.api('plugins.getp')('events')
+    self.log.wanted = set(['events'])
+    msgfrom(events, 'one', 'notlogged')
+    self.log.wanted = set()
+    msgfrom(events, 'two', 'notlogged')
+    self.assertEqual(self.messages, [('one', 'notlogged',
+                                      set(['events', None]))])
+
+
+if __name__ == '__main__':
+  unittest.main()
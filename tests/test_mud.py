@@ -0,0 +1,96 @@
+"""
+test how the mud passes lines through the events and to the clients
+"""
+import unittest
+
+from libs.net.mud import Mud
+from tests.proxyenv import loadplugins
+
+
+class TestProcessLines(unittest.TestCase):
+  """
+  a batch of lines from the mud goes through from_mud_event one line at a
+  time and reaches the clients in order with anything sent while it is
+  processed
+  """
+  mud = None
+
+  def setUp(self):
+    """
+    load the plugins and catch what is sent to the clients
+    """
+    self.api = loadplugins()
+    if not TestProcessLines.mud:
+      TestProcessLines.mud = Mud()
+    self.sent = []
+    self.seen = []
+    self.registered = []
+    self.register('to_client_event', self.clientdata, prio=99)
+
+  def tearDown(self):
+    """
+    unregister the functions
+    """
+    for eventname, func in self.registered:
+      self.api('events.unregister')(eventname, func)
+
+  def register(self, eventname, func, prio=50):
+    """
+    register a function for this test
+    """
+    self.api('events.register')(eventname, func, prio=prio)
+    self.registered.append((eventname, func))
+
+  def clientdata(self, args):
+    """
+    note what was sent to the clients
+    """
+    self.sent.append(args['original'])
+
+  def first(self, args):
+    """
+    note the line and send something to the clients for the second line
+    """
+    self.seen.append(('first', args['original']))
+    if args['original'] == 'two':
+      self.api('send.client')('note for two', raw=True)
+
+  def second(self, args):
+    """
+    note the line and omit the third line
+    """
+    self.seen.append(('second', args['original']))
+    if args['original'] == 'three':
+      args['omit'] = True
+    return args
+
+  def test_batch(self):
+    """
+    lines with nothing else sent go to the clients in one write
+    """
+    self.register('from_mud_event', self.second, prio=60)
+    self.mud.processlines(['one', 'two', 'three', 'four'])
+    self.assertEqual(self.sent, ['one\r\ntwo\r\nfour'])
+
+  def test_lineorder(self):
+    """
+    each line goes through all the functions before the next line
+    """
+    self.register('from_mud_event', self.first, prio=40)
+    self.register('from_mud_event', self.second, prio=60)
+    self.mud.processlines(['one', 'two'])
+    self.assertEqual(self.seen, [('first', 'one'), ('second', 'one'),
+                                 ('first', 'two'), ('second', 'two')])
+
+  def test_clientorder(self):
+    """
+    something sent while a line is processed comes after the lines
+    before it and before the line
+    """
+    self.register('from_mud_event', self.first, prio=40)
+    self.mud.processlines(['one', 'two', 'three'])
+    self.assertEqual(self.sent, ['one', 'note for two', 'two\r\nthree'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,61 @@
+"""
+test the event loop
+"""
+import unittest
+
+from libs.net.reactor import Reactor
+from tests.proxyenv import loadplugins
+
+
+class Rewriter(object):
+  """
+  an object that gets more data each time it is flushed
+  """
+  def __init__(self, reactor, times):
+    """
+    initialize the instance
+    """
+    self.reactor = reactor
+    self.times = times
+    self.flushed = 0
+
+  def flush(self):
+    """
+    count the flush and ask for another one
+    """
+    self.flushed = self.flushed + 1
+    if self.flushed < self.times:
+      self.reactor.flushlater(self)
+
+
+class TestFlush(unittest.TestCase):
+  """
+  objects that get data during a pass are flushed
+  """
+  reactor = None
+
+  def setUp(self):
+    """
+    create the reactor
+    """
+    loadplugins()
+    if not TestFlush.reactor:
+      TestFlush.reactor = Reactor(socketmap={})
+    self.reactor.dirty = {}
+
+  def test_left(self):
+    """
+    what flushall leaves does not wait for a socket or a timer
+    """
+    obj = Rewriter(self.reactor, 8)
+    self.reactor.flushlater(obj)
+    self.reactor.flushall()
+    self.assertEqual(obj.flushed, 5)
+    self.assertEqual(self.reactor.nexttimeout(), 0)
+    self.reactor.runonce(self.reactor.nexttimeout())
+    self.assertEqual(obj.flushed, 8)
+    self.assertFalse(self.reactor.dirty)
+
+
+if __name__ == '__main__':
+  unittest.main()
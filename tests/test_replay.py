@@ -0,0 +1,124 @@
+"""
+test playing back a capture from the rawmud log
+"""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from libs.net import replay
+from libs.net.telnetlib import IAC, WILL, SB, SE
+from tests.proxyenv import loadplugins
+
+MCCP2 = chr(86)
+
+
+def compressed(text):
+  """
+  start an MCCP2 stream the way a mud does, returns the read that has the
+  start of the stream and text compressed after it
+  """
+  compressor = zlib.compressobj(9)
+  return IAC + SB + MCCP2 + IAC + SE + compressor.compress(text) + \
+         compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class TestCapture(unittest.TestCase):
+  """
+  a capture from an MCCP2 session, the mud logs the read that starts the
+  stream as it came from the socket and the reads after it decompressed
+  """
+  def setUp(self):
+    """
+    write the capture
+    """
+    self.tempdir = tempfile.mkdtemp(prefix='bptest')
+    self.capture = os.path.join(self.tempdir, 'rawmud.log')
+    self.text = ''.join(['line %s\r\n' % i for i in range(20)])
+    self.reads = ['welcome\r\n', IAC + WILL + MCCP2,
+                  'before\r\n' + compressed(self.text)] + \
+                 ['more %s\r\n' % i for i in range(30)]
+
+  def tearDown(self):
+    """
+    remove the capture
+    """
+    shutil.rmtree(self.tempdir, True)
+
+  def writecapture(self, reads):
+    """
+    write reads the way the mud logs them
+    """
+    now = time.time()
+    with open(self.capture, 'w') as fileobj:
+      for i, data in enumerate(reads):
+        fileobj.write('%.6f %s\n' % (now + i * .01,
+                                     data.encode('string_escape')))
+
+  def test_read(self):
+    """
+    the data after the start of the stream is decompressed
+    """
+    self.writecapture(self.reads)
+    reads, skipped = replay.readcapture([self.capture])
+    self.assertEqual(skipped, 0)
+    self.assertEqual(reads[2][1], 'before\r\n' + IAC + SB + MCCP2 + IAC + \
+                                  SE + self.text)
+    self.assertEqual(reads[3][1], 'more 0\r\n')
+
+  def test_split(self):
+    """
+    the start of the stream can be split across two reads
+    """
+    start = self.reads[2]
+    self.writecapture(self.reads[:2] + [start[:12], start[12:]] + \
+                      self.reads[3:])
+    reads, _ = replay.readcapture([self.capture])
+    self.assertEqual(reads[2][1] + reads[3][1],
+                     'before\r\n' + IAC + SB + MCCP2 + IAC + SE + self.text)
+
+  def test_replay(self):
+    """
+    every line of the capture gets through the proxy
+    """
+    loadplugins()
+    self.writecapture(self.reads)
+    reads, _ = replay.readcapture([self.capture])
+    areplay = replay.Replay(reads)
+    areplay.setup()
+    try:
+      results = areplay.run()
+    finally:
+      areplay.mud.close()
+      areplay.feeder.close()
+      for client in areplay.clients:
+        client.close()
+      for client in areplay.fakeclients:
+        client.close()
+      areplay.reactor.waker.close()
+    self.assertEqual(results['lines'], 52)
+    self.assertTrue(areplay.finished())
+
+
+class TestFeeder(unittest.TestCase):
+  """
+  when the feeder sends the reads
+  """
+  def test_nextdue(self):
+    """
+    reads that are not timed are never due, the replay waits on the
+    sockets for the proxy to read
+    """
+    feeder = replay.Feeder(None, [(1.0, 'a'), (2.0, 'b')], 0, None)
+    self.assertEqual(feeder.nextdue(), None)
+    feeder = replay.Feeder(None, [(1.0, 'a'), (2.0, 'b')], 1, None)
+    feeder.start = time.time()
+    self.assertEqual(feeder.nextdue(), 0)
+    feeder.reads.popleft()
+    self.assertTrue(0 < feeder.nextdue() <= 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
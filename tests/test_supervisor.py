@@ -0,0 +1,169 @@
+"""
+test passing clients from the supervisor to a worker
+"""
+import pickle
+import socket
+import time
+import unittest
+
+from _multiprocessing import sendfd
+
+from libs.net import supervisor
+
+
+class FakeSupervisor(object):
+  """
+  a supervisor that keeps what it logs
+  """
+  def __init__(self):
+    """
+    initialize the instance
+    """
+    self.logged = []
+
+  def log(self, msg):
+    """
+    keep a message
+    """
+    self.logged.append(msg)
+
+
+class TestChannel(unittest.TestCase):
+  """
+  the supervisor and worker ends of a channel never block
+  """
+  def setUp(self):
+    """
+    make a channel
+    """
+    self.supervisor = FakeSupervisor()
+    channel, workerchannel = socket.socketpair(socket.AF_UNIX,
+                                               socket.SOCK_DGRAM)
+    # a small buffer so a worker that is not reading fills it quickly
+    channel.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+    self.channel = supervisor.WorkerChannel(self.supervisor, 'test', channel)
+    workerchannel.setblocking(0)
+    self.workerchannel = workerchannel
+    self.receiver = supervisor.ClientReceiver(workerchannel)
+    self.peers = []
+
+  def tearDown(self):
+    """
+    close the sockets
+    """
+    self.channel.close()
+    self.workerchannel.close()
+    for peer in self.peers:
+      peer.close()
+
+  def queueclient(self, data):
+    """
+    queue a new client for the worker, returns the socket the client
+    has, the channel has its own copy of the other end
+    """
+    clientsock, peer = socket.socketpair()
+    self.peers.append(peer)
+    self.channel.queueclient(clientsock, 'host', len(self.peers), data)
+    return peer
+
+  def test_pass(self):
+    """
+    a client and its info get to the worker
+    """
+    peer = self.queueclient('look\r\n')
+    self.channel.handle_write()
+    clients = self.receiver.receive()
+    self.assertEqual([info for info, _ in clients],
+                     [{'host':'host', 'port':1, 'data':'look\r\n'}])
+    self.assertFalse(self.channel.writable())
+    peer.send('hello')
+    self.assertEqual(clients[0][1].recv(10), 'hello')
+    clients[0][1].close()
+    self.assertEqual(self.supervisor.logged,
+                     ['host:1 connected to session test'])
+
+  def test_full(self):
+    """
+    clients are kept while the worker is not reading and sent in order
+    """
+    for i in range(40):
+      self.queueclient(str(i))
+    self.channel.handle_write()
+    self.assertTrue(self.channel.writable())
+
+    received = []
+    while self.channel.writable():
+      clients = self.receiver.receive()
+      self.assertTrue(clients)
+      for info, sock in clients:
+        received.append(info['data'])
+        sock.close()
+      self.channel.handle_write()
+    for info, sock in self.receiver.receive():
+      received.append(info['data'])
+      sock.close()
+    self.assertEqual(received, [str(i) for i in range(40)])
+
+  def test_split(self):
+    """
+    the info of a client is kept until its file descriptor arrives
+    """
+    clientsock, peer = socket.socketpair()
+    self.peers.append(peer)
+    channel = self.channel.socket
+    channel.send(pickle.dumps({'host':'host', 'port':1, 'data':''}, 2))
+    self.assertEqual(self.receiver.receive(), [])
+    sendfd(channel.fileno(), clientsock.fileno())
+    clientsock.close()
+    clients = self.receiver.receive()
+    self.assertEqual([info['port'] for info, _ in clients], [1])
+    clients[0][1].close()
+
+  def test_dropped(self):
+    """
+    a client dropped after its info was sent does not take the place of
+    the next one
+    """
+    channel = self.channel.socket
+    channel.send(pickle.dumps({'host':'dropped', 'port':1, 'data':''}, 2))
+    self.assertEqual(self.receiver.receive(), [])
+    self.queueclient('look\r\n')
+    self.channel.handle_write()
+    clients = self.receiver.receive()
+    self.assertEqual([info for info, _ in clients],
+                     [{'host':'host', 'port':1, 'data':'look\r\n'}])
+    clients[0][1].close()
+
+  def test_noinfo(self):
+    """
+    a file descriptor without info is closed and the next client is
+    received
+    """
+    clientsock, peer = socket.socketpair()
+    self.peers.append(peer)
+    sendfd(self.channel.socket.fileno(), clientsock.fileno())
+    clientsock.close()
+    self.assertEqual(self.receiver.receive(), [])
+    self.assertEqual(peer.recv(10), '')
+    self.queueclient('')
+    self.channel.handle_write()
+    clients = self.receiver.receive()
+    self.assertEqual([info['port'] for info, _ in clients], [2])
+    clients[0][1].close()
+
+  def test_expire(self):
+    """
+    clients the worker does not take in time are closed
+    """
+    peer = self.queueclient('')
+    self.channel.queue[0][4] = time.time() - supervisor.LOGINTIMEOUT - 1
+    self.channel.expire()
+    self.assertFalse(self.channel.writable())
+    self.assertEqual(peer.recv(10), '')
+    self.assertEqual(self.supervisor.logged,
+                     ['could not pass host:1 to session test: ' \
+                      'the session did not take it in time'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,142 @@
+"""
+test the telnet parser with a corpus of streams
+"""
+import unittest
+import zlib
+
+from libs.net.telnetlib import Telnet, IAC, WILL, WONT, DO, SB, SE, GA, \
+                               NOP, ENDREC, EOR, ECHO, TTYPE
+
+GMCP = chr(201)
+MCCP2 = chr(86)
+
+
+class RecordingTelnet(Telnet):
+  """
+  a telnet object that records what the parser found
+  """
+  def __init__(self):
+    Telnet.__init__(self)
+    self.events = []
+    self.decomp = None
+
+  def msg(self, msg, **kwargs):
+    pass
+
+  def handleopt(self, command, option):
+    data = self.read_sb_data()
+    self.events.append((self.ccode(command), ord(option), data))
+    if command == SB and option == MCCP2:
+      self.decomp = zlib.decompressobj(15)
+      return True
+    return False
+
+  def handle_command(self, command):
+    self.events.append((self.ccode(command),))
+
+  def convert_indata(self, data):
+    if self.decomp:
+      return self.decomp.decompress(data)
+    return data
+
+
+def run(chunks):
+  """
+  parse a list of chunks, returns the data and what the parser found
+  """
+  tobj = RecordingTelnet()
+  for chunk in chunks:
+    tobj.parse(tobj.convert_indata(chunk))
+  return tobj.cookedq, tobj.events
+
+
+def compress(data):
+  """
+  compress data the way a mud starting mccp would
+  """
+  compressor = zlib.compressobj(9)
+  return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+# name: (stream, (data, [(command, option, sb data) or (command,)]))
+CORPUS = {
+    'plain text':
+        ('hello there\r\nhow are you\r\n',
+         ('hello there\r\nhow are you\r\n', [])),
+    'escaped IAC':
+        ('a' + IAC + IAC + 'b' + IAC + IAC,
+         ('a' + IAC + 'b' + IAC, [])),
+    'negotiation':
+        (IAC + WILL + GMCP + 'text' + IAC + DO + TTYPE + IAC + WONT + ECHO,
+         ('text', [('WILL', 201, ''), ('DO', 24, ''), ("WON'T", 1, '')])),
+    'subnegotiation':
+        ('before' + IAC + SB + GMCP + 'char.vitals { "hp": 100 }' + \
+         IAC + SE + 'after\r\n',
+         ('beforeafter\r\n', [('SB', 201, 'char.vitals { "hp": 100 }')])),
+    'SE byte in subnegotiation':
+        (IAC + SB + GMCP + 'a' + SE + 'b' + IAC + SE + 'text',
+         ('text', [('SB', 201, 'a' + SE + 'b')])),
+    'IAC IAC in subnegotiation':
+        (IAC + SB + GMCP + 'x' + IAC + IAC + SE + IAC + SE,
+         ('', [('SB', 201, 'x' + IAC + SE)])),
+    'two byte commands':
+        ('prompt> ' + IAC + GA + 'next' + IAC + NOP + IAC + ENDREC + 'end',
+         ('prompt> nextend', [('GA',), ('NOP',), ('EOR',)])),
+    'back to back options':
+        (IAC + SB + GMCP + 'one' + IAC + SE + IAC + SB + GMCP + 'two' + \
+         IAC + SE + IAC + WILL + EOR,
+         ('', [('SB', 201, 'one'), ('SB', 201, 'two'), ('WILL', 25, '')])),
+    'empty subnegotiation':
+        (IAC + SB + TTYPE + IAC + SE + 'x',
+         ('x', [('SB', 24, '')])),
+    'mccp start':
+        ('uncompressed\r\n' + IAC + SB + MCCP2 + IAC + SE + \
+         compress('compressed text' + IAC + IAC + '\r\n' + IAC + GA),
+         ('uncompressed\r\ncompressed text' + IAC + '\r\n',
+          [('SB', 86, ''), ('GA',)])),
+}
+
+
+class TestParse(unittest.TestCase):
+  """
+  parse each stream in the corpus whole and in pieces
+  """
+  def test_whole(self):
+    """
+    each stream parsed at once gives the expected data and options
+    """
+    for name in sorted(CORPUS):
+      stream, expected = CORPUS[name]
+      self.assertEqual(run([stream]), expected, name)
+
+  def test_split(self):
+    """
+    each stream split in three at any two points parses the same
+    """
+    for name in sorted(CORPUS):
+      stream, expected = CORPUS[name]
+      for split in range(1, len(stream)):
+        for split2 in range(split, len(stream) + 1, 3):
+          self.assertEqual(
+              run([stream[:split], stream[split:split2], stream[split2:]]),
+              expected, '%s split at %s, %s' % (name, split, split2))
+
+  def test_bytewise(self):
+    """
+    each stream fed one byte at a time parses the same
+    """
+    for name in sorted(CORPUS):
+      stream, expected = CORPUS[name]
+      self.assertEqual(run(list(stream)), expected, name)
+
+  def test_codes(self):
+    """
+    two byte commands have their own names
+    """
+    self.assertEqual(Telnet.ccode(NOP), 'NOP')
+    self.assertEqual(Telnet.ccode(ENDREC), 'EOR')
+    self.assertEqual(Telnet.ccode(GA), 'GA')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,158 @@
+"""
+test when the triggers plugin looks at mud data
+"""
+import unittest
+
+from libs.records import Line
+from tests.proxyenv import loadplugins
+
+
+class TestLineEvents(unittest.TestCase):
+  """
+  trigger_all, trigger_beall and trigger_emptyline are raised by the
+  function that checks triggers, so it has to look at mud data while
+  something listens to them, even with no triggers
+  """
+  def setUp(self):
+    """
+    load the plugins and start with no triggers
+    """
+    self.api = loadplugins()
+    self.triggers = self.api('plugins.getp')('triggers')
+    self.assertFalse([trig for trig in self.triggers.uniquelookup.values()
+                      if trig['enabled']])
+    self.lines = []
+
+  def tearDown(self):
+    """
+    remove the listeners that are left
+    """
+    for eventname in ['trigger_all', 'trigger_beall', 'trigger_emptyline']:
+      if self.api('events.isregistered')(eventname, self.listener):
+        self.api('events.unregister')(eventname, self.listener)
+
+  def listener(self, args):
+    """
+    note the line
+    """
+    self.lines.append((args['eventname'], args['line']))
+
+  def checking(self):
+    """
+    check if the triggers plugin looks at mud data
+    """
+    return self.api('events.isregistered')('from_mud_event',
+                                           self.triggers.checktrigger)
+
+  def raiselines(self, lines):
+    """
+    send lines through the mud data events
+    """
+    self.api('events.eraisebatch')('from_mud_batch', 'from_mud_event',
+                                   [Line(line) for line in lines])
+
+  def test_nolisteners(self):
+    """
+    mud data is not looked at with no triggers and no listeners
+    """
+    self.assertFalse(self.checking())
+
+  def test_triggerall(self):
+    """
+    a trigger_all listener gets every line with no triggers
+    """
+    self.api('events.register')('trigger_all', self.listener)
+    self.assertTrue(self.checking())
+
+    self.raiselines(['first line', '', 'last line'])
+    self.assertEqual(self.lines, [('trigger_all', 'first line'),
+                                  ('trigger_all', ''),
+                                  ('trigger_all', 'last line')])
+
+    self.api('events.unregister')('trigger_all', self.listener)
+    self.assertFalse(self.checking())
+
+  def test_emptyline(self):
+    """
+    a trigger_emptyline listener gets only the empty lines
+    """
+    self.api('events.register')('trigger_emptyline', self.listener)
+    self.assertTrue(self.checking())
+
+    self.raiselines(['a line', ''])
+    self.assertEqual(self.lines, [('trigger_emptyline', '')])
+
+  def test_disabled(self):
+    """
+    listeners do not make disabled triggers look at mud data
+    """
+    self.api('events.register')('trigger_beall', self.listener)
+    self.assertTrue(self.checking())
+    self.triggers.api('setting.change')('enabled', False)
+    try:
+      self.assertFalse(self.checking())
+    finally:
+      self.triggers.api('setting.change')('enabled', True)
+    self.assertTrue(self.checking())
+
+
+class TestLineViews(unittest.TestCase):
+  """
+  checking triggers only computes the views of a line the regexes need
+  """
+  def setUp(self):
+    """
+    load the plugins
+    """
+    self.api = loadplugins()
+    self.matched = []
+
+  def tearDown(self):
+    """
+    remove the test trigger
+    """
+    self.api('triggers.remove')('testview', force=True)
+    self.api('events.unregister')('trigger_testview', self.onmatch)
+
+  def onmatch(self, args):
+    """
+    note the match
+    """
+    self.matched.append((args['line'], args['colorline']))
+
+  def addtrigger(self, regex, matchcolor):
+    """
+    add the test trigger
+    """
+    self.api('triggers.add')('testview', regex, plugin='tests',
+                             matchcolor=matchcolor)
+    self.api('events.register')('trigger_testview', self.onmatch,
+                                plugin='tests')
+
+  def test_noncolor(self):
+    """
+    a trigger without color does not convert the colors of a line
+    """
+    self.addtrigger('^hello (?P<name>.*)$', False)
+    nomatch = Line('\x1b[1;31mgoodbye\x1b[0m')
+    self.api('events.eraisebatch')('from_mud_batch', 'from_mud_event',
+                                   [nomatch])
+    self.assertIsNone(nomatch._convertansi) # pylint: disable=protected-access
+    self.assertEqual(self.matched, [])
+
+  def test_color(self):
+    """
+    a trigger that matches colors does not strip the colors of a line
+    that it does not match
+    """
+    self.addtrigger('^@Rhello', True)
+    nomatch = Line('\x1b[1;31mgoodbye\x1b[0m')
+    match = Line('\x1b[1;31mhello\x1b[0m')
+    self.api('events.eraisebatch')('from_mud_batch', 'from_mud_event',
+                                   [nomatch, match])
+    self.assertIsNone(nomatch._noansi) # pylint: disable=protected-access
+    self.assertEqual([line for line, _ in self.matched], ['hello'])
+
+
+if __name__ == '__main__':
+  unittest.main()